@@ -0,0 +1,165 @@
+import logging
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import func, select
+
+from common import coerce_to_schema
+from backend.db.dbconnect import get_engine
+from backend.db.models import LATEST_TABLES, DisaggregatedFuturesOptions, Legacy, PositioningAnalytics
+from backend.db.upsert import upsert_dataframe
+
+logger = logging.getLogger(__name__)
+
+
+# trader categories of each COT table, as (long column, short column)
+CATEGORIES = {
+    DisaggregatedFuturesOptions.__tablename__: {
+        "Prod_Merc": ("Prod_Merc_Positions_Long_All", "Prod_Merc_Positions_Short_All"),
+        "Swap": ("Swap_Positions_Long_All", "Swap__Positions_Short_All"),
+        "M_Money": ("M_Money_Positions_Long_All", "M_Money_Positions_Short_All"),
+        "Other_Rept": ("Other_Rept_Positions_Long_All", "Other_Rept_Positions_Short_All"),
+        "NonRept": ("NonRept_Positions_Long_All", "NonRept_Positions_Short_All"),
+    },
+    Legacy.__tablename__: {
+        "Commercial": ("Commercial_Positions_Long_All", "Commercial_Positions_Short_All"),
+        "Noncommercial": ("Noncommercial_Positions_Long_All", "Noncommercial_Positions_Short_All"),
+    },
+}
+
+# rolling windows, in weekly reports
+WINDOWS = (52, 156)
+
+GROUP = ["Market_Code", "Report_Type", "Category"]
+
+
+def net_positions(df: pd.DataFrame, categories: dict) -> pd.DataFrame:
+    """
+    Turns report rows into one row per (Date, Market_Code, Report_Type, Category) with the net position
+    (long minus short) of the category and its share of the open interest. Categories whose columns are
+    missing from `df` are left out.
+    """
+    frames = []
+    for category, (long, short) in categories.items():
+        if long not in df.columns or short not in df.columns:
+            continue
+        net = df[long] - df[short]
+        frames.append(pd.DataFrame({"Date": df["Date"], "Market_Code": df["Market_Code"], "Report_Type": df["Report_Type"],
+                                    "Category": category, "Net_Position": net,
+                                    "Pct_of_OI_Net": net / df["Open_Interest_All"].replace(0, np.nan) * 100}))
+    if not frames:
+        return pd.DataFrame(columns=["Date"] + GROUP + ["Net_Position", "Pct_of_OI_Net"])
+    return pd.concat(frames, ignore_index=True)
+
+
+def positioning_analytics(df: pd.DataFrame, categories: dict, windows=WINDOWS) -> pd.DataFrame:
+    """
+    Computes the positioning analytics of every market and category at once.
+
+    For each (Market_Code, Report_Type, Category), in report date order: the net position, its change from the
+    previous report, and over each rolling window of `windows` reports the COT index (where the net position
+    sits between its window minimum and maximum, 0 to 100), the z-score and the percentile rank. A rolling
+    value is missing until the window is full.
+
+    Args:
+        df (pd.DataFrame): Report rows with "Date", "Market_Code", "Report_Type", "Open_Interest_All" and the
+            long and short columns of `categories`.
+        categories (dict): Category -> (long column, short column), e.g. `CATEGORIES["legacy"]`.
+        windows (tuple, optional): Rolling window lengths in reports. Defaults to (52, 156).
+
+    Returns:
+        pd.DataFrame: One row per (Date, Market_Code, Report_Type, Category), named like PositioningAnalytics.
+    """
+    net = net_positions(df, categories)
+    net = net.assign(Net_Position=pd.to_numeric(net["Net_Position"], errors="coerce").astype("float64"))
+    net = net.sort_values(GROUP + ["Date"], ignore_index=True)
+
+    grouped = net.groupby(GROUP, sort=False)["Net_Position"]
+    derived = {"Net_Change": grouped.diff()}
+    for window in windows:
+        rolling = grouped.rolling(window, min_periods=window)
+        # rolling results are indexed by the group keys first, then by the row they belong to
+        low, high = rolling.min().droplevel(GROUP), rolling.max().droplevel(GROUP)
+        mean, std = rolling.mean().droplevel(GROUP), rolling.std().droplevel(GROUP)
+        derived["COT_Index_{}W".format(window)] = (net["Net_Position"] - low) / (high - low).replace(0, np.nan) * 100
+        derived["Z_Score_{}W".format(window)] = (net["Net_Position"] - mean) / std.replace(0, np.nan)
+        derived["Pct_Rank_{}W".format(window)] = rolling.rank(pct=True).droplevel(GROUP) * 100
+
+    return net.assign(**derived)
+
+
+def _read_rows(conn, table, columns, since=None):
+    stmt = select(*[table.c[c] for c in columns if c in table.c])
+    if since is not None:
+        stmt = stmt.where(table.c.Date >= since)
+    result = conn.execute(stmt)
+    df = pd.DataFrame(result.fetchall(), columns=list(result.keys()))
+    return df.assign(Date=pd.to_datetime(df["Date"]))
+
+
+def refresh_analytics(mappers=(DisaggregatedFuturesOptions, Legacy), engine=None, full: bool = False,
+                      revised: dict = None) -> int:
+    """
+    Brings the positioning_analytics table up to date with the COT tables.
+
+    Only the report dates after the last one already computed for each (Market_Code, Report_Type) are
+    written. They are computed from the reports of the longest window before them, so a weekly refresh reads
+    about three years of rows instead of the full history. Markets never computed, or a `full` refresh,
+    read the full history. Markets whose past reports were revised are recomputed from the first revised
+    date on, the rolling values after it included.
+
+    Args:
+        mappers (tuple, optional): COT tables to compute. Defaults to DisaggregatedFuturesOptions and Legacy.
+        engine (Engine, optional): Defaults to the COT database engine.
+        full (bool, optional): Recompute every report date. Defaults to False.
+        revised (dict, optional): (Market_Code, Report_Type) -> first revised report date, as returned by
+            `cot.save_new_rows`. Defaults to None.
+
+    Returns:
+        int: Number of analytics rows written.
+    """
+    engine = engine or get_engine()
+    analytics = PositioningAnalytics.__table__
+    written = 0
+
+    for mapper in mappers:
+        table = mapper.__table__
+        categories = CATEGORIES[table.name]
+        columns = ["Date", "Market_Code", "Report_Type", "Open_Interest_All"] + [c for pair in categories.values() for c in pair]
+        latest = LATEST_TABLES[table.name]
+
+        with engine.connect() as conn:
+            pairs = set(conn.execute(select(latest.c.Market_Code, latest.c.Report_Type)).fetchall())
+            last = {} if full else {
+                (market_code, report_type): last_date for market_code, report_type, last_date in conn.execute(
+                    select(analytics.c.Market_Code, analytics.c.Report_Type, func.max(analytics.c.Date))
+                    .where(analytics.c.Report_Type.in_({report_type for _, report_type in pairs}))
+                    .group_by(analytics.c.Market_Code, analytics.c.Report_Type))}
+            for pair, first_revised in (revised or {}).items():
+                if pair in last:
+                    # the revised date is written again, and every one after it
+                    last[pair] = min(pd.Timestamp(last[pair]), pd.Timestamp(first_revised) - timedelta(days=1))
+
+            since = None
+            if last and all(pair in last for pair in pairs):
+                # enough reports before the oldest new one to fill the longest window, with room for missed weeks
+                since = min(pd.Timestamp(d).date() for d in last.values()) - timedelta(weeks=max(WINDOWS) + 8)
+            rows = _read_rows(conn, table, columns, since)
+
+        if rows.empty:
+            continue
+
+        df = positioning_analytics(rows, categories)
+        if last:
+            last_dates = pd.Series({pair: pd.Timestamp(d) for pair, d in last.items()}, dtype="datetime64[ns]")
+            keys = pd.MultiIndex.from_frame(df[["Market_Code", "Report_Type"]])
+            previous = last_dates.reindex(keys).to_numpy()
+            df = df[pd.isna(previous) | (df["Date"].to_numpy() > previous)]
+
+        if not df.empty:
+            inserted, updated = upsert_dataframe(PositioningAnalytics, coerce_to_schema(df, PositioningAnalytics), engine)
+            written += inserted + updated
+        logger.info("{} positioning analytics rows written for {}".format(len(df), table.name))
+
+    return written
@@ -0,0 +1,335 @@
+import json
+import logging
+import os
+import shutil
+import time
+from datetime import date
+from email.utils import formatdate
+from pathlib import Path
+from typing import Iterable, Optional, Union
+
+from downloader import Download, DownloadError, download, file_sha256
+from metrics import stage
+
+logger = logging.getLogger(__name__)
+
+
+CFTC_BASE_URL = "https://cftc.gov/files/dea/history/"
+
+# the bulk archive covers every year up to 2016, later years are published one archive per year
+HIST = "hist"
+FIRST_YEARLY_ARCHIVE = 2017
+
+# report type -> (bulk history archive, yearly archive prefix), as published on the CFTC history page
+ARCHIVES = {
+    "legacy_fut": ("deacot1986_2016", "deacot"),
+    "legacy_futopt": ("deahistfo_1995_2016", "deahistfo"),
+    "supplemental_futopt": ("dea_cit_txt_2006_2016", "dea_cit_txt_"),
+    "disaggregated_fut": ("fut_disagg_txt_hist_2006_2016", "fut_disagg_txt_"),
+    "disaggregated_futopt": ("com_disagg_txt_hist_2006_2016", "com_disagg_txt_"),
+    "traders_in_financial_futures_fut": ("fin_fut_txt_2006_2016", "fut_fin_txt_"),
+    "traders_in_financial_futures_futopt": ("fin_com_txt_2006_2016", "com_fin_txt_"),
+}
+
+DEFAULT_CACHE_DIR = Path(__file__).resolve().parent.joinpath("ARCHIVE_CACHE")
+DEFAULT_MAX_BYTES = 1024 ** 3
+
+# seconds a freshly fetched current-year archive is used without revalidating it, e.g. by the worker
+# processes of a run after it was prefetched
+DEFAULT_FRESH_FOR = 600
+
+
+class ArchiveNotCached(Exception):
+    """Raised in offline mode when a requested archive is not in the cache."""
+
+
+class ArchiveNotPublished(DownloadError):
+    """Raised when an archive is not on the CFTC site (HTTP 404), e.g. the new year's in early January."""
+
+
+def archive_name(report_type: str, year: Union[int, str]) -> str:
+    """
+    Returns the archive file name (without extension) of a report type and year, or of its bulk history when `year` is `HIST`.
+    """
+    if report_type not in ARCHIVES:
+        raise ValueError("Unknown report type {}, expected one of {}".format(report_type, list(ARCHIVES)))
+    hist_name, prefix = ARCHIVES[report_type]
+    if year == HIST:
+        return hist_name
+    if int(year) < FIRST_YEARLY_ARCHIVE:
+        raise ValueError("Years before {} are only published in the {} archive".format(FIRST_YEARLY_ARCHIVE, hist_name))
+    return prefix + str(int(year))
+
+
+def is_current(year: Union[int, str]) -> bool:
+    return year != HIST and int(year) == date.today().year
+
+
+def archive_years(since_year: Optional[int] = None) -> list:
+    """
+    Returns the archive keys covering `since_year` up to the current year: `HIST` first if needed, then each year.
+    """
+    current_year = date.today().year
+    if since_year is None or since_year < FIRST_YEARLY_ARCHIVE:
+        return [HIST] + list(range(FIRST_YEARLY_ARCHIVE, current_year + 1))
+    return list(range(since_year, current_year + 1))
+
+
+class ArchiveCache:
+    """
+    Local cache of the raw CFTC report archives, keyed by report type and year.
+
+    Each archive is stored as `<directory>/<report_type>/<name>.zip` next to a `<name>.json` file holding its
+    ETag, Last-Modified, SHA-256, size, modification time and last access time. Closed years never change and are
+    served from disk, hashed again only when their size or modification time no longer match; only the current
+    year's archive is revalidated with a conditional request, once it is older than `fresh_for` seconds. Until the
+    CFTC publishes the new year's archive, its 404 means "no rows yet" and `get` returns None. The total size is capped at `max_bytes`, evicting the least recently used
+    archives first. Archives are downloaded through `downloader`, with retries and resumed transfers, and
+    `prefetch` downloads everything a run needs concurrently.
+
+    `base_url` may also be a local directory laid out like the CFTC history page, which stands in for the site
+    in tests and air-gapped runs. With `offline` set the network is never touched.
+    """
+
+    def __init__(self, directory: Union[str, Path, None] = None, base_url: Optional[str] = None,
+                 max_bytes: Optional[int] = None, offline: Optional[bool] = None, timeout: int = 60,
+                 fresh_for: Optional[int] = None, per_host: Optional[int] = None, retries: Optional[int] = None):
+        self.directory = Path(directory or os.getenv("COT_CACHE_DIR") or DEFAULT_CACHE_DIR)
+        self.base_url = base_url or os.getenv("COT_BASE_URL") or CFTC_BASE_URL
+        self.max_bytes = int(max_bytes if max_bytes is not None else os.getenv("COT_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES))
+        if offline is None:
+            offline = os.getenv("COT_OFFLINE", "").lower() in ("1", "true", "yes")
+        self.offline = offline
+        self.timeout = timeout
+        self.fresh_for = int(fresh_for if fresh_for is not None else os.getenv("COT_CACHE_FRESH_SECONDS", DEFAULT_FRESH_FOR))
+        self.per_host = int(per_host if per_host is not None else os.getenv("COT_DOWNLOAD_PER_HOST", 4))
+        self.retries = int(retries if retries is not None else os.getenv("COT_DOWNLOAD_RETRIES", 5))
+
+    def _paths(self, report_type, year):
+        name = archive_name(report_type, year)
+        folder = self.directory.joinpath(report_type)
+        return folder.joinpath(name + ".zip"), folder.joinpath(name + ".json")
+
+    @staticmethod
+    def _read_meta(meta_path):
+        try:
+            with open(meta_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _write_meta(meta_path, meta):
+        tmp = meta_path.with_suffix(".json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(meta, f, indent=1)
+        os.replace(tmp, meta_path)
+
+    def _is_valid(self, path, meta):
+        """
+        Checks a cached archive against the size and SHA-256 recorded with it. The file is only hashed again
+        when its modification time differs from the recorded one, which is then updated in `meta`.
+        """
+        if meta is None or not path.exists():
+            return False
+        stat = path.stat()
+        if stat.st_size != meta.get("size"):
+            return False
+        if stat.st_mtime_ns == meta.get("mtime_ns"):
+            return True
+        if file_sha256(path) != meta.get("sha256"):
+            return False
+        meta["mtime_ns"] = stat.st_mtime_ns
+        return True
+
+    def get(self, report_type: str, year: Union[int, str]) -> Optional[Path]:
+        """
+        Returns the path of the cached archive for `report_type` and `year`, downloading or revalidating it as needed.
+        The current year's archive is not published in the first days of January: None is returned until it is.
+
+        Args:
+            report_type (str): One of the report types in `ARCHIVES`.
+            year (int | str): The archive year, or `HIST` for the bulk history archive.
+
+        Returns:
+            Path: Location of the zip archive inside the cache, None for a current year not published yet.
+
+        Raises:
+            ArchiveNotCached: In offline mode, when the archive has not been cached (or fails its hash check).
+            DownloadError: When the archive cannot be downloaded, `ArchiveNotPublished` when it is not on the site.
+        """
+        path, meta_path = self._paths(report_type, year)
+        with stage("download", report_type=report_type, year=str(year)) as record:
+            meta = self._read_meta(meta_path)
+            valid = self._is_valid(path, meta)
+
+            record["bytes"] = 0
+            if self.offline:
+                if not valid:
+                    raise ArchiveNotCached("{} {} is not cached under {}".format(report_type, year, self.directory))
+            elif self._needs_fetch(year, meta, valid):
+                try:
+                    meta, record["bytes"] = self._fetch(report_type, year, path, meta_path, meta if valid else None)
+                except ArchiveNotPublished:
+                    if not is_current(year) or valid:
+                        raise
+                    logger.info("{} {} is not published yet".format(report_type, year))
+                    return None
+
+        meta["accessed"] = time.time()
+        self._write_meta(meta_path, meta)
+        self.evict(keep=path)
+        return path
+
+    def _needs_fetch(self, year, meta, valid):
+        if not valid:
+            return True
+        closed = year == HIST or int(year) < date.today().year
+        return not closed and time.time() - meta.get("fetched", 0) > self.fresh_for
+
+    def _fetch(self, report_type, year, path, meta_path, meta):
+        name = archive_name(report_type, year) + ".zip"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".zip.part")
+
+        if self.base_url.startswith(("http://", "https://")):
+            fetched = self._download([(report_type, year, meta)])[0]
+            if fetched.status == "failed":
+                error = ArchiveNotPublished if fetched.status_code == 404 else DownloadError
+                raise error("downloading {} failed: {}".format(fetched.url, fetched.error))
+            return self._commit(fetched, meta), fetched.transferred
+        else:
+            # a local directory standing in for the CFTC site
+            source = Path(self.base_url.replace("file://", "", 1)).joinpath(name)
+            url = str(source)
+            if not source.exists():
+                raise ArchiveNotPublished("{} does not exist".format(url))
+            last_modified = formatdate(source.stat().st_mtime, usegmt=True)
+            if meta and meta.get("last_modified") == last_modified:
+                return meta, 0
+            shutil.copyfile(source, tmp)
+            etag = None
+
+        transferred = tmp.stat().st_size
+        sha256 = file_sha256(tmp)
+        if meta and meta.get("sha256") == sha256:
+            os.remove(tmp)
+        else:
+            os.replace(tmp, path)
+            logger.info("cached {} ({} bytes)".format(url, path.stat().st_size))
+
+        return {"url": url, "etag": etag, "last_modified": last_modified, "sha256": sha256,
+                "size": path.stat().st_size, "mtime_ns": path.stat().st_mtime_ns, "fetched": time.time()}, transferred
+
+    def _download(self, archives):
+        """
+        Downloads (report type, year, metadata of the valid cached copy or None) archives concurrently, with
+        conditional requests for the cached ones.
+        """
+        downloads = []
+        for report_type, year, meta in archives:
+            name = archive_name(report_type, year) + ".zip"
+            meta = meta or {}
+            downloads.append(Download(self.base_url.rstrip("/") + "/" + name, self._paths(report_type, year)[0],
+                                      etag=meta.get("etag"), last_modified=meta.get("last_modified")))
+        return download(downloads, per_host=self.per_host, retries=self.retries, timeout=self.timeout)
+
+    def _commit(self, fetched, meta):
+        """
+        Returns the metadata of an archive after its download, which left it in place unless it was not modified.
+        """
+        if fetched.status == "not_modified":
+            logger.debug("{} not modified".format(fetched.url))
+            return dict(meta, fetched=time.time())
+        logger.info("cached {} ({} bytes)".format(fetched.url, fetched.path.stat().st_size))
+        return {"url": fetched.url, "etag": fetched.etag, "last_modified": fetched.last_modified,
+                "sha256": fetched.sha256, "size": fetched.path.stat().st_size,
+                "mtime_ns": fetched.path.stat().st_mtime_ns, "fetched": time.time()}
+
+    def prefetch(self, archives: Iterable[tuple]) -> None:
+        """
+        Brings every (report type, year) archive of `archives` up to date at once, downloading the missing and
+        stale ones concurrently instead of one `get` after the other. Failed downloads are logged and left to
+        the `get` that needs them.
+        """
+        if self.offline:
+            return
+        if not self.base_url.startswith(("http://", "https://")):
+            for report_type, year in archives:
+                self.get(report_type, year)
+            return
+
+        stale = []
+        for report_type, year in dict.fromkeys(archives):
+            path, meta_path = self._paths(report_type, year)
+            meta = self._read_meta(meta_path)
+            valid = self._is_valid(path, meta)
+            if self._needs_fetch(year, meta, valid):
+                stale.append((report_type, year, meta if valid else None))
+        if not stale:
+            return
+
+        with stage("download", archives=len(stale)) as record:
+            fetched = self._download(stale)
+            for (report_type, year, meta), result in zip(stale, fetched):
+                if result.status == "failed":
+                    if result.status_code == 404 and is_current(year):
+                        logger.info("{} is not published yet".format(result.url))
+                    else:
+                        logger.warning("prefetching {} failed: {}".format(result.url, result.error))
+                    continue
+                meta = self._commit(result, meta)
+                meta["accessed"] = time.time()
+                self._write_meta(self._paths(report_type, year)[1], meta)
+            record["bytes"] = sum(result.transferred for result in fetched)
+        self.evict()
+
+    def entries(self) -> list:
+        """
+        Returns (archive path, metadata) pairs for everything in the cache.
+        """
+        entries = []
+        for meta_path in self.directory.glob("*/*.json"):
+            meta = self._read_meta(meta_path)
+            path = meta_path.with_suffix(".zip")
+            if meta is not None and path.exists():
+                entries.append((path, meta))
+        return entries
+
+    def evict(self, keep: Optional[Path] = None) -> None:
+        """
+        Deletes the least recently used archives until the cache fits in `max_bytes`, never deleting `keep`.
+        """
+        entries = sorted(self.entries(), key=lambda entry: entry[1].get("accessed", 0))
+        total = sum(path.stat().st_size for path, _ in entries)
+
+        for path, meta in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            total -= path.stat().st_size
+            os.remove(path)
+            os.remove(path.with_suffix(".json"))
+            logger.info("evicted {} from the archive cache".format(path.name))
+
+
+_default_cache = None
+
+
+def get_archive_cache() -> ArchiveCache:
+    """
+    Returns the process-wide archive cache, configured from the COT_CACHE_* / COT_BASE_URL / COT_OFFLINE env variables.
+    """
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = ArchiveCache()
+    return _default_cache
+
+
+def set_archive_cache(cache: Optional[ArchiveCache]) -> None:
+    """
+    Replaces the process-wide archive cache, e.g. with an offline one. Passing None resets it to the env defaults.
+    """
+    global _default_cache
+    _default_cache = cache
@@ -1,17 +1,288 @@
-import sys
-import pathlib
-from db.dbconnect import connect_to_database as db_cot
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import Date, DateTime, Float, Integer, Numeric, select
+from sqlalchemy.exc import SQLAlchemyError
+
+from backend.db.dbconnect import connect_to_database as db_cot
+from backend.db.models import LATEST_TABLES
+from backend.db.versions import get_data_version
+
+logger = logging.getLogger(__name__)
+
+
+class ReadCache:
+    """
+    LRU cache of query results with a time to live, emptied whenever the data version moved forward.
+    The data version is read from the database before every cached read by default (a primary key lookup), so
+    results are never stale. A `version_check` of n seconds reads it at most every n seconds instead, at the
+    cost of serving results up to n seconds older than the last load
+    """
+
+    def __init__(self, max_entries=256, ttl=300, version_check=0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.version_check = version_check
+        self.version = None
+        self.version_checked = None
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def validate(self, read_version):
+        """
+        Empties the cache if the data version changed since it was last read with `read_version()`
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self.version_checked is not None and now - self.version_checked < self.version_check:
+                return
+            self.version_checked = now
+        version = read_version()
+        with self._lock:
+            if version != self.version:
+                self._entries.clear()
+                self.version = version
+
+    def get(self, key):
+        """
+        Returns (True, value) for a live entry, (False, None) otherwise
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# shared by every controller of the process, as they read the same database
+_READ_CACHE = ReadCache(max_entries=int(os.getenv("COT_READ_CACHE_SIZE", 256)),
+                        ttl=float(os.getenv("COT_READ_CACHE_TTL", 300)),
+                        version_check=float(os.getenv("COT_READ_CACHE_VERSION_CHECK", 0)))
+
+
+def _freeze(value):
+    # cache keys must be hashable, the query arguments may hold lists
+    if isinstance(value, (list, tuple, set)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    return value
+
+
+def _copy_result(value):
+    # callers get their own copy, so changing a result never changes the cached one
+    if isinstance(value, pd.DataFrame):
+        return value.copy()
+    if isinstance(value, list):
+        return [dict(v) if isinstance(v, dict) else v for v in value]
+    if isinstance(value, dict):
+        return dict(value)
+    return value
+
+
+def cached(method):
+    """
+    Serves the results of a query method from the read cache, keyed on the method, the table and the arguments
+    """
+    @wraps(method)
+    def wrapper(self, mapper, *args, **kwargs):
+        if self.cache is None or self.cache.max_entries <= 0:
+            return method(self, mapper, *args, **kwargs)
+
+        self.cache.validate(self.data_version)
+        key = (method.__name__, mapper.__tablename__, _freeze(args), _freeze(kwargs))
+        found, value = self.cache.get(key)
+        if not found:
+            value = method(self, mapper, *args, **kwargs)
+            self.cache.put(key, value)
+        return _copy_result(value)
+
+    return wrapper
 
-sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
 
 class DataRetreivalControllerCOT:
 
-    def __init__(self):
+    def __init__(self, cache=True):
         """
-        Initializes the database session
+        Initializes the database session factory, bound to the process-wide connection pool
+
+        Args:
+            cache: Serve repeated queries from the process-wide read cache (default is True)
         """
         self.session = db_cot()
+        self.engine = db_cot(get_engine_only=True)
+        self.cache = _READ_CACHE if cache else None
+
+    def data_version(self):
+        """
+        Returns the version of the COT data, moved forward by the ingest after every load
+        """
+        try:
+            return get_data_version(engine=self.engine)
+        except SQLAlchemyError:
+            # schema not migrated yet, the cache then only expires on its time to live
+            return None
+
+    def build_query(self, mapper, market_codes=None, report_type=None, start=None, end=None, columns=None,
+                    limit=None, latest_first=False):
+        """
+        Builds the SELECT statement behind `query_frame`, filtered and ordered along the
+        (Market_Code, Report_Type, Date) index of the table
+
+        Args:
+            mapper: The mapper to query from, e.g. DisaggregatedFuturesOptions
+            market_codes: A market code or a list of market codes (optional, all markets by default)
+            report_type: A report type or a list of report types, e.g. "disaggregated_futopt" (optional)
+            start: First report date to return, inclusive (optional)
+            end: Last report date to return, inclusive (optional)
+            columns: The column names to return (optional, all columns by default)
+            limit: The maximum number of rows to return (optional)
+            latest_first: Return the latest report dates of each market first (default is False)
+
+        Returns:
+            A SQLAlchemy Select
+        """
+        table = mapper.__table__
+        if columns:
+            unknown = [c for c in columns if c not in table.c]
+            if unknown:
+                raise ValueError("Unknown columns {} for table {}".format(unknown, table.name))
+            stmt = select(*[table.c[c] for c in columns])
+        else:
+            stmt = select(table)
+
+        if market_codes is not None:
+            market_codes = [market_codes] if isinstance(market_codes, str) else list(market_codes)
+            stmt = stmt.where(table.c.Market_Code.in_(market_codes))
+        if report_type is not None:
+            report_type = [report_type] if isinstance(report_type, str) else list(report_type)
+            stmt = stmt.where(table.c.Report_Type.in_(report_type))
+        if start is not None:
+            stmt = stmt.where(table.c.Date >= pd.Timestamp(start).date())
+        if end is not None:
+            stmt = stmt.where(table.c.Date <= pd.Timestamp(end).date())
+
+        date_order = table.c.Date.desc() if latest_first else table.c.Date
+        stmt = stmt.order_by(table.c.Market_Code, table.c.Report_Type, date_order)
+        if limit is not None:
+            stmt = stmt.limit(limit)
+        return stmt
+
+    @cached
+    def query_frame(self, mapper, market_codes=None, report_type=None, start=None, end=None, columns=None,
+                    limit=None, latest_first=False):
+        """
+        Queries data from the database into a DataFrame, built straight from the result rows
+        without creating mapper objects. Takes the arguments of `build_query`
+
+        Returns:
+            A pandas DataFrame with one column per selected column, "Date" as datetime64
+        """
+        stmt = self.build_query(mapper, market_codes, report_type, start, end, columns, limit, latest_first)
+        with self.engine.connect() as conn:
+            result = conn.execute(stmt)
+            df = pd.DataFrame(result.fetchall(), columns=list(result.keys()))
+
+        if "Date" in df.columns:
+            df["Date"] = pd.to_datetime(df["Date"])
+        return df
+
+    def arrow_schema(self, mapper, columns=None):
+        """
+        Returns the Arrow schema of the given columns of a mapper (all columns by default). Numeric columns with
+        a precision keep it as decimals, the others are float64 as in the parquet store
+        """
+        table = mapper.__table__
+        fields = []
+        for column in (table.c[c] for c in columns) if columns else table.columns:
+            if isinstance(column.type, Integer):
+                arrow_type = pa.int64()
+            elif isinstance(column.type, Float):
+                arrow_type = pa.float64()
+            elif isinstance(column.type, Numeric):
+                precision, scale = column.type.precision, column.type.scale or 0
+                if column.type.asdecimal and precision:
+                    arrow_type = (pa.decimal128 if precision <= 38 else pa.decimal256)(precision, scale)
+                else:
+                    arrow_type = pa.float64()
+            elif isinstance(column.type, DateTime):
+                arrow_type = pa.timestamp("us")
+            elif isinstance(column.type, Date):
+                arrow_type = pa.date32()
+            else:
+                arrow_type = pa.string()
+            fields.append(pa.field(column.name, arrow_type))
+        return pa.schema(fields)
+
+    def iter_frames(self, mapper, chunk_size=50000, arrow=False, **filters):
+        """
+        Streams the result of a query in chunks through a server-side cursor, so that reads over the
+        whole history of every market run in bounded memory. Takes the filters of `build_query`
+
+        Args:
+            mapper: The mapper to query from
+            chunk_size: The number of rows per chunk (default is 50000)
+            arrow: Yield Arrow record batches instead of DataFrames (default is False)
+
+        Yields:
+            A pandas DataFrame, or a pyarrow RecordBatch typed like the table columns, per chunk
+        """
+        stmt = self.build_query(mapper, **filters)
+        schema = self.arrow_schema(mapper, filters.get("columns")) if arrow else None
+
+        with self.engine.connect() as conn:
+            result = conn.execution_options(stream_results=True, yield_per=chunk_size).execute(stmt)
+            columns = list(result.keys())
+            for rows in result.partitions():
+                df = pd.DataFrame(rows, columns=columns)
+                if arrow:
+                    # unbounded Numeric columns come back as Decimal objects, which Arrow does not cast to float64
+                    floats = {f.name: df[f.name].astype("float64") for f in schema
+                              if f.type == pa.float64() and df[f.name].dtype == object}
+                    yield pa.RecordBatch.from_pandas(df.assign(**floats), schema=schema, preserve_index=False)
+                else:
+                    if "Date" in df.columns:
+                        df["Date"] = pd.to_datetime(df["Date"])
+                    yield df
 
+    def export_parquet(self, mapper, path, chunk_size=50000, **filters):
+        """
+        Writes the result of a query to a parquet file one chunk at a time. Takes the filters of `build_query`
+
+        Returns:
+            The number of rows written
+        """
+        written = 0
+        with pq.ParquetWriter(path, self.arrow_schema(mapper, filters.get("columns"))) as writer:
+            for batch in self.iter_frames(mapper, chunk_size=chunk_size, arrow=True, **filters):
+                writer.write_batch(batch)
+                written += batch.num_rows
+        return written
+
+    @cached
     def query_data(self, mapper, parameter_val=None, parameter="id"):
         """
         Queries data from the database using the given mapper and parameter(s)
@@ -38,16 +309,18 @@ class DataRetreivalControllerCOT:
             return res
 
         elif parameter_val is None:
+            # the whole table as objects, see iter_frames to read it in chunks
             q_res = session.query(mapper).all()
             res = [q.toDict() for q in q_res]
             return res
 
         else:
-            print("enter valid par_value str and list is valid type ")
+            logger.warning("enter valid par_value str and list is valid type ")
 
 
     
 
+    @cached
     def get_latest_series(self, mapper, parameter_val=None, parameter="id"):
         """
         Retrieves the latest series from the database.
@@ -61,29 +334,66 @@ class DataRetreivalControllerCOT:
             The latest series as a dictionary.
         """
 
+        # the latest row for a market code or report type filter is always in the latest report table
+        latest = LATEST_TABLES.get(mapper.__tablename__)
+        if latest is not None and (parameter_val is None or (parameter in latest.primary_key.columns and type(parameter_val) in (str, list))):
+            stmt = select(latest).order_by(latest.c.Date.desc()).limit(1)
+            if type(parameter_val) == str:
+                stmt = stmt.where(latest.c[parameter] == parameter_val)
+            elif type(parameter_val) == list:
+                stmt = stmt.where(latest.c[parameter].in_(parameter_val))
+            with self.engine.connect() as conn:
+                row = conn.execute(stmt).first()
+            return dict(row._mapping) if row is not None else None
+
         session = self.session()
 
         if type(parameter_val) == str:
-            q_res = session.query(mapper).filter(getattr(mapper, parameter) == parameter_val).order_by(mapper.date.desc()).first()
+            q_res = session.query(mapper).filter(getattr(mapper, parameter) == parameter_val).order_by(mapper.Date.desc()).first()
             res = q_res.toDict()
             return res
 
         elif type(parameter_val) == list:
             prm = getattr(mapper, parameter)
-            q_res = session.query(mapper).filter(prm.in_(parameter_val)).order_by(mapper.date.desc()).first()
+            q_res = session.query(mapper).filter(prm.in_(parameter_val)).order_by(mapper.Date.desc()).first()
             res = q_res.toDict()
             return res
 
         elif parameter_val is None:
-            q_res = session.query(mapper).order_by(mapper.date.desc()).first()
+            q_res = session.query(mapper).order_by(mapper.Date.desc()).first()
             res = q_res.toDict()
             return res
 
         else:
-            print("Enter valid parameter_val; str and list are valid types.")
+            logger.warning("Enter valid parameter_val; str and list are valid types.")
 
-    
-            
+    @cached
+    def get_latest_rows(self, mapper, market_codes, report_type=None, columns=None):
+        """
+        Retrieves the latest report of several markets in a single query on the latest report table
 
-    
-            
\ No newline at end of file
+        Args:
+            mapper: The mapper whose latest reports to return, e.g. DisaggregatedFuturesOptions
+            market_codes: A market code or a list of market codes
+            report_type: A report type or a list of report types (optional, all by default)
+            columns: The column names to return (optional, all columns by default)
+
+        Returns:
+            A pandas DataFrame with one row per (Market_Code, Report_Type) found
+        """
+        latest = LATEST_TABLES[mapper.__tablename__]
+        stmt = select(*[latest.c[c] for c in columns]) if columns else select(latest)
+
+        market_codes = [market_codes] if isinstance(market_codes, str) else list(market_codes)
+        stmt = stmt.where(latest.c.Market_Code.in_(market_codes))
+        if report_type is not None:
+            report_type = [report_type] if isinstance(report_type, str) else list(report_type)
+            stmt = stmt.where(latest.c.Report_Type.in_(report_type))
+
+        with self.engine.connect() as conn:
+            result = conn.execute(stmt.order_by(latest.c.Market_Code, latest.c.Report_Type))
+            df = pd.DataFrame(result.fetchall(), columns=list(result.keys()))
+
+        if "Date" in df.columns:
+            df["Date"] = pd.to_datetime(df["Date"])
+        return df
@@ -1,30 +1,113 @@
 import os
+import logging
+import threading
+from contextlib import contextmanager
 from dotenv import load_dotenv
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import sessionmaker
 
 #load the env variables
 load_dotenv()
 
+logger = logging.getLogger(__name__)
 
 
-def connect_to_database(get_engine_only=False):
+# engines and session factories are created once per database url and shared by the whole process
+_ENGINES = {}
+_SESSION_FACTORIES = {}
+_LOCK = threading.Lock()
+
+
+def _env_bool(name, default):
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes")
+
+
+def engine_options(url):
+    """
+    Returns the create_engine keyword arguments for a database url, with the pool settings taken from env:
+    DB_POOL_SIZE (5), DB_MAX_OVERFLOW (10), DB_POOL_TIMEOUT (30), DB_POOL_RECYCLE (1800 seconds) and DB_POOL_PRE_PING (true).
+    """
+    options = {
+        "echo": False,
+        "pool_pre_ping": _env_bool("DB_POOL_PRE_PING", True),
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", 1800)),
+    }
+
+    if url.get_backend_name() == "postgresql":
+        options["pool_size"] = int(os.getenv("DB_POOL_SIZE", 5))
+        options["max_overflow"] = int(os.getenv("DB_MAX_OVERFLOW", 10))
+        options["pool_timeout"] = int(os.getenv("DB_POOL_TIMEOUT", 30))
+        if os.getenv("POSTGRES_SCHEMA_COT"):
+            options["connect_args"] = {"options": "-csearch_path={}".format(os.environ["POSTGRES_SCHEMA_COT"])}
+
+    return options
+
+
+def get_engine(db_url=None):
+    """
+    Returns the pooled engine for `db_url` (DB_URL_COT by default), creating it on first use.
+    """
+    db_url = db_url or os.environ["DB_URL_COT"]
+
+    with _LOCK:
+        if db_url not in _ENGINES:
+            url = make_url(db_url)
+            logger.info("Creating database engine for {}".format(url.render_as_string(hide_password=True)))
+            _ENGINES[db_url] = create_engine(url, **engine_options(url))
+        return _ENGINES[db_url]
+
+
+def get_session_factory(db_url=None):
+    """
+    Returns the sessionmaker bound to the pooled engine for `db_url` (DB_URL_COT by default).
+    """
+    engine = get_engine(db_url)
+
+    with _LOCK:
+        if engine not in _SESSION_FACTORIES:
+            _SESSION_FACTORIES[engine] = sessionmaker(engine, expire_on_commit=False)
+        return _SESSION_FACTORIES[engine]
+
+
+@contextmanager
+def session_scope(db_url=None):
+    """
+    Context manager handing out a session from the shared pool: commits on success, rolls back on error
+    and always returns the connection to the pool.
+    """
+    ssn = get_session_factory(db_url)()
     try:
-        print("Connecting to database...")
-        print(os.environ["DB_URL_COT"])
-        
-        engine=create_engine(str(os.environ["DB_URL_COT"]),echo=False,connect_args={"options":"-csearch_path={}".format(os.environ["POSTGRES_SCHEMA_COT"])})
+        yield ssn
+        ssn.commit()
+    except Exception:
+        ssn.rollback()
+        raise
+    finally:
+        ssn.close()
 
-        if get_engine_only:
-            return engine
-        
-        session=sessionmaker(engine,expire_on_commit=False)
-        print("Connection Established!")
-        return session
 
-    except Exception as e:
-   
-        raise ConnectionError("There is some error connecting to data base")
+def dispose_engines():
+    """
+    Closes every pooled connection, e.g. at the end of a run or in a freshly forked worker process.
+    """
+    with _LOCK:
+        for engine in _ENGINES.values():
+            engine.dispose()
+        _ENGINES.clear()
+        _SESSION_FACTORIES.clear()
 
 
+def connect_to_database(get_engine_only=False):
+    try:
+        if get_engine_only:
+            return get_engine()
+
+        return get_session_factory()
+
+    except Exception as e:
 
+        raise ConnectionError("There is some error connecting to data base") from e
@@ -1,5 +1,9 @@
 from backend.db.dbconnect import connect_to_database
 from backend.db.models import  Base
+from backend.db.migrations import upgrade
+import logging
+
+logger=logging.getLogger(__name__)
 
 
 #funciton to migrate the code
@@ -7,26 +11,26 @@ def migrate_models():
     engine=connect_to_database(get_engine_only=True)
 
     try:
-        Base.metadata.create_all(engine)
-        print("migrations completed")
+        version=upgrade(engine)
+        logger.info("migrations completed, schema version {}".format(version))
 
     except Exception as e:
         raise e
 
 
 
-#funciton to migrate the code
+#funciton to drop every table, the data has to be reloaded from scratch afterwards
+#prefer migrations.rebuild_tables for a full reload, readers never see empty tables with it
 def clean_db():
     engine=connect_to_database(get_engine_only=True)
 
     try:
         Base.metadata.drop_all(engine)
-        print("database cleaned completed")
+        logger.info("database cleaned completed")
 
     except Exception as e:
         raise e
 
 
-# clean_db()
-
-# migrate_models()
\ No newline at end of file
+if __name__ == "__main__":
+    migrate_models()
@@ -0,0 +1,358 @@
+import logging
+from contextlib import contextmanager
+from datetime import date
+
+from sqlalchemy import Integer, MetaData, Numeric, BigInteger, Table, case, cast, delete, func, inspect, select, text
+
+from backend.db.dbconnect import get_engine
+from backend.db.models import (Base, DataVersion, DisaggregatedFuturesOptions, LATEST_TABLES, Legacy, Metric,
+                               PositionFact, PositioningAnalytics, RevisionLog, SchemaVersion)
+from backend.db.partitions import create_partitions, partitioned_in_database
+from backend.db.snapshots import rebuild_latest
+from backend.db.upsert import redirect_loads
+
+logger = logging.getLogger(__name__)
+
+
+def _qualified(conn, name, schema=None):
+    preparer = conn.dialect.identifier_preparer
+    if schema:
+        return "{}.{}".format(preparer.quote_schema(schema), preparer.quote(name))
+    return preparer.quote(name)
+
+
+def shadow_table(table, suffix):
+    """
+    Returns a copy of `table` (columns, keys and indexes) named `<table name><suffix>` in the same schema.
+    Index names starting with the table name are renamed the same way, as they must be unique per schema.
+    """
+    shadow = table.to_metadata(MetaData(), name=table.name + suffix)
+    for index in shadow.indexes:
+        if index.name and index.name.startswith(table.name):
+            index.name = shadow.name + index.name[len(table.name):]
+    return shadow
+
+
+def _rename_indexes(conn, table_name, old_prefix, new_prefix, schema=None):
+    # index names are unique per schema, so they follow the table they belong to
+    quote = conn.dialect.identifier_preparer.quote
+    if conn.dialect.name == "postgresql":
+        rows = conn.execute(text("SELECT indexname FROM pg_indexes WHERE tablename = :t AND schemaname = COALESCE(:s, current_schema())"),
+                            {"t": table_name, "s": schema}).fetchall()
+        for (index_name,) in rows:
+            if index_name.startswith(old_prefix):
+                conn.execute(text("ALTER INDEX {} RENAME TO {}".format(
+                    _qualified(conn, index_name, schema), quote(new_prefix + index_name[len(old_prefix):]))))
+
+    elif conn.dialect.name == "sqlite":
+        # sqlite cannot rename an index, it is recreated from its definition under the new name
+        rows = conn.execute(text("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = :t AND sql IS NOT NULL"),
+                            {"t": table_name}).fetchall()
+        for index_name, sql in rows:
+            if index_name.startswith(old_prefix):
+                conn.execute(text("DROP INDEX {}".format(quote(index_name))))
+                conn.execute(text(sql.replace(index_name, new_prefix + index_name[len(old_prefix):], 1)))
+
+
+def _rename_partitions(conn, table_name, old_prefix, new_prefix, schema=None):
+    # partitions are named after their table (see backend/db/partitions.py) and follow it like its indexes
+    if conn.dialect.name != "postgresql":
+        return
+    quote = conn.dialect.identifier_preparer.quote
+    rows = conn.execute(text("WITH RECURSIVE parts(oid) AS (SELECT inhrelid FROM pg_inherits WHERE inhparent = to_regclass(:t) "
+                             "UNION ALL SELECT i.inhrelid FROM pg_inherits i JOIN parts p ON i.inhparent = p.oid) "
+                             "SELECT c.relname FROM parts p JOIN pg_class c ON c.oid = p.oid"),
+                        {"t": _qualified(conn, table_name, schema)}).fetchall()
+    for (name,) in rows:
+        if name.startswith(old_prefix):
+            new_name = new_prefix + name[len(old_prefix):]
+            conn.execute(text("ALTER TABLE {} RENAME TO {}".format(_qualified(conn, name, schema), quote(new_name))))
+            _rename_indexes(conn, new_name, old_prefix, new_prefix, schema)
+
+
+def swap_tables(conn, table, shadow, old_suffix="__old", drop_old=False):
+    """
+    Replaces `table` with `shadow` by renaming both inside the caller's transaction, so readers see either the
+    old or the new table and never an empty one. The replaced table is kept as `<name><old_suffix>` (replacing
+    any previous one) unless `drop_old` is set.
+    """
+    schema = table.schema
+    old_name = table.name + old_suffix
+    conn.execute(text("DROP TABLE IF EXISTS {}".format(_qualified(conn, old_name, schema))))
+
+    conn.execute(text("ALTER TABLE {} RENAME TO {}".format(_qualified(conn, table.name, schema), conn.dialect.identifier_preparer.quote(old_name))))
+    _rename_indexes(conn, old_name, table.name, old_name, schema)
+    _rename_partitions(conn, old_name, table.name, old_name, schema)
+
+    conn.execute(text("ALTER TABLE {} RENAME TO {}".format(_qualified(conn, shadow.name, schema), conn.dialect.identifier_preparer.quote(table.name))))
+    _rename_indexes(conn, table.name, shadow.name, table.name, schema)
+    _rename_partitions(conn, table.name, shadow.name, table.name, schema)
+
+    if drop_old:
+        conn.execute(text("DROP TABLE {}".format(_qualified(conn, old_name, schema))))
+
+
+def numeric_cast(column, to_type):
+    """
+    Casts a text column to a numeric type, mapping the CFTC '.' placeholder, blanks and anything else that is
+    not a number to NULL. Values written as floats ("250.0") are accepted.
+    """
+    trimmed = func.trim(column)
+    return case((trimmed.regexp_match(r"^-?[0-9]+(\.[0-9]*)?$"), cast(cast(trimmed, Numeric), to_type)), else_=None)
+
+
+def copy_by_year(engine, source, target, columns, exprs, finish):
+    """
+    Copies the rows of `source` into `target` one year at a time, each year in its own transaction so the copy
+    can be interrupted and run again. The latest year is copied once more inside the transaction that runs
+    `finish(conn)`, e.g. swapping `target` in, which keeps rows loaded in the meantime.
+
+    Args:
+        columns (list): Columns of `target` to fill.
+        exprs (list): Expressions over `source` selected into `columns`.
+    """
+    def copy_year(conn, year):
+        start, end = date(year, 1, 1), date(year + 1, 1, 1)
+        conn.execute(delete(target).where(target.c.Date >= start, target.c.Date < end))
+        conn.execute(target.insert().from_select(columns, select(*exprs).where(source.c.Date >= start, source.c.Date < end)))
+
+    with engine.connect() as conn:
+        first, last = conn.execute(select(func.min(source.c.Date), func.max(source.c.Date))).one()
+
+    if first is not None:
+        first, last = [d if isinstance(d, date) else date.fromisoformat(str(d)[:10]) for d in (first, last)]
+        for year in range(first.year, last.year):
+            with engine.begin() as conn:
+                copy_year(conn, year)
+            logger.info("copied {} rows of {}".format(source.name, year))
+
+    with engine.begin() as conn:
+        if first is not None:
+            copy_year(conn, last.year)
+        finish(conn)
+
+
+def backfill_numeric(mapper, engine=None, drop_old=False):
+    """
+    Converts the text columns of an existing table to the numeric types declared on `mapper`, one year at a time.
+
+    The rows are copied year by year into a typed shadow table, each year in its own transaction so the
+    tool can be interrupted and run again. The latest year is copied once more inside the transaction that
+    swaps the shadow table in, which keeps rows loaded in the meantime. The text table is kept as
+    `<name>__text` unless `drop_old` is set.
+
+    Args:
+        mapper (class): DisaggregatedFuturesOptions or Legacy.
+        engine (Engine, optional): Defaults to the COT database engine.
+        drop_old (bool, optional): Drop the text table once the typed one is in place. Defaults to False.
+    """
+    engine = engine or get_engine()
+    table = mapper.__table__
+    insp = inspect(engine)
+    if not insp.has_table(table.name, schema=table.schema):
+        return
+
+    existing = {c["name"]: c["type"] for c in insp.get_columns(table.name, schema=table.schema)}
+    to_convert = [c.name for c in table.columns
+                  if c.name in existing and isinstance(c.type, Integer) and not isinstance(existing[c.name], Integer)]
+    if not to_convert:
+        logger.info("{} already has numeric columns".format(table.name))
+        return
+
+    source = Table(table.name, MetaData(), schema=table.schema, autoload_with=engine)
+    typed = shadow_table(table, "__typed")
+    with engine.begin() as conn:
+        typed.create(conn, checkfirst=True)
+        create_partitions(conn, typed)
+
+    columns = [c.name for c in table.columns if c.name in source.c]
+    exprs = [numeric_cast(source.c[name], table.c[name].type) if name in to_convert else source.c[name] for name in columns]
+
+    copy_by_year(engine, source, typed, columns, exprs,
+                 lambda conn: swap_tables(conn, table, typed, old_suffix="__text", drop_old=drop_old))
+    logger.info("{} now uses numeric columns".format(table.name))
+
+
+@contextmanager
+def rebuild_tables(mappers=(DisaggregatedFuturesOptions, Legacy), engine=None, keep_old=False):
+    """
+    Context manager for an explicit full rebuild of the COT tables.
+
+    Empty shadow tables are created next to the live ones and every load of the given mappers is redirected
+    to them while the block runs. When it completes, all shadow tables are swapped in within a single
+    transaction, so readers keep seeing the previous data until the new data replaces it. If the block
+    fails, the shadow tables are dropped and the live tables are left untouched.
+
+    Args:
+        mappers (tuple, optional): Mapper classes to rebuild. Defaults to DisaggregatedFuturesOptions and Legacy.
+        engine (Engine, optional): Defaults to the COT database engine.
+        keep_old (bool, optional): Keep the replaced tables as `<name>__old`. Defaults to False.
+    """
+    engine = engine or get_engine()
+    shadows = []
+    for mapper in mappers:
+        table = mapper.__table__
+        shadow = shadow_table(table, "__shadow")
+        # left over by an interrupted rebuild
+        shadow.drop(engine, checkfirst=True)
+        with engine.begin() as conn:
+            shadow.create(conn)
+            create_partitions(conn, shadow)
+        shadows.append((table, shadow))
+
+    try:
+        for table, shadow in shadows:
+            redirect_loads(table, shadow)
+        yield
+
+    except Exception:
+        for _, shadow in shadows:
+            shadow.drop(engine, checkfirst=True)
+        raise
+
+    finally:
+        for table, _ in shadows:
+            redirect_loads(table, None)
+
+    with engine.begin() as conn:
+        for table, shadow in shadows:
+            swap_tables(conn, table, shadow, old_suffix="__old", drop_old=not keep_old)
+    logger.info("rebuilt {}".format(", ".join(table.name for table, _ in shadows)))
+
+
+def _baseline(engine):
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspect(conn).has_table(table.name, schema=table.schema):
+                table.create(conn)
+                create_partitions(conn, table)
+
+
+def _numeric_columns(engine):
+    for mapper in (DisaggregatedFuturesOptions, Legacy):
+        backfill_numeric(mapper, engine)
+
+
+def _market_indexes(engine):
+    for mapper in (DisaggregatedFuturesOptions, Legacy):
+        for index in mapper.__table__.indexes:
+            index.create(engine, checkfirst=True)
+
+
+def _latest_tables(engine):
+    for mapper in (DisaggregatedFuturesOptions, Legacy):
+        rebuild_latest(mapper, engine)
+
+
+def _data_version(engine):
+    DataVersion.__table__.create(engine, checkfirst=True)
+
+
+def _positioning_analytics(engine):
+    # filled by the next pipeline run
+    PositioningAnalytics.__table__.create(engine, checkfirst=True)
+
+
+def _partitioned_tables(engine):
+    # PostgreSQL only: the rows are copied into a partitioned copy of each table, which then replaces it
+    if engine.dialect.name != "postgresql":
+        return
+    for mapper in (DisaggregatedFuturesOptions, Legacy):
+        table = mapper.__table__
+        with engine.connect() as conn:
+            if partitioned_in_database(conn, table):
+                continue
+
+        source = Table(table.name, MetaData(), schema=table.schema, autoload_with=engine)
+        partitioned = shadow_table(table, "__partitioned")
+        partitioned.drop(engine, checkfirst=True)
+        with engine.begin() as conn:
+            partitioned.create(conn)
+            create_partitions(conn, partitioned)
+
+        columns = [c.name for c in table.columns if c.name in source.c]
+        copy_by_year(engine, source, partitioned, columns, [source.c[name] for name in columns],
+                     lambda conn: swap_tables(conn, table, partitioned, old_suffix="__unpartitioned"))
+        logger.info("{} is now partitioned by report type and year".format(table.name))
+
+
+def _row_hashes(engine):
+    # the hashes of the rows stored before are left empty, these rows are rewritten the next time they are read
+    for mapper in (DisaggregatedFuturesOptions, Legacy):
+        for table in (mapper.__table__, LATEST_TABLES[mapper.__tablename__]):
+            with engine.begin() as conn:
+                if "Row_Hash" in {c["name"] for c in inspect(conn).get_columns(table.name, schema=table.schema)}:
+                    continue
+                conn.execute(text("ALTER TABLE {} ADD COLUMN {} {}".format(
+                    _qualified(conn, table.name, table.schema), conn.dialect.identifier_preparer.quote("Row_Hash"),
+                    table.c.Row_Hash.type.compile(dialect=conn.dialect))))
+    RevisionLog.__table__.create(engine, checkfirst=True)
+
+
+def _position_facts(engine):
+    # imported here, the backend does not otherwise depend on the top-level ingest modules
+    from facts import backfill_facts, sync_metrics
+
+    Metric.__table__.create(engine, checkfirst=True)
+    PositionFact.__table__.create(engine, checkfirst=True)
+    sync_metrics(engine)
+    for mapper in (DisaggregatedFuturesOptions, Legacy):
+        backfill_facts(mapper, engine)
+
+
+# (version, description, migration) in the order they are applied. A migration must leave tables that are
+# already up to date untouched, since a fresh database is created straight from the models.
+MIGRATIONS = [
+    (1, "baseline COT tables", _baseline),
+    (2, "numeric position, open interest, change and trader count columns", _numeric_columns),
+    (3, "(Market_Code, Report_Type, Date) indexes", _market_indexes),
+    (4, "latest report per (Market_Code, Report_Type) tables", _latest_tables),
+    (5, "data version counter", _data_version),
+    (6, "positioning analytics table", _positioning_analytics),
+    (7, "COT tables partitioned by report type and year", _partitioned_tables),
+    (8, "row hashes and revision log", _row_hashes),
+    (9, "long format position facts and metric dimension", _position_facts),
+]
+
+
+def current_version(engine=None):
+    """
+    Returns the schema version recorded in the database, 0 if none was recorded.
+    """
+    engine = engine or get_engine()
+    if not inspect(engine).has_table(SchemaVersion.__tablename__, schema=SchemaVersion.__table__.schema):
+        return 0
+    with engine.connect() as conn:
+        return conn.execute(select(func.max(SchemaVersion.Version))).scalar() or 0
+
+
+def _stamp(engine, version, description):
+    with engine.begin() as conn:
+        conn.execute(SchemaVersion.__table__.insert().values(Version=version, Description=description))
+
+
+def upgrade(engine=None, target=None):
+    """
+    Brings the database schema up to `target` (the latest version by default), applying the pending
+    migrations in order and recording each one in the schema_version table.
+
+    A database without the COT tables is created straight from the models and stamped with the latest version.
+    """
+    engine = engine or get_engine()
+    version = current_version(engine)
+    insp = inspect(engine)
+    fresh = not any(insp.has_table(m.__tablename__, schema=m.__table__.schema) for m in (DisaggregatedFuturesOptions, Legacy))
+
+    SchemaVersion.__table__.create(engine, checkfirst=True)
+
+    for number, description, migrate in MIGRATIONS:
+        if number <= version or (target is not None and number > target):
+            continue
+        if fresh:
+            _baseline(engine)
+        else:
+            logger.info("applying schema migration {}: {}".format(number, description))
+            migrate(engine)
+        _stamp(engine, number, description)
+
+    return current_version(engine)
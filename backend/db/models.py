@@ -1,11 +1,11 @@
 
-from sqlalchemy import String, String,DATETIME,Column, Float,Date,String
-from sqlalchemy import ForeignKey,UniqueConstraint
+from sqlalchemy import String, String,DATETIME,DateTime,Column, Float,Date,String,BigInteger,Integer
+from sqlalchemy import ForeignKey,UniqueConstraint,Index
 from sqlalchemy import String
 from sqlalchemy import String
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import relationship
-from sqlalchemy import inspect,MetaData
+from sqlalchemy import inspect,MetaData,Table
 from sqlalchemy.sql import func
 import os
 
@@ -21,75 +21,75 @@ class DisaggregatedFuturesOptions(Base):
     __tablename__="disaggregated_futures_options"
 
     Date=Column(Date,primary_key=True)
-    Open_Interest_All=Column(String)
+    Open_Interest_All=Column(BigInteger)
     Market_and_Exchange_Names=Column(String)
     CFTC_Contract_Market_Code=Column(String)
     CFTC_Market_Code=Column(String)
     CFTC_Region_Code=Column(String)
     CFTC_Commodity_Code=Column(String)
-    Prod_Merc_Positions_Long_All=Column(String)
-    Prod_Merc_Positions_Short_All=Column(String)
-    Swap_Positions_Long_All=Column(String)
-    Swap__Positions_Short_All=Column(String)
-    Swap__Positions_Spread_All=Column(String)
-    M_Money_Positions_Long_All=Column(String)
-    M_Money_Positions_Short_All=Column(String)
-    M_Money_Positions_Spread_All=Column(String)
-    Other_Rept_Positions_Long_All=Column(String)
-    Other_Rept_Positions_Short_All=Column(String)
-    Other_Rept_Positions_Spread_All=Column(String)
-    Tot_Rept_Positions_Long_All=Column(String)
-    Tot_Rept_Positions_Short_All=Column(String)
-    NonRept_Positions_Long_All=Column(String)
-    NonRept_Positions_Short_All=Column(String)
-    Open_Interest_Old=Column(String)
-    Prod_Merc_Positions_Long_Old=Column(String)
-    Prod_Merc_Positions_Short_Old=Column(String)
-    Swap_Positions_Long_Old=Column(String)
-    Swap__Positions_Short_Old=Column(String)
-    Swap__Positions_Spread_Old=Column(String)
-    M_Money_Positions_Long_Old=Column(String)
-    M_Money_Positions_Short_Old=Column(String)
-    M_Money_Positions_Spread_Old=Column(String)
-    Other_Rept_Positions_Long_Old=Column(String)
-    Other_Rept_Positions_Short_Old=Column(String)
-    Other_Rept_Positions_Spread_Old=Column(String)
-    Tot_Rept_Positions_Long_Old=Column(String)
-    Tot_Rept_Positions_Short_Old=Column(String)
-    NonRept_Positions_Long_Old=Column(String)
-    NonRept_Positions_Short_Old=Column(String)
-    Open_Interest_Other=Column(String)
-    Prod_Merc_Positions_Long_Other=Column(String)
-    Prod_Merc_Positions_Short_Other=Column(String)
-    Swap_Positions_Long_Other=Column(String)
-    Swap__Positions_Short_Other=Column(String)
-    Swap__Positions_Spread_Other=Column(String)
-    M_Money_Positions_Long_Other=Column(String)
-    M_Money_Positions_Short_Other=Column(String)
-    M_Money_Positions_Spread_Other=Column(String)
-    Other_Rept_Positions_Long_Other=Column(String)
-    Other_Rept_Positions_Short_Other=Column(String)
-    Other_Rept_Positions_Spread_Other=Column(String)
-    Tot_Rept_Positions_Long_Other=Column(String)
-    Tot_Rept_Positions_Short_Other=Column(String)
-    NonRept_Positions_Long_Other=Column(String)
-    NonRept_Positions_Short_Other=Column(String)
-    Change_in_Open_Interest_All=Column(String)
-    Change_in_Prod_Merc_Long_All=Column(String)
-    Change_in_Prod_Merc_Short_All=Column(String)
-    Change_in_Swap_Long_All=Column(String)
-    Change_in_Swap_Short_All=Column(String)
-    Change_in_Swap_Spread_All=Column(String)
-    Change_in_M_Money_Long_All=Column(String)
-    Change_in_M_Money_Short_All=Column(String)
-    Change_in_M_Money_Spread_All=Column(String)
-    Change_in_Other_Rept_Long_All=Column(String)
-    Change_in_Other_Rept_Short_All=Column(String)
-    Change_in_Other_Rept_Spread_All=Column(String)
-    Change_in_Tot_Rept_Long_All=Column(String)
-    Change_in_Tot_Rept_Short_All=Column(String)
-    Change_in_NonRept_Long_All=Column(String)
-    Change_in_NonRept_Short_All=Column(String)
+    Prod_Merc_Positions_Long_All=Column(BigInteger)
+    Prod_Merc_Positions_Short_All=Column(BigInteger)
+    Swap_Positions_Long_All=Column(BigInteger)
+    Swap__Positions_Short_All=Column(BigInteger)
+    Swap__Positions_Spread_All=Column(BigInteger)
+    M_Money_Positions_Long_All=Column(BigInteger)
+    M_Money_Positions_Short_All=Column(BigInteger)
+    M_Money_Positions_Spread_All=Column(BigInteger)
+    Other_Rept_Positions_Long_All=Column(BigInteger)
+    Other_Rept_Positions_Short_All=Column(BigInteger)
+    Other_Rept_Positions_Spread_All=Column(BigInteger)
+    Tot_Rept_Positions_Long_All=Column(BigInteger)
+    Tot_Rept_Positions_Short_All=Column(BigInteger)
+    NonRept_Positions_Long_All=Column(BigInteger)
+    NonRept_Positions_Short_All=Column(BigInteger)
+    Open_Interest_Old=Column(BigInteger)
+    Prod_Merc_Positions_Long_Old=Column(BigInteger)
+    Prod_Merc_Positions_Short_Old=Column(BigInteger)
+    Swap_Positions_Long_Old=Column(BigInteger)
+    Swap__Positions_Short_Old=Column(BigInteger)
+    Swap__Positions_Spread_Old=Column(BigInteger)
+    M_Money_Positions_Long_Old=Column(BigInteger)
+    M_Money_Positions_Short_Old=Column(BigInteger)
+    M_Money_Positions_Spread_Old=Column(BigInteger)
+    Other_Rept_Positions_Long_Old=Column(BigInteger)
+    Other_Rept_Positions_Short_Old=Column(BigInteger)
+    Other_Rept_Positions_Spread_Old=Column(BigInteger)
+    Tot_Rept_Positions_Long_Old=Column(BigInteger)
+    Tot_Rept_Positions_Short_Old=Column(BigInteger)
+    NonRept_Positions_Long_Old=Column(BigInteger)
+    NonRept_Positions_Short_Old=Column(BigInteger)
+    Open_Interest_Other=Column(BigInteger)
+    Prod_Merc_Positions_Long_Other=Column(BigInteger)
+    Prod_Merc_Positions_Short_Other=Column(BigInteger)
+    Swap_Positions_Long_Other=Column(BigInteger)
+    Swap__Positions_Short_Other=Column(BigInteger)
+    Swap__Positions_Spread_Other=Column(BigInteger)
+    M_Money_Positions_Long_Other=Column(BigInteger)
+    M_Money_Positions_Short_Other=Column(BigInteger)
+    M_Money_Positions_Spread_Other=Column(BigInteger)
+    Other_Rept_Positions_Long_Other=Column(BigInteger)
+    Other_Rept_Positions_Short_Other=Column(BigInteger)
+    Other_Rept_Positions_Spread_Other=Column(BigInteger)
+    Tot_Rept_Positions_Long_Other=Column(BigInteger)
+    Tot_Rept_Positions_Short_Other=Column(BigInteger)
+    NonRept_Positions_Long_Other=Column(BigInteger)
+    NonRept_Positions_Short_Other=Column(BigInteger)
+    Change_in_Open_Interest_All=Column(BigInteger)
+    Change_in_Prod_Merc_Long_All=Column(BigInteger)
+    Change_in_Prod_Merc_Short_All=Column(BigInteger)
+    Change_in_Swap_Long_All=Column(BigInteger)
+    Change_in_Swap_Short_All=Column(BigInteger)
+    Change_in_Swap_Spread_All=Column(BigInteger)
+    Change_in_M_Money_Long_All=Column(BigInteger)
+    Change_in_M_Money_Short_All=Column(BigInteger)
+    Change_in_M_Money_Spread_All=Column(BigInteger)
+    Change_in_Other_Rept_Long_All=Column(BigInteger)
+    Change_in_Other_Rept_Short_All=Column(BigInteger)
+    Change_in_Other_Rept_Spread_All=Column(BigInteger)
+    Change_in_Tot_Rept_Long_All=Column(BigInteger)
+    Change_in_Tot_Rept_Short_All=Column(BigInteger)
+    Change_in_NonRept_Long_All=Column(BigInteger)
+    Change_in_NonRept_Short_All=Column(BigInteger)
     Pct_of_Open_Interest_All=Column(Float)
     Pct_of_OI_Prod_Merc_Long_All=Column(Float)
     Pct_of_OI_Prod_Merc_Short_All=Column(Float)
@@ -138,30 +138,30 @@ class DisaggregatedFuturesOptions(Base):
     Pct_of_OI_Tot_Rept_Short_Other=Column(Float)
     Pct_of_OI_NonRept_Long_Other=Column(Float)
     Pct_of_OI_NonRept_Short_Other=Column(Float)
-    Traders_Total_All=Column(String)
-    Traders_Noncommercial_Long_All=Column(String)
-    Traders_Noncommercial_Short_All=Column(String)
-    Traders_Noncommercial_Spreading_All=Column(String)
-    Traders_Commercial_Long_All=Column(String)
-    Traders_Commercial_Short_All=Column(String)
-    Traders_Total_Reportable_Long_All=Column(String)
-    Traders_Total_Reportable_Short_All=Column(String)
-    Traders_Total_Old=Column(String)
-    Traders_Noncommercial_Long_Old=Column(String)
-    Traders_Noncommercial_Short_Old=Column(String)
-    Traders_Noncommercial_Spreading_Old=Column(String)
-    Traders_Commercial_Long_Old=Column(String)
-    Traders_Commercial_Short_Old=Column(String)
-    Traders_Total_Reportable_Long_Old=Column(String)
-    Traders_Total_Reportable_Short_Old=Column(String)
-    Traders_Total_Other=Column(String)
-    Traders_Noncommercial_Long_Other=Column(String)
-    Traders_Noncommercial_Short_Other=Column(String)
-    Traders_Noncommercial_Spreading_Other=Column(String)
-    Traders_Commercial_Long_Other=Column(String)
-    Traders_Commercial_Short_Other=Column(String)
-    Traders_Total_Reportable_Long_Other=Column(String)
-    Traders_Total_Reportable_Short_Other=Column(String)
+    Traders_Total_All=Column(BigInteger)
+    Traders_Noncommercial_Long_All=Column(BigInteger)
+    Traders_Noncommercial_Short_All=Column(BigInteger)
+    Traders_Noncommercial_Spreading_All=Column(BigInteger)
+    Traders_Commercial_Long_All=Column(BigInteger)
+    Traders_Commercial_Short_All=Column(BigInteger)
+    Traders_Total_Reportable_Long_All=Column(BigInteger)
+    Traders_Total_Reportable_Short_All=Column(BigInteger)
+    Traders_Total_Old=Column(BigInteger)
+    Traders_Noncommercial_Long_Old=Column(BigInteger)
+    Traders_Noncommercial_Short_Old=Column(BigInteger)
+    Traders_Noncommercial_Spreading_Old=Column(BigInteger)
+    Traders_Commercial_Long_Old=Column(BigInteger)
+    Traders_Commercial_Short_Old=Column(BigInteger)
+    Traders_Total_Reportable_Long_Old=Column(BigInteger)
+    Traders_Total_Reportable_Short_Old=Column(BigInteger)
+    Traders_Total_Other=Column(BigInteger)
+    Traders_Noncommercial_Long_Other=Column(BigInteger)
+    Traders_Noncommercial_Short_Other=Column(BigInteger)
+    Traders_Noncommercial_Spreading_Other=Column(BigInteger)
+    Traders_Commercial_Long_Other=Column(BigInteger)
+    Traders_Commercial_Short_Other=Column(BigInteger)
+    Traders_Total_Reportable_Long_Other=Column(BigInteger)
+    Traders_Total_Reportable_Short_Other=Column(BigInteger)
     Concentration_Gross_LT__4_TDR_Long_All=Column(Float)
     Concentration_Gross_LT_4_TDR_Short_All=Column(Float)
     Concentration_Gross_LT_8_TDR_Long_All=Column(Float)
@@ -192,34 +192,41 @@ class DisaggregatedFuturesOptions(Base):
     CFTC_Commodity_Code_Quotes=Column(String)
     Report_Type=Column(String,primary_key=True)
     Market_Code=Column(String,primary_key=True)
-    Prod_Merc_Positions_Long_All=Column(String)
-    Prod_Merc_Positions_Short_All=Column(String)
-    M_Money_Positions_Long_All=Column(String)
-    M_Money_Positions_Short_All=Column(String)
-    M_Money_Positions_Spread_All=Column(String)
-    Tot_Rept_Positions_Long_All=Column(String)
-    Tot_Rept_Positions_Short_All=Column(String)
-    Change_in_Open_Interest_All=Column(Float)
-    Change_in_Prod_Merc_Long_All=Column(Float)
-    Change_in_Prod_Merc_Short_All=Column(Float)
-    Change_in_M_Money_Long_All=Column(Float)
-    Change_in_M_Money_Short_All=Column(Float)
+    Prod_Merc_Positions_Long_All=Column(BigInteger)
+    Prod_Merc_Positions_Short_All=Column(BigInteger)
+    M_Money_Positions_Long_All=Column(BigInteger)
+    M_Money_Positions_Short_All=Column(BigInteger)
+    M_Money_Positions_Spread_All=Column(BigInteger)
+    Tot_Rept_Positions_Long_All=Column(BigInteger)
+    Tot_Rept_Positions_Short_All=Column(BigInteger)
+    Change_in_Open_Interest_All=Column(BigInteger)
+    Change_in_Prod_Merc_Long_All=Column(BigInteger)
+    Change_in_Prod_Merc_Short_All=Column(BigInteger)
+    Change_in_M_Money_Long_All=Column(BigInteger)
+    Change_in_M_Money_Short_All=Column(BigInteger)
     Pct_of_Open_Interest_All=Column(Float)
     Pct_of_OI_Prod_Merc_Long_All=Column(Float)
     Pct_of_OI_Prod_Merc_Short_All=Column(Float)
     Pct_of_OI_M_Money_Long_All=Column(Float)
     Pct_of_OI_M_Money_Short_All=Column(Float)
     Pct_of_OI_M_Money_Spread_All=Column(Float)
-    Net_Spec_Length=Column(String)
+    Net_Spec_Length=Column(BigInteger)
     Pct_of_OI_MM_NSL=Column(Float)
     Market_Code=Column(String,primary_key=True)
     Report_Type=Column(String,primary_key=True)
+    # hash of the numeric columns, compared on each load to catch revisions (see revisions.py)
+    Row_Hash=Column(BigInteger)
     
 
     def toDict(self):
         return { c.key: getattr(self, c.key) for c in inspect(self).mapper.column_attrs }
 
     # __table_args__ = (UniqueConstraint('name', 'id','period','date',"value","frequency","created_at"),)
+    # index names start with the table name, so shadow tables can rename them (see migrations.shadow_table)
+    # on PostgreSQL the table is partitioned by report type, then by year, see backend/db/partitions.py
+    __table_args__ = (Index("disaggregated_futures_options_market_report_date","Market_Code","Report_Type","Date"),
+                      {"postgresql_partition_by":'LIST ("Report_Type")',
+                       "info":{"report_types":("disaggregated_futopt","disaggregated_fut"),"first_year":2006}})
 
 
 
@@ -232,46 +239,46 @@ class Legacy(Base):
     CFTC_Market_Code_in_Initials=Column(String)
     CFTC_Region_Code=Column(String)
     CFTC_Commodity_Code=Column(String)
-    Open_Interest_All=Column(String)
-    Noncommercial_Positions_Long_All=Column(String)
-    Noncommercial_Positions_Short_All=Column(String)
-    Noncommercial_Positions_Spreading_All=Column(String)
-    Commercial_Positions_Long_All=Column(String)
-    Commercial_Positions_Short_All=Column(String)
-    Total_Reportable_Positions_Long_All=Column(String)
-    Total_Reportable_Positions_Short_All=Column(String)
-    Nonreportable_Positions_Long_All=Column(String)
-    Nonreportable_Positions_Short_All=Column(String)
-    Open_Interest_Old=Column(String)
-    Noncommercial_Positions_Long_Old=Column(String)
-    Noncommercial_Positions_Short_Old=Column(String)
-    Noncommercial_Positions_Spreading_Old=Column(String)
-    Commercial_Positions_Long_Old=Column(String)
-    Commercial_Positions_Short_Old=Column(String)
-    Total_Reportable_Positions_Long_Old=Column(String)
-    Total_Reportable_Positions_Short_Old=Column(String)
-    Nonreportable_Positions_Long_Old=Column(String)
-    Nonreportable_Positions_Short_Old=Column(String)
-    Open_Interest_Other=Column(String)
-    Noncommercial_Positions_Long_Other=Column(String)
-    Noncommercial_Positions_Short_Other=Column(String)
-    Noncommercial_Positions_Spreading_Other=Column(String)
-    Commercial_Positions_Long_Other=Column(String)
-    Commercial_Positions_Short_Other=Column(String)
-    Total_Reportable_Positions_Long_Other=Column(String)
-    Total_Reportable_Positions_Short_Other=Column(String)
-    Nonreportable_Positions_Long_Other=Column(String)
-    Nonreportable_Positions_Short_Other=Column(String)
-    Change_in_Open_Interest_All=Column(String)
-    Change_in_Noncommercial_Long_All=Column(String)
-    Change_in_Noncommercial_Short_All=Column(String)
-    Change_in_Noncommercial_Spreading_All=Column(String)
-    Change_in_Commercial_Long_All=Column(String)
-    Change_in_Commercial_Short_All=Column(String)
-    Change_in_Total_Reportable_Long_All=Column(String)
-    Change_in_Total_Reportable_Short_All=Column(String)
-    Change_in_Nonreportable_Long_All=Column(String)
-    Change_in_Nonreportable_Short_All=Column(String)
+    Open_Interest_All=Column(BigInteger)
+    Noncommercial_Positions_Long_All=Column(BigInteger)
+    Noncommercial_Positions_Short_All=Column(BigInteger)
+    Noncommercial_Positions_Spreading_All=Column(BigInteger)
+    Commercial_Positions_Long_All=Column(BigInteger)
+    Commercial_Positions_Short_All=Column(BigInteger)
+    Total_Reportable_Positions_Long_All=Column(BigInteger)
+    Total_Reportable_Positions_Short_All=Column(BigInteger)
+    Nonreportable_Positions_Long_All=Column(BigInteger)
+    Nonreportable_Positions_Short_All=Column(BigInteger)
+    Open_Interest_Old=Column(BigInteger)
+    Noncommercial_Positions_Long_Old=Column(BigInteger)
+    Noncommercial_Positions_Short_Old=Column(BigInteger)
+    Noncommercial_Positions_Spreading_Old=Column(BigInteger)
+    Commercial_Positions_Long_Old=Column(BigInteger)
+    Commercial_Positions_Short_Old=Column(BigInteger)
+    Total_Reportable_Positions_Long_Old=Column(BigInteger)
+    Total_Reportable_Positions_Short_Old=Column(BigInteger)
+    Nonreportable_Positions_Long_Old=Column(BigInteger)
+    Nonreportable_Positions_Short_Old=Column(BigInteger)
+    Open_Interest_Other=Column(BigInteger)
+    Noncommercial_Positions_Long_Other=Column(BigInteger)
+    Noncommercial_Positions_Short_Other=Column(BigInteger)
+    Noncommercial_Positions_Spreading_Other=Column(BigInteger)
+    Commercial_Positions_Long_Other=Column(BigInteger)
+    Commercial_Positions_Short_Other=Column(BigInteger)
+    Total_Reportable_Positions_Long_Other=Column(BigInteger)
+    Total_Reportable_Positions_Short_Other=Column(BigInteger)
+    Nonreportable_Positions_Long_Other=Column(BigInteger)
+    Nonreportable_Positions_Short_Other=Column(BigInteger)
+    Change_in_Open_Interest_All=Column(BigInteger)
+    Change_in_Noncommercial_Long_All=Column(BigInteger)
+    Change_in_Noncommercial_Short_All=Column(BigInteger)
+    Change_in_Noncommercial_Spreading_All=Column(BigInteger)
+    Change_in_Commercial_Long_All=Column(BigInteger)
+    Change_in_Commercial_Short_All=Column(BigInteger)
+    Change_in_Total_Reportable_Long_All=Column(BigInteger)
+    Change_in_Total_Reportable_Short_All=Column(BigInteger)
+    Change_in_Nonreportable_Long_All=Column(BigInteger)
+    Change_in_Nonreportable_Short_All=Column(BigInteger)
     Per_of_Open_Interest_OI_All=Column(Float)
     Per_of_OI_Noncommercial_Long_All=Column(Float)
     Per_of_OI_Noncommercial_Short_All=Column(Float)
@@ -302,30 +309,30 @@ class Legacy(Base):
     Per_of_OI_Total_Reportable_Short_Other=Column(Float)
     Per_of_OI_Nonreportable_Long_Other=Column(Float)
     Per_of_OI_Nonreportable_Short_Other=Column(Float)
-    Traders_Total_All=Column(String)
-    Traders_Noncommercial_Long_All=Column(String)
-    Traders_Noncommercial_Short_All=Column(String)
-    Traders_Noncommercial_Spreading_All=Column(String)
-    Traders_Commercial_Long_All=Column(String)
-    Traders_Commercial_Short_All=Column(String)
-    Traders_Total_Reportable_Long_All=Column(String)
-    Traders_Total_Reportable_Short_All=Column(String)
-    Traders_Total_Old=Column(String)
-    Traders_Noncommercial_Long_Old=Column(String)
-    Traders_Noncommercial_Short_Old=Column(String)
-    Traders_Noncommercial_Spreading_Old=Column(String)
-    Traders_Commercial_Long_Old=Column(String)
-    Traders_Commercial_Short_Old=Column(String)
-    Traders_Total_Reportable_Long_Old=Column(String)
-    Traders_Total_Reportable_Short_Old=Column(String)
-    Traders_Total_Other=Column(String)
-    Traders_Noncommercial_Long_Other=Column(String)
-    Traders_Noncommercial_Short_Other=Column(String)
-    Traders_Noncommercial_Spreading_Other=Column(String)
-    Traders_Commercial_Long_Other=Column(String)
-    Traders_Commercial_Short_Other=Column(String)
-    Traders_Total_Reportable_Long_Other=Column(String)
-    Traders_Total_Reportable_Short_Other=Column(String)
+    Traders_Total_All=Column(BigInteger)
+    Traders_Noncommercial_Long_All=Column(BigInteger)
+    Traders_Noncommercial_Short_All=Column(BigInteger)
+    Traders_Noncommercial_Spreading_All=Column(BigInteger)
+    Traders_Commercial_Long_All=Column(BigInteger)
+    Traders_Commercial_Short_All=Column(BigInteger)
+    Traders_Total_Reportable_Long_All=Column(BigInteger)
+    Traders_Total_Reportable_Short_All=Column(BigInteger)
+    Traders_Total_Old=Column(BigInteger)
+    Traders_Noncommercial_Long_Old=Column(BigInteger)
+    Traders_Noncommercial_Short_Old=Column(BigInteger)
+    Traders_Noncommercial_Spreading_Old=Column(BigInteger)
+    Traders_Commercial_Long_Old=Column(BigInteger)
+    Traders_Commercial_Short_Old=Column(BigInteger)
+    Traders_Total_Reportable_Long_Old=Column(BigInteger)
+    Traders_Total_Reportable_Short_Old=Column(BigInteger)
+    Traders_Total_Other=Column(BigInteger)
+    Traders_Noncommercial_Long_Other=Column(BigInteger)
+    Traders_Noncommercial_Short_Other=Column(BigInteger)
+    Traders_Noncommercial_Spreading_Other=Column(BigInteger)
+    Traders_Commercial_Long_Other=Column(BigInteger)
+    Traders_Commercial_Short_Other=Column(BigInteger)
+    Traders_Total_Reportable_Long_Other=Column(BigInteger)
+    Traders_Total_Reportable_Short_Other=Column(BigInteger)
     Concentration_Gross_LT__4_TDR_Long_All=Column(Float)
     Concentration_Gross_LT_4_TDR_Short_All=Column(Float)
     Concentration_Gross_LT_8_TDR_Long_All=Column(Float)
@@ -356,8 +363,150 @@ class Legacy(Base):
     CFTC_Commodity_Code_Quotes=Column(String)
     Report_Type=Column(String,primary_key=True)
     Market_Code=Column(String,primary_key=True)
+    Row_Hash=Column(BigInteger)
 
     def toDict(self):
         return { c.key: getattr(self, c.key) for c in inspect(self).mapper.column_attrs }
 
+    __table_args__ = (Index("legacy_market_report_date","Market_Code","Report_Type","Date"),
+                      {"postgresql_partition_by":'LIST ("Report_Type")',
+                       "info":{"report_types":("legacy_futopt","legacy_fut"),"first_year":1986}})
 
+
+
+class IngestWatermark(Base):
+    __tablename__="ingest_watermark"
+
+    Market_Code=Column(String,primary_key=True)
+    Report_Type=Column(String,primary_key=True)
+    Last_Date=Column(Date)
+    Updated_At=Column(DateTime,server_default=func.now(),onupdate=func.now())
+
+    def toDict(self):
+        return { c.key: getattr(self, c.key) for c in inspect(self).mapper.column_attrs }
+
+
+
+class SchemaVersion(Base):
+    __tablename__="schema_version"
+
+    Version=Column(Integer,primary_key=True,autoincrement=False)
+    Description=Column(String)
+    Applied_At=Column(DateTime,server_default=func.now())
+
+    def toDict(self):
+        return { c.key: getattr(self, c.key) for c in inspect(self).mapper.column_attrs }
+
+
+
+
+class DataVersion(Base):
+    __tablename__="data_version"
+
+    Name=Column(String,primary_key=True)
+    Version=Column(BigInteger,nullable=False,default=0)
+    Updated_At=Column(DateTime,server_default=func.now(),onupdate=func.now())
+
+    def toDict(self):
+        return { c.key: getattr(self, c.key) for c in inspect(self).mapper.column_attrs }
+
+
+
+class RevisionLog(Base):
+    __tablename__="revision_log"
+
+    Id=Column(Integer,primary_key=True,autoincrement=True)
+    Table_Name=Column(String,nullable=False)
+    Date=Column(Date,nullable=False)
+    Market_Code=Column(String,nullable=False)
+    Report_Type=Column(String,nullable=False)
+    Old_Hash=Column(BigInteger)
+    New_Hash=Column(BigInteger)
+    Changed_Columns=Column(String)
+    Detected_At=Column(DateTime,server_default=func.now())
+
+    def toDict(self):
+        return { c.key: getattr(self, c.key) for c in inspect(self).mapper.column_attrs }
+
+    __table_args__ = (Index("revision_log_market_report_date","Market_Code","Report_Type","Date"),)
+
+
+
+class Metric(Base):
+    # one numeric column of a COT table, with the trader category it reports on ("Market" for the market-wide
+    # ones, e.g. Open_Interest_All). Filled from the models, see facts.py
+    __tablename__="metric"
+
+    Id=Column(Integer,primary_key=True,autoincrement=True)
+    Table_Name=Column(String,nullable=False)
+    Name=Column(String,nullable=False)
+    Category=Column(String,nullable=False)
+
+    def toDict(self):
+        return { c.key: getattr(self, c.key) for c in inspect(self).mapper.column_attrs }
+
+    __table_args__ = (UniqueConstraint("Table_Name","Name",name="metric_table_name"),)
+
+
+
+class PositionFact(Base):
+    # the numeric values of the COT tables in long format, one row per (market, report date, metric), for
+    # queries of a few metrics across every market. Missing values are not stored
+    __tablename__="position_facts"
+
+    Market_Code=Column(String,primary_key=True)
+    Report_Type=Column(String,primary_key=True)
+    Date=Column(Date,primary_key=True)
+    Metric_Id=Column(Integer,ForeignKey(Metric.Id),primary_key=True)
+    Value=Column(Float)
+
+    def toDict(self):
+        return { c.key: getattr(self, c.key) for c in inspect(self).mapper.column_attrs }
+
+    # covering index of the cross-market screens: one metric over a date range, answered from the index alone
+    # on PostgreSQL
+    __table_args__ = (Index("position_facts_metric_date_market","Metric_Id","Date","Market_Code",
+                            postgresql_include=["Report_Type","Value"]),)
+
+
+
+class PositioningAnalytics(Base):
+    __tablename__="positioning_analytics"
+
+    Date=Column(Date,primary_key=True)
+    Market_Code=Column(String,primary_key=True)
+    Report_Type=Column(String,primary_key=True)
+    Category=Column(String,primary_key=True)
+    Net_Position=Column(BigInteger)
+    Net_Change=Column(BigInteger)
+    Pct_of_OI_Net=Column(Float)
+    COT_Index_52W=Column(Float)
+    COT_Index_156W=Column(Float)
+    Z_Score_52W=Column(Float)
+    Z_Score_156W=Column(Float)
+    Pct_Rank_52W=Column(Float)
+    Pct_Rank_156W=Column(Float)
+
+    def toDict(self):
+        return { c.key: getattr(self, c.key) for c in inspect(self).mapper.column_attrs }
+
+    __table_args__ = (Index("positioning_analytics_market_report_date","Market_Code","Report_Type","Date"),)
+
+
+def latest_table(table):
+    """
+    Table holding the latest report of each (Market_Code, Report_Type) of `table`, with the same columns.
+    It is refreshed by the ingest, see backend/db/snapshots.py
+    """
+    return Table(table.name+"_latest",meta_obj,
+                 *[Column(c.name,c.type,primary_key=c.name in ("Market_Code","Report_Type")) for c in table.columns])
+
+
+DisaggregatedFuturesOptionsLatest=latest_table(DisaggregatedFuturesOptions.__table__)
+LegacyLatest=latest_table(Legacy.__table__)
+
+# latest report tables keyed by the name of the table they summarize
+LATEST_TABLES={
+    DisaggregatedFuturesOptions.__tablename__:DisaggregatedFuturesOptionsLatest,
+    Legacy.__tablename__:LegacyLatest,
+}
@@ -0,0 +1,170 @@
+import logging
+from datetime import date
+
+from sqlalchemy import text
+
+from backend.db.dbconnect import get_engine
+from backend.db.models import DisaggregatedFuturesOptions, Legacy
+
+logger = logging.getLogger(__name__)
+
+
+# PostgreSQL only: the COT tables (and their shadow copies) are partitioned by LIST on Report_Type, each report
+# type by RANGE on Date with one partition per year. Partitions are named after their table, e.g.
+# legacy_futopt (report type legacy_futopt) and legacy_futopt_2019, so they follow it through the renames of
+# migrations.swap_tables. Each report type also has a default partition catching the years not created yet,
+# and report types not listed on the model go to <table>_other.
+
+
+def is_partitioned(table) -> bool:
+    """
+    Tells whether `table` is declared as partitioned on PostgreSQL.
+    """
+    return bool(table.dialect_options["postgresql"]["partition_by"])
+
+
+def _quote(conn, name, schema=None):
+    preparer = conn.dialect.identifier_preparer
+    if schema:
+        return "{}.{}".format(preparer.quote_schema(schema), preparer.quote(name))
+    return preparer.quote(name)
+
+
+def report_partition(table_name: str, report_type: str) -> str:
+    # the report types of a table share its family prefix, "legacy_futopt" -> "futopt"
+    return "{}_{}".format(table_name, report_type.rsplit("_", 1)[-1])
+
+
+def year_partition(table_name: str, report_type: str, year: int) -> str:
+    return "{}_{}".format(report_partition(table_name, report_type), year)
+
+
+def _create_year(conn, table, report_type, year):
+    conn.execute(text("CREATE TABLE IF NOT EXISTS {} PARTITION OF {} FOR VALUES FROM ('{}') TO ('{}')".format(
+        _quote(conn, year_partition(table.name, report_type, year), table.schema),
+        _quote(conn, report_partition(table.name, report_type), table.schema),
+        date(year, 1, 1), date(year + 1, 1, 1))))
+
+
+def create_partitions(conn, table, through_year=None) -> None:
+    """
+    Creates the partitions of a partitioned COT table just created (or of a shadow copy of one): one per report
+    type, each split into yearly partitions from the first year of the table through `through_year` (next
+    year by default), plus the default partitions. The (Market_Code, Report_Type, Date) index of the table is
+    created on each partition by PostgreSQL. Does nothing on other databases.
+    """
+    if conn.dialect.name != "postgresql" or not is_partitioned(table):
+        return
+    through_year = through_year or date.today().year + 1
+
+    for report_type in table.info["report_types"]:
+        parent = report_partition(table.name, report_type)
+        conn.execute(text("CREATE TABLE IF NOT EXISTS {} PARTITION OF {} FOR VALUES IN ('{}') PARTITION BY RANGE (\"Date\")".format(
+            _quote(conn, parent, table.schema), _quote(conn, table.name, table.schema), report_type)))
+        for year in range(table.info["first_year"], through_year + 1):
+            _create_year(conn, table, report_type, year)
+        conn.execute(text("CREATE TABLE IF NOT EXISTS {} PARTITION OF {} DEFAULT".format(
+            _quote(conn, parent + "_default", table.schema), _quote(conn, parent, table.schema))))
+
+    conn.execute(text("CREATE TABLE IF NOT EXISTS {} PARTITION OF {} DEFAULT".format(
+        _quote(conn, table.name + "_other", table.schema), _quote(conn, table.name, table.schema))))
+
+
+def partitioned_in_database(conn, table) -> bool:
+    """
+    Tells whether `table` is partitioned in the database, as opposed to declared so on the model.
+    """
+    if conn.dialect.name != "postgresql":
+        return False
+    return conn.execute(text("SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:t))"),
+                        {"t": _quote(conn, table.name, table.schema)}).scalar()
+
+
+def list_partitions(table, engine=None) -> list:
+    """
+    Returns the partitions of a COT table under each of its report types, as (name, bound) pairs, e.g.
+    ("legacy_futopt_2019", "FOR VALUES FROM ('2019-01-01') TO ('2020-01-01')"). Empty on other databases.
+    """
+    engine = engine or get_engine()
+    if engine.dialect.name != "postgresql":
+        return []
+    with engine.connect() as conn:
+        return [tuple(row) for row in conn.execute(text(
+            "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = to_regclass(:t)) "
+            "ORDER BY c.relname"), {"t": _quote(conn, table.name, table.schema)})]
+
+
+def ensure_partitions(mappers=(DisaggregatedFuturesOptions, Legacy), engine=None, through_year=None) -> None:
+    """
+    Creates the yearly partitions still missing through `through_year` (next year by default), so that the
+    rows of a new year never land in a default partition. Run before each load.
+    """
+    engine = engine or get_engine()
+    if engine.dialect.name != "postgresql":
+        return
+    with engine.begin() as conn:
+        for mapper in mappers:
+            if partitioned_in_database(conn, mapper.__table__):
+                create_partitions(conn, mapper.__table__, through_year)
+
+
+def detach_partition(mapper, report_type: str, year: int, engine=None) -> str:
+    """
+    Detaches the partition of one report type and year from its table. It is kept as a plain table under the
+    same name, which can be dumped, moved to another tablespace or dropped without touching the other years,
+    and attached back with `attach_partition`.
+
+    Args:
+        mapper (class): DisaggregatedFuturesOptions or Legacy.
+        report_type (str): A report type of the table, e.g. "legacy_futopt".
+        year (int): The year of the partition. The current year cannot be detached.
+        engine (Engine, optional): Defaults to the COT database engine.
+
+    Returns:
+        str: The name of the detached table.
+    """
+    if year >= date.today().year:
+        raise ValueError("The partition of the current year {} cannot be detached".format(year))
+
+    engine = engine or get_engine()
+    table = mapper.__table__
+    name = year_partition(table.name, report_type, year)
+    # DETACH ... CONCURRENTLY is not allowed next to the default partition every report type has
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE {} DETACH PARTITION {}".format(
+            _quote(conn, report_partition(table.name, report_type), table.schema), _quote(conn, name, table.schema))))
+    logger.info("detached partition {}".format(name))
+    return name
+
+
+def attach_partition(mapper, report_type: str, year: int, engine=None) -> None:
+    """
+    Attaches back a yearly partition detached with `detach_partition`.
+    """
+    engine = engine or get_engine()
+    table = mapper.__table__
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE {} ATTACH PARTITION {} FOR VALUES FROM ('{}') TO ('{}')".format(
+            _quote(conn, report_partition(table.name, report_type), table.schema),
+            _quote(conn, year_partition(table.name, report_type, year), table.schema),
+            date(year, 1, 1), date(year + 1, 1, 1))))
+    logger.info("attached partition {}".format(year_partition(table.name, report_type, year)))
+
+
+def detach_years_before(mapper, year: int, engine=None) -> list:
+    """
+    Detaches every yearly partition of `mapper` older than `year`, for all its report types.
+
+    Returns:
+        list: The names of the detached tables.
+    """
+    table = mapper.__table__
+    attached = {name for name, _ in list_partitions(table, engine)}
+    detached = []
+    for report_type in table.info["report_types"]:
+        for old_year in range(table.info["first_year"], year):
+            if year_partition(table.name, report_type, old_year) in attached:
+                detached.append(detach_partition(mapper, report_type, old_year, engine))
+    return detached
@@ -0,0 +1,50 @@
+from sqlalchemy import and_, delete, func, select
+
+from backend.db.dbconnect import get_engine
+from backend.db.models import LATEST_TABLES
+
+
+# latest report of each (Market_Code, Report_Type), kept next to the COT tables so that lookups of the
+# current positioning never scan the history
+def _latest_rows(table, where=None):
+    """
+    Selects the rows of `table` holding the latest report date of their (Market_Code, Report_Type).
+    """
+    last = select(table.c.Market_Code, table.c.Report_Type, func.max(table.c.Date).label("Date"))
+    if where is not None:
+        last = last.where(where)
+    last = last.group_by(table.c.Market_Code, table.c.Report_Type).subquery()
+
+    return select(table).join(last, and_(table.c.Market_Code == last.c.Market_Code,
+                                         table.c.Report_Type == last.c.Report_Type,
+                                         table.c.Date == last.c.Date))
+
+
+def refresh_latest(mapper, market_code, report_type, engine=None):
+    """
+    Replaces the latest report of one (Market_Code, Report_Type) with the one now in the table of `mapper`.
+    Called after each load, it only reads the rows of that market through the (Market_Code, Report_Type, Date)
+    index.
+    """
+    engine = engine or get_engine()
+    table = mapper.__table__
+    latest = LATEST_TABLES[table.name]
+
+    keys = and_(table.c.Market_Code == market_code, table.c.Report_Type == report_type)
+    with engine.begin() as conn:
+        conn.execute(delete(latest).where(latest.c.Market_Code == market_code, latest.c.Report_Type == report_type))
+        conn.execute(latest.insert().from_select([c.name for c in table.columns], _latest_rows(table, keys)))
+
+
+def rebuild_latest(mapper, engine=None):
+    """
+    Rebuilds the latest report table of `mapper` from scratch, e.g. after the table was rebuilt.
+    """
+    engine = engine or get_engine()
+    table = mapper.__table__
+    latest = LATEST_TABLES[table.name]
+
+    with engine.begin() as conn:
+        latest.create(conn, checkfirst=True)
+        conn.execute(delete(latest))
+        conn.execute(latest.insert().from_select([c.name for c in table.columns], _latest_rows(table)))
@@ -0,0 +1,154 @@
+import csv
+import io
+
+import pandas as pd
+from sqlalchemy import Column, Date, MetaData, Table, and_, func, select, true
+from sqlalchemy.dialects import postgresql, sqlite
+
+from backend.db.dbconnect import connect_to_database
+
+
+# tables that loads are redirected to while a rebuild is running, keyed by the name of the table they replace
+_LOAD_TARGETS = {}
+
+
+def redirect_loads(table, target):
+    """
+    Sends every load of `table` to `target` instead (e.g. a shadow table being rebuilt), or back to `table`
+    itself when `target` is None.
+    """
+    if target is None:
+        _LOAD_TARGETS.pop(table.name, None)
+    else:
+        _LOAD_TARGETS[table.name] = target
+
+
+def load_target(mapper):
+    """
+    Returns the table loads of `mapper` currently go to.
+    """
+    return _LOAD_TARGETS.get(mapper.__table__.name, mapper.__table__)
+
+
+def _staging_table(table, columns):
+    """
+    Builds a temporary table with the given columns of `table`, used to stage rows before merging them.
+    """
+    return Table("stage_" + table.name, MetaData(),
+                 *[Column(c.name, c.type) for c in table.columns if c.name in columns],
+                 prefixes=["TEMPORARY"])
+
+
+def _prepare(table, df, columns, keys):
+    """
+    Restricts `df` to the table columns, drops repeated keys (last one wins) and converts dates and missing values.
+    """
+    df = df[columns].drop_duplicates(subset=keys, keep="last")
+    df = df.dropna(subset=keys)
+    for c in table.columns:
+        if c.name in columns and isinstance(c.type, Date):
+            df = df.assign(**{c.name: pd.to_datetime(df[c.name]).dt.date})
+    return df.astype(object).where(df.notna(), None)
+
+
+def _copy_into(conn, stage, df):
+    """
+    Streams `df` into the staging table, with COPY FROM STDIN on PostgreSQL and executemany elsewhere.
+    """
+    if conn.dialect.name == "postgresql":
+        buf = io.StringIO()
+        df.to_csv(buf, index=False, header=False, na_rep="", quoting=csv.QUOTE_MINIMAL)
+        buf.seek(0)
+        preparer = conn.dialect.identifier_preparer
+        sql = "COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '')".format(
+            preparer.format_table(stage), ", ".join(preparer.quote(c) for c in df.columns))
+        cursor = conn.connection.cursor()
+        try:
+            if hasattr(cursor, "copy_expert"):
+                # psycopg2
+                cursor.copy_expert(sql, buf)
+            else:
+                # psycopg 3
+                with cursor.copy(sql) as copy:
+                    copy.write(buf.getvalue())
+        finally:
+            cursor.close()
+    else:
+        conn.execute(stage.insert(), df.to_dict(orient="records"))
+
+
+def upsert_dataframe(mapper, df, engine=None):
+    """
+    Inserts or updates the rows of a DataFrame in the table of `mapper`, keyed on its primary key.
+
+    The rows are streamed into a temporary staging table (COPY FROM STDIN on PostgreSQL) and merged with a single
+    INSERT ... SELECT ... ON CONFLICT (primary key) DO UPDATE, so new and existing rows can be mixed freely.
+    PostgreSQL and SQLite (3.24+) are supported. Columns of `df` that are not in the table are ignored, and
+    rows repeating a key keep their last occurrence.
+
+    Args:
+        mapper (class): A mapper class from backend.db.models, e.g. DisaggregatedFuturesOptions.
+        df (pandas.DataFrame): The rows to load. It must contain every primary key column of the table.
+        engine (Engine, optional): Engine to load with. Defaults to the COT database engine.
+
+    Returns:
+        tuple: (inserted, updated) row counts.
+    """
+    table = load_target(mapper)
+    keys = [c.name for c in table.primary_key.columns]
+    missing = [k for k in keys if k not in df.columns]
+    if missing:
+        raise ValueError("Missing primary key columns {} for table {}".format(missing, table.name))
+
+    columns = [c.name for c in table.columns if c.name in df.columns]
+    df = _prepare(table, df, columns, keys)
+    if df.empty:
+        return 0, 0
+
+    if engine is None:
+        engine = connect_to_database(get_engine_only=True)
+
+    if engine.dialect.name == "postgresql":
+        dialect_insert = postgresql.insert
+    elif engine.dialect.name == "sqlite":
+        dialect_insert = sqlite.insert
+    else:
+        raise NotImplementedError("Upserts are not supported on {}".format(engine.dialect.name))
+
+    stage = _staging_table(table, columns)
+
+    with engine.begin() as conn:
+        stage.drop(conn, checkfirst=True)
+        stage.create(conn)
+        _copy_into(conn, stage, df)
+
+        # rows whose key already exists in the target are the ones the merge will update
+        on_keys = and_(*[stage.c[k] == table.c[k] for k in keys])
+        updated = conn.execute(select(func.count()).select_from(stage.join(table, on_keys))).scalar()
+
+        stmt = dialect_insert(table).from_select(columns, select(*[stage.c[c] for c in columns]).where(true()))
+        update_columns = {c: stmt.excluded[c] for c in columns if c not in keys}
+        if update_columns:
+            stmt = stmt.on_conflict_do_update(index_elements=keys, set_=update_columns)
+        else:
+            stmt = stmt.on_conflict_do_nothing(index_elements=keys)
+        conn.execute(stmt)
+
+        stage.drop(conn)
+
+    return len(df) - updated, updated
+
+
+def append_dataframe(conn, table, df):
+    """
+    Appends the rows of a DataFrame to `table` on an open connection, streamed as in `upsert_dataframe` but
+    without the staging table and merge. Only for rows whose keys are not in the table, e.g. just deleted.
+
+    Returns:
+        int: Number of rows appended.
+    """
+    columns = [c.name for c in table.columns if c.name in df.columns]
+    df = _prepare(table, df, columns, [c.name for c in table.primary_key.columns])
+    if not df.empty:
+        _copy_into(conn, table, df)
+    return len(df)
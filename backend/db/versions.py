@@ -0,0 +1,39 @@
+from sqlalchemy import func, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from backend.db.dbconnect import get_engine
+from backend.db.models import DataVersion
+
+
+# counter moved forward after every successful load, so readers can tell when their cached results are stale
+COT_DATA = "cot"
+
+
+def get_data_version(name=COT_DATA, engine=None):
+    """
+    Returns the current version of a data set, 0 if it was never loaded.
+    """
+    engine = engine or get_engine()
+    with engine.connect() as conn:
+        return conn.execute(select(DataVersion.Version).where(DataVersion.Name == name)).scalar() or 0
+
+
+def bump_data_version(name=COT_DATA, engine=None):
+    """
+    Moves the version of a data set forward by one, creating it at 1. The row is created or incremented by a
+    single INSERT ... ON CONFLICT DO UPDATE, so concurrent loads never lose one, nor fail on the first load.
+    """
+    engine = engine or get_engine()
+    if engine.dialect.name == "postgresql":
+        dialect_insert = postgresql.insert
+    elif engine.dialect.name == "sqlite":
+        dialect_insert = sqlite.insert
+    else:
+        raise NotImplementedError("Upserts are not supported on {}".format(engine.dialect.name))
+
+    table = DataVersion.__table__
+    stmt = dialect_insert(table).values(Name=name, Version=1)
+    stmt = stmt.on_conflict_do_update(index_elements=["Name"],
+                                      set_={"Version": table.c.Version + 1, "Updated_At": func.now()})
+    with engine.begin() as conn:
+        conn.execute(stmt)
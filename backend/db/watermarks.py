@@ -0,0 +1,40 @@
+from backend.db.dbconnect import session_scope
+from backend.db.models import IngestWatermark
+
+
+# high-water marks of the last report date loaded per (Market_Code, Report_Type)
+def get_watermarks(report_type, market_codes=None):
+    """
+    Returns the last loaded report date of each market for a report type.
+
+    Args:
+        report_type (str): The report type, e.g. "disaggregated_futopt".
+        market_codes (list, optional): Restrict to these market codes. Defaults to None, which returns every market.
+
+    Returns:
+        dict: Market code -> datetime.date of the last loaded report. Markets never loaded are absent.
+    """
+    with session_scope() as ssn:
+        q = ssn.query(IngestWatermark.Market_Code, IngestWatermark.Last_Date).filter(IngestWatermark.Report_Type == report_type)
+        if market_codes is not None:
+            q = q.filter(IngestWatermark.Market_Code.in_(list(market_codes)))
+        return {code: last_date for code, last_date in q.all() if last_date is not None}
+
+
+def get_watermark(market_code, report_type):
+    """
+    Returns the last loaded report date for a market and report type, or None if it was never loaded.
+    """
+    return get_watermarks(report_type, [market_code]).get(market_code)
+
+
+def set_watermark(market_code, report_type, last_date):
+    """
+    Moves the high-water mark of a market and report type forward to `last_date`. It never moves backwards.
+    """
+    with session_scope() as ssn:
+        mark = ssn.get(IngestWatermark, (market_code, report_type))
+        if mark is None:
+            ssn.add(IngestWatermark(Market_Code=market_code, Report_Type=report_type, Last_Date=last_date))
+        elif mark.Last_Date is None or last_date > mark.Last_Date:
+            mark.Last_Date = last_date
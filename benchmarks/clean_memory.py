@@ -0,0 +1,139 @@
+"""
+Peak memory of `cot.clean_disagg_fut_opt` per market, next to the implementation it replaced.
+
+Every (implementation, market) pair runs in a fresh process, which reads the rows of the market from a pickle,
+then records its resident set size before cleaning and its peak while cleaning.
+
+    python benchmarks/clean_memory.py --markets 058643 067651 --report disaggregated_futopt
+"""
+import argparse
+import os
+import pickle
+import resource
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from cot import DISAGGREGATED_REPORTS, clean_disagg_fut_opt
+from reports import get_market_frames
+
+MIB = 1024 * 1024
+
+
+def previous_clean_disagg_fut_opt(market_code, columns_to_keep=None, fut_opt='opt', disaggregated_futopt=None):
+    """
+    `clean_disagg_fut_opt` as it was before the cleaning was made copy-free, kept for comparison.
+    """
+    disaggregated_futopt.sort_values(by='Report_Date_as_YYYY-MM-DD', ascending=True, inplace=True)
+    disaggregated_futopt.set_index('Report_Date_as_YYYY-MM-DD', inplace=True)
+    disaggregated_futopt.index.name = 'Date'
+
+    if columns_to_keep:
+        disaggregated_futopt = disaggregated_futopt[columns_to_keep]
+
+    if fut_opt == "opt":
+        disaggregated_futopt['Net_Spec_Length_Cal'] = disaggregated_futopt['M_Money_Positions_Long_All'] - disaggregated_futopt['M_Money_Positions_Short_All']
+        disaggregated_futopt['Pct_of_OI_MM_NSL'] = disaggregated_futopt['Pct_of_OI_M_Money_Long_All'] - disaggregated_futopt['Pct_of_OI_M_Money_Short_All']
+    elif fut_opt == "fut":
+        disaggregated_futopt['Net_Spec_Length'] = disaggregated_futopt['M_Money_Positions_Long_All'] - disaggregated_futopt['M_Money_Positions_Short_All']
+        disaggregated_futopt['Pct_of_OI_MM_NSL'] = disaggregated_futopt['Pct_of_OI_M_Money_Long_All'] - disaggregated_futopt['Pct_of_OI_M_Money_Short_All']
+
+    disaggregated_futopt.index = pd.DatetimeIndex(disaggregated_futopt.index)
+    disaggregated_futopt.sort_index(ascending=False, inplace=True)
+
+    disaggregated_futopt = disaggregated_futopt.replace('.', np.nan)
+    disaggregated_futopt["Market_Code"] = market_code
+
+    return disaggregated_futopt
+
+
+IMPLEMENTATIONS = {
+    "previous": previous_clean_disagg_fut_opt,
+    "current": clean_disagg_fut_opt,
+}
+
+
+def _rss():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def _reset_peak():
+    # linux resets the peak resident set size (VmHWM) of a process when 5 is written to its clear_refs
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _measure(implementation, path, market_code, fut_opt, columns_to_keep):
+    """
+    Cleans the pickled rows of a market with one implementation. Runs in a fresh process.
+    """
+    with open(path, "rb") as f:
+        frame = pickle.load(f)
+
+    clean = IMPLEMENTATIONS[implementation]
+    before = _rss()
+    exact = _reset_peak()
+    result = clean(market_code, columns_to_keep=columns_to_keep, fut_opt=fut_opt, disaggregated_futopt=frame)
+    peak = _peak()
+
+    return {"rows": len(result), "columns": result.shape[1], "rss_before_mib": before / MIB,
+            "peak_mib": peak / MIB, "growth_mib": max(peak - before, 0) / MIB, "exact_peak": exact}
+
+
+def run(market_codes, fut_opt="opt", columns_to_keep=None):
+    """
+    Measures every implementation on the rows of each market.
+
+    Returns:
+        pd.DataFrame: One row per (market, implementation).
+    """
+    report = DISAGGREGATED_REPORTS[fut_opt]
+    frames = get_market_frames(report, market_codes)
+    results = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for market_code, frame in frames.items():
+            path = os.path.join(tmp, market_code + ".pkl")
+            with open(path, "wb") as f:
+                pickle.dump(frame.copy(), f)
+
+            for implementation in IMPLEMENTATIONS:
+                with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+                    measured = pool.submit(_measure, implementation, path, market_code, fut_opt, columns_to_keep).result()
+                results.append({"market_code": market_code, "implementation": implementation, **measured})
+
+    return pd.DataFrame(results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Peak memory of the disaggregated report cleaning per market")
+    parser.add_argument("--markets", nargs="+", required=True, help="CFTC contract market codes")
+    parser.add_argument("--report", choices=list(DISAGGREGATED_REPORTS.values()), default="disaggregated_futopt")
+    parser.add_argument("--columns", nargs="+", help="columns_to_keep passed to both implementations")
+    args = parser.parse_args()
+
+    fut_opt = next(key for key, report in DISAGGREGATED_REPORTS.items() if report == args.report)
+    results = run(args.markets, fut_opt, args.columns)
+    pd.set_option("display.width", 200)
+    print(results.round(1).to_string(index=False))
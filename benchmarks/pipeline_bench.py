@@ -0,0 +1,221 @@
+"""
+Times and memory-profiles every stage of the pipeline on synthetic reports, and flags regressions against a
+stored baseline.
+
+The stages run as in `pipeline.py`, on a disaggregated and a legacy report of `--markets` markets over
+`--weeks` weeks: parse (reading the zip archive), split, clean, store (parquet store in a temporary
+directory), db_load (into a temporary SQLite database, or the scratch database of `--db-url`, whose COT
+and fact tables are dropped and recreated before each run), facts, analytics and panel. Each stage keeps its fastest time
+over `--repeat` runs; one more run under tracemalloc records the peak memory allocated by each stage.
+
+    python benchmarks/pipeline_bench.py --markets 50 --weeks 520 --save-baseline
+    python benchmarks/pipeline_bench.py --markets 50 --weeks 520
+
+The second command compares with benchmarks/baseline.json and exits with status 1 when a stage got slower
+or allocates more than `--tolerance` (20%) above the baseline.
+"""
+import argparse
+import json
+import logging
+import sys
+import tempfile
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+
+import pandas as pd
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from synthetic import MAPPERS, synthetic_report, write_archive
+
+from analytics import CATEGORIES, positioning_analytics
+from backend.db.dbconnect import get_engine
+from backend.db.models import Base, Metric, PositionFact
+from backend.db.partitions import create_partitions
+from backend.db.upsert import upsert_dataframe
+from common import coerce_to_schema
+from cot import prepare_report_rows
+from facts import save_facts
+from metrics import get_run_metrics, stage, start_run
+from panel import build_panel
+from parquet_store import write_rows
+from reports import read_archive, split_by_market
+
+logger = logging.getLogger(__name__)
+
+MIB = 1024 * 1024
+
+DEFAULT_BASELINE = Path(__file__).resolve().parent / "baseline.json"
+
+REPORTS = ("disaggregated_futopt", "legacy_futopt")
+
+# stages shorter than this are too noisy to compare
+MIN_SECONDS = 0.05
+
+
+@contextmanager
+def _measured(name, report_type):
+    """
+    Records a stage like `metrics.stage`, with the memory it allocated at its peak when tracemalloc is on.
+    """
+    with stage(name, report_type=report_type) as record:
+        traced = tracemalloc.is_tracing()
+        if traced:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        try:
+            yield record
+        finally:
+            if traced:
+                record["allocated_mib"] = (tracemalloc.get_traced_memory()[1] - before) / MIB
+
+
+def run_pipeline(archives: dict, workdir: Path, db_url: str = None) -> None:
+    """
+    Runs every stage once on the archives of each report type, recording them in the current run metrics.
+    """
+    engine = get_engine(db_url or "sqlite:///{}".format(workdir / "cot.db"))
+    tables = [mapper.__table__ for mapper in set(MAPPERS.values())] + [Metric.__table__, PositionFact.__table__]
+    # start from empty tables, so db_load always measures inserts
+    Base.metadata.drop_all(engine, tables=tables)
+    with engine.begin() as conn:
+        for table in tables:
+            table.create(conn)
+            create_partitions(conn, table)
+
+    for report_type, path in archives.items():
+        mapper = MAPPERS[report_type]
+
+        with _measured("parse", report_type) as record:
+            df = read_archive(path)
+            record["rows"] = len(df)
+
+        with _measured("split", report_type) as record:
+            frames = split_by_market(df, report_type)
+            record["rows"] = sum(len(frame) for frame in frames.values())
+        del df
+
+        with _measured("clean", report_type) as record:
+            rows = pd.concat([prepare_report_rows(report_type, code, frame) for code, frame in frames.items()],
+                             ignore_index=True)
+            record["rows"] = len(rows)
+        del frames
+
+        with _measured("store", report_type) as record:
+            rows = coerce_to_schema(rows, mapper)
+            record["rows"] = write_rows(rows, root=workdir / "store")
+
+        with _measured("db_load", report_type) as record:
+            record["inserted"], record["updated"] = upsert_dataframe(mapper, rows, engine)
+
+        with _measured("facts", report_type) as record:
+            record["rows"] = save_facts(rows, mapper, engine)
+
+        with _measured("analytics", report_type) as record:
+            record["rows"] = len(positioning_analytics(rows, CATEGORIES[mapper.__tablename__]))
+
+        with _measured("panel", report_type) as record:
+            panel = build_panel(report_type, fields=["Open_Interest_All"], rows=rows)
+            record["rows"] = len(panel)
+
+    engine.dispose()
+
+
+def run(markets: int = 50, weeks: int = 520, repeat: int = 3, db_url: str = None, seed: int = 0) -> dict:
+    """
+    Benchmarks the pipeline stages on synthetic reports.
+
+    Returns:
+        dict: The benchmark settings and, per "<stage>/<report type>", the fastest time in seconds and the
+            peak memory allocated in MiB.
+    """
+    results = {"settings": {"markets": markets, "weeks": weeks, "repeat": repeat,
+                            "database": "postgresql" if db_url else "sqlite"}, "stages": {}}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        archives = {report_type: write_archive(synthetic_report(report_type, markets, weeks, seed=seed),
+                                               tmp / "{}.zip".format(report_type))
+                    for report_type in REPORTS}
+
+        for i in range(repeat + 1):
+            traced = i == repeat
+            workdir = tmp / "run{}".format(i)
+            workdir.mkdir()
+            if traced:
+                tracemalloc.start()
+            start_run()
+            try:
+                run_pipeline(archives, workdir, db_url)
+            finally:
+                if traced:
+                    tracemalloc.stop()
+
+            for record in get_run_metrics().records:
+                key = "{}/{}".format(record["stage"], record["report_type"])
+                measured = results["stages"].setdefault(key, {})
+                if traced:
+                    measured["allocated_mib"] = record["allocated_mib"]
+                else:
+                    measured["seconds"] = min(measured.get("seconds", record["seconds"]), record["seconds"])
+                    measured["rows"] = record.get("rows", record.get("inserted"))
+
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float = 0.2) -> list:
+    """
+    Returns the regressions of `results` against `baseline`: stages more than `tolerance` slower, or
+    allocating more than `tolerance` more memory, as (stage, measure, baseline, current) tuples.
+    """
+    if results["settings"] != baseline["settings"]:
+        logger.warning("Baseline settings {} differ from {}".format(baseline["settings"], results["settings"]))
+
+    regressions = []
+    for key, measured in results["stages"].items():
+        before = baseline["stages"].get(key)
+        if before is None:
+            continue
+        for measure in ("seconds", "allocated_mib"):
+            if measure not in measured or measure not in before:
+                continue
+            if measure == "seconds" and max(measured[measure], before[measure]) < MIN_SECONDS:
+                continue
+            if measured[measure] > before[measure] * (1 + tolerance):
+                regressions.append((key, measure, before[measure], measured[measure]))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic COT reports")
+    parser.add_argument("--markets", type=int, default=50, help="number of markets per report (default: 50)")
+    parser.add_argument("--weeks", type=int, default=520, help="weeks of history per market (default: 520)")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs, the fastest is kept (default: 3)")
+    parser.add_argument("--db-url", help="scratch database to load into instead of a temporary SQLite file, "
+                                         "e.g. a local PostgreSQL; its COT tables are dropped")
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE, help="baseline JSON file")
+    parser.add_argument("--save-baseline", action="store_true", help="write the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown over the baseline (default: 0.2)")
+    parser.add_argument("--output", type=Path, help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    results = run(args.markets, args.weeks, args.repeat, args.db_url)
+
+    table = pd.DataFrame.from_dict(results["stages"], orient="index")
+    print(table.round(3).to_string())
+
+    for path in [args.output, args.baseline if args.save_baseline else None]:
+        if path:
+            with open(path, "w") as f:
+                json.dump(results, f, indent=2)
+
+    if not args.save_baseline and args.baseline.exists():
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for key, measure, before, current in regressions:
+            print("REGRESSION {} {}: {:.3f} -> {:.3f}".format(key, measure, before, current))
+        if regressions:
+            sys.exit(1)
+        print("no regression against {}".format(args.baseline))
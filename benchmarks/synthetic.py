@@ -0,0 +1,96 @@
+"""
+Synthetic CFTC report frames, laid out like the published disaggregated and legacy reports.
+
+The columns are those of the model tables, with the report date column and the market code column spelled as
+published (the legacy headers use spaces instead of underscores), so that they go through the same
+normalization as the real archives.
+"""
+import sys
+import zipfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import Float, Integer
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from backend.db.models import DisaggregatedFuturesOptions, Legacy
+from reports import DATE_COLUMNS, MARKET_CODE_COLUMNS
+
+MAPPERS = {"disaggregated_futopt": DisaggregatedFuturesOptions, "disaggregated_fut": DisaggregatedFuturesOptions,
+           "legacy_futopt": Legacy, "legacy_fut": Legacy}
+
+# columns added by the cleaning, absent from the published reports
+ADDED_COLUMNS = ("Date", "Report_Type", "Market_Code", "Net_Spec_Length", "Pct_of_OI_MM_NSL", "Row_Hash")
+
+
+def published_header(report_type: str, name: str) -> str:
+    if name == "CFTC_Contract_Market_Code":
+        return MARKET_CODE_COLUMNS[report_type]
+    if " " in MARKET_CODE_COLUMNS[report_type]:
+        return name.replace("_", " ")
+    return name
+
+
+def synthetic_report(report_type: str, markets: int = 50, weeks: int = 520, missing: float = 0.01,
+                     seed: int = 0) -> pd.DataFrame:
+    """
+    Builds a report of `markets` markets over `weeks` weekly (Tuesday) report dates, as `reports.read_archive`
+    returns it.
+
+    Args:
+        report_type (str): "disaggregated_futopt", "disaggregated_fut", "legacy_futopt" or "legacy_fut".
+        markets (int, optional): Number of markets. Defaults to 50.
+        weeks (int, optional): Number of report dates per market. Defaults to 520 (10 years).
+        missing (float, optional): Share of the numeric values published as the "." placeholder, which turns
+            their columns into text like in the real archives. Defaults to 0.01.
+        seed (int, optional): Random seed. Defaults to 0.
+
+    Returns:
+        pd.DataFrame: One row per (market, report date), newest first like the CFTC files.
+    """
+    rng = np.random.default_rng(seed)
+    table = MAPPERS[report_type].__table__
+    dates = pd.date_range(end=pd.Timestamp.today().normalize(), periods=weeks, freq="W-TUE")
+    codes = ["{:06d}".format(code) for code in rng.choice(999999, size=markets, replace=False)]
+    rows = markets * weeks
+
+    columns = {}
+    for column in table.columns:
+        if column.name in ADDED_COLUMNS:
+            continue
+        if isinstance(column.type, Integer):
+            # positions follow a random walk per market, so the rolling statistics have something to work on
+            steps = rng.integers(-2000, 2000, size=(markets, weeks))
+            values = np.abs(steps.cumsum(axis=1) + rng.integers(10000, 200000, size=(markets, 1))).ravel()
+        elif isinstance(column.type, Float):
+            values = rng.uniform(0, 100, size=rows).round(1)
+        else:
+            values = np.repeat(["{} {}".format(column.name, code) for code in codes], weeks)
+        columns[published_header(report_type, column.name)] = values
+
+    df = pd.DataFrame(columns)
+    df[MARKET_CODE_COLUMNS[report_type]] = np.repeat(codes, weeks)
+    df[DATE_COLUMNS[report_type]] = np.tile(dates.strftime("%Y-%m-%d"), markets)
+
+    numeric = [published_header(report_type, c.name) for c in table.columns
+               if c.name not in ADDED_COLUMNS and isinstance(c.type, (Integer, Float))]
+    if missing:
+        # the CFTC writes "." for a missing value, which makes pandas read the whole column as text
+        for name in rng.choice(numeric, size=max(1, len(numeric) // 10), replace=False):
+            text = df[name].astype(str).to_numpy(dtype=object)
+            text[rng.random(rows) < missing] = "."
+            df[name] = text
+
+    return df.sort_values(DATE_COLUMNS[report_type], ascending=False, ignore_index=True)
+
+
+def write_archive(df: pd.DataFrame, path) -> Path:
+    """
+    Writes a report frame as a CFTC-style zip archive holding one comma separated .txt file.
+    """
+    path = Path(path)
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr(path.stem + ".txt", df.to_csv(index=False))
+    return path
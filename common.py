@@ -1,8 +1,13 @@
 
 import os
+import logging
 from pathlib import Path
 import pandas as pd
-from backend.db.dbconnect import connect_to_database
+from sqlalchemy import Float, Integer, Numeric
+from backend.db.upsert import upsert_dataframe
+from metrics import stage
+from parquet_store import write_rows
+logger = logging.getLogger(__name__)
 PDFS=[]
 
 
@@ -56,77 +61,82 @@ def check_if_exists(filepath: str, checkparm: str):
         return False
 
 
-def save_to_dir(df, directory, filename, mapper=None, sub_dir=None):
+def coerce_to_schema(df, mapper):
     """
-    Save a pandas DataFrame to a specified directory and file name.
+    Converts the columns of a DataFrame that map to numeric columns of `mapper` to numbers, in one vectorized
+    pass per column. The CFTC '.' placeholder and anything else that is not a number become missing values;
+    integer columns use the nullable Int64 dtype.
 
     Args:
-        df (pandas.DataFrame): The DataFrame to be saved.
-        directory (str): The name of the directory where the file will be saved.
-        filename (str): The name of the file to be saved.
+        df (pandas.DataFrame): The DataFrame to convert.
+        mapper (Mapper class): The mapper class whose column types are used.
+
+    Returns:
+        pandas.DataFrame: A DataFrame with the numeric columns converted, other columns untouched.
+    """
+    converted = {}
+    for column in mapper.__table__.columns:
+        if column.name not in df.columns or not isinstance(column.type, (Integer, Float, Numeric)):
+            continue
+        values = pd.to_numeric(df[column.name], errors="coerce")
+        if isinstance(column.type, Integer):
+            values = values.round().astype("Int64")
+        converted[column.name] = values
+    return df.assign(**converted)
+
+
+def save_to_store(df, mapper=None):
+    """
+    Save report rows to the local parquet store (FILEDB/parquet), replacing rows already stored for the
+    same (Date, Market_Code, Report_Type), and load them into the database when a mapper is given.
+
+    Args:
+        df (pandas.DataFrame): Report rows with "Date", "Market_Code" and "Report_Type" columns.
         mapper (Mapper class): Optional mapper class to map the DataFrame to a database table.
-        sub_dir (str): Optional subdirectory name to be created within the main directory.
 
     Returns:
-        None
+        tuple: (inserted, updated) database row counts when a mapper is given, None otherwise.
     """
-    # set the file path and create the directory if it doesn't exist
-    path = (Path(__file__).resolve().parent).joinpath(directory)
-    if sub_dir:
-        path = (Path(__file__).resolve().parent).joinpath(directory).joinpath(sub_dir)
-    if not os.path.exists(path):
-        os.makedirs(path)
-
-    filepath = os.path.join(path, filename)
-
-    # create or append data to the file
-    if not os.path.isfile(str(filepath)):
-        df.to_csv(str(filepath), header='column_names')
-    else:
-        df.to_csv(str(filepath), mode='a', header=False)
+    # the market and report type of the rows, when they all share one, label the timings
+    fields = {name.lower(): df[name].iloc[0] for name in ("Market_Code", "Report_Type")
+              if name in df.columns and len(df) and (df[name] == df[name].iloc[0]).all()}
+
+    with stage("store", rows=len(df), **fields):
+        if mapper:
+            df = coerce_to_schema(df, mapper)
+        write_rows(df)
 
-    # if a mapper is provided, insert the data into the database
     if mapper:
-        insert_into_database(mapper, df.to_dict(orient="records"))
+        with stage("db_load", rows=len(df), **fields) as record:
+            record["inserted"], record["updated"] = insert_into_database(mapper, df)
+        return record["inserted"], record["updated"]
 
-    
 
 def insert_into_database(mapper, data):
     """
     Wrapper function to insert or update data to the database
 
+    The rows are merged on the primary key of the table (Date, Market_Code, Report_Type for the COT tables):
+    new rows are inserted and existing ones updated in a single bulk load.
+
     Parameters:
     mapper (class): A mapper class representing the database table to be updated
-    data (list): A list of dictionaries containing the data to be updated or inserted
+    data (DataFrame or list): The rows to be updated or inserted, as a DataFrame or a list of dictionaries
 
     Returns:
-    None
-    """
+    tuple: (inserted, updated) row counts
 
-    # Connect to the database
-    db_engine = connect_to_database()
-    ssn = db_engine()
+    Raises:
+    Exception: Whatever the load raised, after it has been rolled back and logged
+    """
+    if not isinstance(data, pd.DataFrame):
+        data = pd.DataFrame(data)
 
     try:
-        # Try to bulk insert the data
-        ssn.bulk_insert_mappings(mapper, data)
-        ssn.commit()
-        print("Records added to the database")
+        inserted, updated = upsert_dataframe(mapper, data)
+        logger.info("{} records added and {} updated in {}".format(inserted, updated, mapper.__tablename__))
+        return inserted, updated
 
     except Exception as e:
-        # Rollback the transaction if there was an error
-        ssn.rollback()
-
-        try:
-            # If insertion fails, try to update existing data
-            ssn.bulk_update_mappings(mapper, data)
-            ssn.commit()
-            print("Records updated in the database")
-
-        except Exception as e:
-            # If update also fails, print the error message
-            print("Error adding or updating data to the database: {}".format(e))
-
-    finally:
-        # Close the session
-        ssn.close()
+        logger.error("Error adding or updating data to the database: {}".format(e))
+        raise
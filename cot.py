@@ -2,24 +2,108 @@
 # The data, which is generally released each Friday at 3:30 pm Eastern time, comes with a lag of three days, as the reported data is typically from previous Tuesday (close).
 from pandas.tseries.offsets import BDay
 from datetime import date
+from functools import lru_cache
 import pandas_market_calendars as mcal
-import cot_reports as cot
 import pandas as pd
 import numpy as np
-from common import save_to_dir
+from common import save_to_store
+from reports import DATE_COLUMNS, get_market_frame, get_market_frames, normalize_report, release_report
 from backend.db.models import *
-from backend.db.migrate_db import clean_db, migrate_models
+from backend.db.watermarks import get_watermark, get_watermarks, set_watermark
+from backend.db.snapshots import refresh_latest
+from backend.db.versions import bump_data_version
+from metrics import stage
+from revisions import changed_rows, log_revisions
+from facts import save_facts
 import logging
+import sys
 from pathlib import Path
-logging.basicConfig(filename="logs/cot.log",level=logging.DEBUG)
 logger= logging.getLogger(__name__)
-import numpy as np
-from pathlib import Path
-import cot_functions as cot # assuming this module is imported elsewhere
 from typing import Optional
 
-# Docstring for function
-def get_legacy_fut_opt(market_code: str, report_type: Optional[str] = "opt", hist: Optional[bool] = True) -> None:
+# report types loaded into the database, with the "fut"/"opt" choice each getter takes and the table they go to
+DISAGGREGATED_REPORTS = {"opt": "disaggregated_futopt", "fut": "disaggregated_fut"}
+LEGACY_REPORTS = {"opt": "legacy_futopt", "fut": "legacy_fut"}
+REPORT_MAPPERS = {
+    "disaggregated_futopt": DisaggregatedFuturesOptions,
+    "disaggregated_fut": DisaggregatedFuturesOptions,
+    "legacy_futopt": Legacy,
+    "legacy_fut": Legacy,
+}
+
+# columns derived from the disaggregated reports, as (long column, short column) pairs of the difference
+DERIVED_COLUMNS = {
+    "Net_Spec_Length": ("M_Money_Positions_Long_All", "M_Money_Positions_Short_All"),
+    "Pct_of_OI_MM_NSL": ("Pct_of_OI_M_Money_Long_All", "Pct_of_OI_M_Money_Short_All"),
+}
+
+
+def report_columns(report: str, columns_to_keep: list[str] = None) -> Optional[list]:
+    """
+    Returns the model columns to read from a report for `columns_to_keep`: those and the columns of
+    `DERIVED_COLUMNS` for the disaggregated reports, or None (every column) for the other reports or when no
+    columns are given.
+    """
+    if not columns_to_keep or report not in DISAGGREGATED_REPORTS.values():
+        return None
+    return list(dict.fromkeys(list(columns_to_keep) + [c for pair in DERIVED_COLUMNS.values() for c in pair]))
+
+
+# report weeks before the last loaded one that are read again on each run and compared by row hash, to catch
+# the revisions the CFTC publishes for past weeks. Limited to the archives an incremental run reads, which
+# start with the year of the last loaded report, see `revision_start`
+REVISION_WEEKS = 52
+
+
+def revision_start(last_date):
+    """
+    Returns the first report date an incremental run compares with the stored rows, or None for a full load:
+    `REVISION_WEEKS` before `last_date`, but not before January 1st of its year, the first archive read.
+    """
+    if last_date is None:
+        return None
+    last_date = pd.Timestamp(last_date)
+    return max(last_date - pd.Timedelta(weeks=REVISION_WEEKS), pd.Timestamp(last_date.year, 1, 1))
+
+
+def rows_after(df: pd.DataFrame, last_date) -> pd.DataFrame:
+    """
+    Keeps the rows of `df` dated after `last_date`, or all of them when `last_date` is None.
+    """
+    if last_date is None:
+        return df
+    return df[pd.to_datetime(df["Date"]) > pd.Timestamp(last_date)]
+
+
+def prepare_report_rows(report: str, market_code: str, report_df: Optional[pd.DataFrame] = None, last_date=None,
+                        columns_to_keep: list[str] = None) -> pd.DataFrame:
+    """
+    Cleans the rows of a loadable report type for a market code and keeps the report dates after `last_date`,
+    and the earlier ones from `revision_start`, which `save_new_rows` only loads again if they were revised.
+
+    Args:
+        report (str): One of the report types in `REPORT_MAPPERS`.
+        market_code (str): The CFTC contract market code.
+        report_df (pd.DataFrame, optional): Rows of the report already split out for `market_code`.
+        last_date (date, optional): Last report date already loaded. Defaults to None, which keeps every row.
+        columns_to_keep (List[str], optional): Columns to keep from the disaggregated reports. Defaults to None.
+
+    Returns:
+        pd.DataFrame: Rows ready for `save_new_rows`, with "Date", "Market_Code" and "Report_Type" columns.
+    """
+    if report in LEGACY_REPORTS.values():
+        report_type = "opt" if report == "legacy_futopt" else "fut"
+        df = clean_legacy_fut_opt(market_code=market_code, report_type=report_type, legacy_df=report_df)
+    else:
+        fut_opt = "opt" if report == "disaggregated_futopt" else "fut"
+        df = clean_disagg_fut_opt(market_code=market_code, columns_to_keep=columns_to_keep, fut_opt=fut_opt,
+                                  disaggregated_futopt=report_df).reset_index()
+        df["Report_Type"] = report
+    return rows_after(df, revision_start(last_date))
+
+
+def get_legacy_fut_opt(market_code: str, report_type: Optional[str] = "opt", hist: Optional[bool] = True,
+                       legacy_df: Optional[pd.DataFrame] = None) -> None:
     """
     Download and get COT legacy futures/options data for a given market code, and optionally store it locally.
 
@@ -27,45 +111,52 @@ def get_legacy_fut_opt(market_code: str, report_type: Optional[str] = "opt", his
         market_code: A string representing the CFTC contract market code for the desired data.
         report_type: A string indicating the type of data to download ("opt" or "fut").
             Defaults to "opt".
-        hist: A boolean indicating whether to compare downloaded data to previously stored data and only keep new data.
-            If False, all downloaded data is kept.
+        hist: A boolean indicating whether to load the full history.
+            If False, only the archives from the year of the last loaded report date on are fetched, and only
+            report dates after it are stored.
             Defaults to True.
+        legacy_df: Optional rows of the legacy report already split out for `market_code`, as produced by
+            `reports.get_market_frames`. If None, they are taken from the report downloaded for this run.
     Returns:
-        None. The function saves the downloaded data to a CSV file in a specified directory.
+        None. The function saves the downloaded data to the local parquet store and the database.
+
+    """
+    report = LEGACY_REPORTS[report_type]
+    last_date = None if hist else get_watermark(market_code, report)
+    legacy_df = clean_legacy_fut_opt(market_code=market_code, report_type=report_type, legacy_df=legacy_df,
+                                     since_year=last_date.year if last_date else None)
+
+    # Keep only the report dates after the last loaded one, and the recent ones that may have been revised,
+    # if historical data is not to be kept
+    legacy_df = rows_after(legacy_df, revision_start(last_date))
 
+    # Save data to file and move the high-water mark forward
+    save_new_rows(df=legacy_df, mapper=Legacy, market_code=market_code, report_type=report)
+
+
+def clean_legacy_fut_opt(market_code: str, report_type: Optional[str] = "opt", legacy_df: Optional[pd.DataFrame] = None,
+                         since_year: Optional[int] = None) -> pd.DataFrame:
+    """
+    Cleans the COT legacy futures/options data for a given market code.
+
+    Args:
+        market_code: A string representing the CFTC contract market code for the desired data.
+        report_type: A string indicating the type of data to clean ("opt" or "fut"). Defaults to "opt".
+        legacy_df: Optional rows of the legacy report already split out for `market_code`. If None, they are
+            taken from the report downloaded for this run.
+        since_year: Only fetch the archives from this year on when `legacy_df` is None. Defaults to None, the full history.
+    Returns:
+        pd.DataFrame: The cleaned rows, with "Date", "Market_Code" and "Report_Type" columns.
     """
     # Download and filter data based on report_type and market_code
-    if report_type == "fut":
-        legacy_fut = cot.cot_all(cot_report_type='legacy_fut')
-        legacy_df = legacy_fut[legacy_fut['CFTC Contract Market Code'] == market_code]
-        legacy_df["Report_Type"] = "legacy_fut"
-        filename = "legacy_fut_" + market_code + ".csv"
-    elif report_type == "opt":
-        legacy_futopt = cot.cot_all(cot_report_type='legacy_futopt')
-        legacy_df = legacy_futopt[legacy_futopt['CFTC Contract Market Code'] == market_code]
-        legacy_df["Report_Type"] = "legacy_futopt"
-        filename = "legacy_futopt_" + market_code + ".csv"
-
-    # Clean up column names and format date/time information
-    legacy_df.columns = legacy_df.columns.str.replace(' ', '_').str.replace("(", "").str.replace(")", "") \
-        .str.replace("-", "_").str.replace("%", "Per").str.replace("=", "")
-    legacy_df.sort_values(by='As_of_Date_in_Form_YYYY_MM_DD', ascending=True, inplace=True)
-    legacy_df.set_index('As_of_Date_in_Form_YYYY_MM_DD', inplace=True)
-    legacy_df = legacy_df.replace(".", np.nan)
-    legacy_df.index.name = 'Date'
-    legacy_df["Market_Code"] = market_code
-    legacy_df.reset_index(inplace=True)
-
-    # Check if historical data is to be kept or not, and store new data if applicable
-    if not hist or hist == False:
-        read_path = (Path(__file__).resolve().parent).joinpath("FILEDB", filename)
-        compare_df = pd.read_csv(read_path)
-        compare_df = compare_df.drop_duplicates()
-        legacy_df.reset_index(inplace=True)
-        legacy_df = legacy_df[~legacy_df["Date"].isin(compare_df["Date"])]
-
-    # Save data to file
-    save_to_dir(df=legacy_df, directory="FILEDB", filename=filename, mapper=Legacy)
+    report = LEGACY_REPORTS[report_type]
+    if legacy_df is None:
+        legacy_df = get_market_frame(report, market_code, since_year)
+
+    # Rename the columns to the model names, parse the dates and convert the numeric columns
+    legacy_df = normalize_report(legacy_df, report, market_code).sort_values(by="Date", ignore_index=True)
+
+    return legacy_df
 
 
 def get_supplemental(market_code: str) -> pd.DataFrame:
@@ -78,9 +169,7 @@ def get_supplemental(market_code: str) -> pd.DataFrame:
     Returns:
         pd.DataFrame: A pandas DataFrame containing the Supplemental COT data for the specified market.
     """
-    supplemental_futopt = cot.cot_all(cot_report_type='supplemental_futopt')
-    supplemental_futopt = supplemental_futopt[supplemental_futopt['CFTC_Contract_Market_Code'] == market_code]
-    return supplemental_futopt
+    return normalize_report(get_market_frame('supplemental_futopt', market_code), 'supplemental_futopt', market_code)
 
 
 def get_financial_futures(market_code: str) -> pd.DataFrame:
@@ -94,15 +183,8 @@ def get_financial_futures(market_code: str) -> pd.DataFrame:
         pd.DataFrame: A pandas DataFrame containing the TFF data for the specified financial futures market.
     """
     # Note: there is no TFF data available for lumber futures
-    traders_in_financial_futures_fut = cot.cot_all(cot_report_type='traders_in_financial_futures_fut')
-    traders_in_financial_futures_fut = traders_in_financial_futures_fut[traders_in_financial_futures_fut['CFTC_Contract_Market_Code'] == market_code]
-    return traders_in_financial_futures_fut
-
-
-
-
+    return normalize_report(get_market_frame('traders_in_financial_futures_fut', market_code), 'traders_in_financial_futures_fut', market_code)
 
-from cot import cot
 
 def get_financial_futures_options(market_code: str) -> pd.DataFrame:
     """
@@ -114,19 +196,22 @@ def get_financial_futures_options(market_code: str) -> pd.DataFrame:
     Returns:
         pd.DataFrame: A pandas DataFrame containing the TFF data for the specified financial futures options market.
     """
-    traders_in_financial_futures_futopt = cot.cot_all(cot_report_type='traders_in_financial_futures_futopt')
-    traders_in_financial_futures_futopt = traders_in_financial_futures_futopt[traders_in_financial_futures_futopt['CFTC_Contract_Market_Code'] == market_code]
-    return traders_in_financial_futures_futopt
+    return normalize_report(get_market_frame('traders_in_financial_futures_futopt', market_code), 'traders_in_financial_futures_futopt', market_code)
 
 
-def clean_disagg_fut_opt(market_code, columns_to_keep=None, fut_opt='opt'):
+def clean_disagg_fut_opt(market_code, columns_to_keep=None, fut_opt='opt', disaggregated_futopt=None, since_year=None):
     """
     Cleans the disaggregated futures and options data for the specified market code.
 
     Args:
         market_code (str): The CFTC market code for the desired market.
-        columns_to_keep (list, optional): List of columns to keep. Defaults to None, which keeps all columns.
+        columns_to_keep (list, optional): List of columns to keep. Defaults to None, which keeps all columns. The
+            columns of `DERIVED_COLUMNS` are always computed, so the columns they are computed from are kept too.
         fut_opt (str, optional): Type of data to clean, either 'fut' for futures or 'opt' for options. Defaults to 'opt'.
+        disaggregated_futopt (pandas.DataFrame, optional): Rows of the disaggregated report already split out for
+            `market_code`. Defaults to None, which takes them from the report downloaded for this run.
+        since_year (int, optional): Only fetch the archives from this year on when `disaggregated_futopt` is None.
+            Defaults to None, the full history.
 
     Returns:
         pandas.DataFrame: The cleaned disaggregated futures and options data.
@@ -134,117 +219,218 @@ def clean_disagg_fut_opt(market_code, columns_to_keep=None, fut_opt='opt'):
     
     # Select the appropriate data based on fut_opt value
     if fut_opt == "opt":
-        disaggregated_futopt = cot.cot_all(cot_report_type='disaggregated_futopt')
+        report = 'disaggregated_futopt'
     elif fut_opt == "fut":
-        disaggregated_futopt = cot.cot_all(cot_report_type='disaggregated_fut')
+        report = 'disaggregated_fut'
     else:
-        print("Wrong_choice for fut_opt")
+        logger.error("Wrong_choice for fut_opt")
         return None
-    
-    # Filter data by market code, sort and set index to date
-    disaggregated_futopt = disaggregated_futopt[disaggregated_futopt['CFTC_Contract_Market_Code']==market_code]
-    disaggregated_futopt.sort_values(by='Report_Date_as_YYYY-MM-DD', ascending=True, inplace=True)
-    disaggregated_futopt.set_index('Report_Date_as_YYYY-MM-DD', inplace=True)
-    disaggregated_futopt.index.name = 'Date'
-    
-    # Keep only the desired columns, if specified
+
+    # Take the rows of this market code
+    if disaggregated_futopt is None:
+        disaggregated_futopt = get_market_frame(report, market_code, since_year)
+
+    # Keep only the desired columns, if specified, before any conversion. The columns the derived ones are
+    # computed from are always kept.
     if columns_to_keep:
-        disaggregated_futopt = disaggregated_futopt[columns_to_keep]
-    
-    # Calculate net speculative length and percent of open interest for commercial and non-commercial traders
-    if fut_opt == "opt":
-        disaggregated_futopt['Net_Spec_Length_Cal'] = disaggregated_futopt['M_Money_Positions_Long_All'] - disaggregated_futopt['M_Money_Positions_Short_All']
-        disaggregated_futopt['Pct_of_OI_MM_NSL'] = disaggregated_futopt['Pct_of_OI_M_Money_Long_All'] - disaggregated_futopt['Pct_of_OI_M_Money_Short_All']
-    elif fut_opt == "fut":
-        disaggregated_futopt['Net_Spec_Length'] = disaggregated_futopt['M_Money_Positions_Long_All'] - disaggregated_futopt['M_Money_Positions_Short_All']
-        disaggregated_futopt['Pct_of_OI_MM_NSL'] = disaggregated_futopt['Pct_of_OI_M_Money_Long_All'] - disaggregated_futopt['Pct_of_OI_M_Money_Short_All']
-    
-    # Convert index to datetime and sort in descending order
-    disaggregated_futopt.index = pd.DatetimeIndex(disaggregated_futopt.index)
-    disaggregated_futopt.sort_index(ascending=False, inplace=True)
-    
-    # Replace dots with NaNs and add market code column
-    disaggregated_futopt = disaggregated_futopt.replace('.', np.nan)
-    disaggregated_futopt["Market_Code"] = market_code
-    
+        needed = [DATE_COLUMNS[report]] + report_columns(report, columns_to_keep)
+        disaggregated_futopt = disaggregated_futopt[[c for c in dict.fromkeys(needed) if c in disaggregated_futopt.columns]]
+
+    # Convert the numeric columns, then calculate net speculative length and its percent of open interest
+    disaggregated_futopt = normalize_report(disaggregated_futopt, report, market_code)
+    disaggregated_futopt = disaggregated_futopt.assign(**{name: disaggregated_futopt[long] - disaggregated_futopt[short]
+                                                         for name, (long, short) in DERIVED_COLUMNS.items()})
+
+    # Set index to date, sorted in descending order
+    disaggregated_futopt = disaggregated_futopt.set_index('Date').sort_index(ascending=False)
+
     return disaggregated_futopt
 
 
-def delayed_cot_df(lag=4):
-    _ , disaggregated_futopt = clean_disagg_fut_opt()
-    cot_df = disaggregated_futopt.copy(deep=True)
-    cot_df.index = cot_df.index.map(lambda x : x + lag*BDay())
-    cot_df = cot_df.resample('B').ffill()
-    cot_df.sort_index(ascending=False, inplace=True)
-    last_row_values = cot_df.sort_index(ascending=False).iloc[0]
+@lru_cache(maxsize=None)
+def exchange_calendar(name: str = "CME_Agriculture"):
+    """
+    Returns the `pandas_market_calendars` calendar of an exchange, built once per run.
+    """
+    return mcal.get_calendar(name)
+
+
+@lru_cache(maxsize=256)
+def trading_days(calendar: str, start: pd.Timestamp, end: pd.Timestamp) -> pd.DatetimeIndex:
+    """
+    Returns the valid trading days of an exchange between `start` and `end` (inclusive), as naive dates.
+    Computed once per exchange and date range.
+    """
+    return exchange_calendar(calendar).valid_days(start_date=start, end_date=end).tz_localize(None).normalize()
+
+
+def delayed_cot_df(cot_df: pd.DataFrame, lag: int = 4, calendar: str = "CME_Agriculture", end: Optional[date] = None) -> pd.DataFrame:
+    """
+    Aligns report rows on the days they could be traded on: each report date is moved `lag` business days
+    forward (the report of a Tuesday is released on Friday and usable from the next Monday with the default
+    lag), then the rows are spread over the trading days of `calendar`, each day taking the last report
+    released by then.
 
-    yesterday = pd.to_datetime(date.today().strftime('%Y-%m-%d')) - pd.DateOffset(days=1)
-    today = pd.to_datetime(date.today().strftime('%Y-%m-%d'))
-    cme = mcal.get_calendar("CME_Agriculture")
-    extra_days = cme.valid_days(start_date=pd.to_datetime(cot_df.sort_index(ascending=False).index[0]) + pd.DateOffset(days=1), end_date=yesterday) # can change it to today also if required
+    Args:
+        cot_df (pd.DataFrame): Report rows indexed by report date, as returned by `clean_disagg_fut_opt`.
+        lag (int, optional): Business days between a report date and the first day it can be used. Defaults to 4.
+        calendar (str, optional): `pandas_market_calendars` exchange name. Defaults to "CME_Agriculture".
+        end (date, optional): Last trading day to fill. Defaults to yesterday.
 
-    extra_days = extra_days.strftime('%Y-%m-%d')
+    Returns:
+        pd.DataFrame: One row per trading day from the first release on, sorted in descending order.
+    """
+    if cot_df.empty:
+        return cot_df
 
-    for new_dt in extra_days:
-        for col in cot_df.columns: cot_df.loc[new_dt,col] = last_row_values[col]
+    released = cot_df.sort_index()
+    released.index = pd.DatetimeIndex(released.index) + lag * BDay()
 
-    cot_df.sort_index(ascending=False, inplace=True)
+    end = pd.Timestamp(end) if end is not None else pd.Timestamp(date.today()) - pd.DateOffset(days=1)
+    first = released.index[0]
+    # the calendar is cached from the start of the first release year, which markets mostly share
+    days = trading_days(calendar, pd.Timestamp(first.year, 1, 1), end)
+    days = days[days.searchsorted(first):][::-1]
 
-    return cot_df
+    # a single take, already in descending order, picks the last release at or before each trading day
+    return released.take(released.index.get_indexer(days, method="ffill")).set_axis(days.rename("Date"))
 
 
 def populate_data(market_code: str, columns_to_keep: list[str] = None, hist: bool = True, fut_opt: str = "opt",
-                  file_to_save: str = "disaggregated-futures-options") -> None:
+                  report_df: pd.DataFrame = None) -> None:
     """
     Populates the data for a specified market code and type of data (futures/options) by cleaning and preprocessing
-    the data, saving it to a file, and comparing it to existing data if needed.
+    the data, saving it to the local parquet store and the database, and comparing it to existing data if needed.
 
     Args:
         market_code (str): Market code to retrieve data for.
         columns_to_keep (List[str], optional): List of columns to keep in the resulting DataFrame. Defaults to None.
-        hist (bool, optional): Whether to save the data to a historical file and compare to existing data. Defaults to True.
+        hist (bool, optional): Whether to load the full history. If False, only the archives from the year of the last
+            loaded report date on are fetched, and only report dates after it are stored. Defaults to True.
         fut_opt (str, optional): Type of data to retrieve, either "fut" for futures or "opt" for options. Defaults to "opt".
-        file_to_save (str, optional): Name of the file to save the data to. Defaults to "disaggregated-futures-options".
+        report_df (pd.DataFrame, optional): Rows of the disaggregated report already split out for `market_code`.
+            Defaults to None, which takes them from the report downloaded for this run.
     """
-    df = clean_disagg_fut_opt(market_code=market_code, fut_opt=fut_opt, columns_to_keep=columns_to_keep)
-    df.reset_index(inplace=True)
-    if fut_opt == "opt":
-        f_name = file_to_save + "_" + market_code + "_opt.csv"
-        df["Report_Type"] = "disaggregated_futopt"
-    elif fut_opt == "fut":
-        f_name = file_to_save + "_" + market_code + "_fut.csv"
-        df["Report_Type"] = "disaggregated_fut"
-    if hist:
-        save_to_dir(df=df, directory="FILEDB", filename=f_name, mapper=DisaggregatedFuturesOptions)
-    else:
-        read_path = (Path(__file__).resolve().parent).joinpath("FILEDB", f_name)
-        compare_df = pd.read_csv(read_path)
-        compare_df = compare_df.drop_duplicates()
-        df = df[~df["Date"].isin(compare_df["Date"])]
-        save_to_dir(df=df, directory="FILEDB", filename=f_name, mapper=DisaggregatedFuturesOptions)
-
-
-
-logger.info("Running cod script on {}".format(date.today()))
-try:
-    logger.info("cleaning cot data")
-    clean_db()
-    logger.info("migrating cot tables")
-    migrate_models()
-    Lumber_code = '058643'
-    columns_to_keep =['Open_Interest_All','Prod_Merc_Positions_Long_All','Prod_Merc_Positions_Short_All','M_Money_Positions_Long_All','M_Money_Positions_Short_All','M_Money_Positions_Spread_All','Tot_Rept_Positions_Long_All','Tot_Rept_Positions_Short_All','Change_in_Open_Interest_All','Change_in_Prod_Merc_Long_All','Change_in_Prod_Merc_Short_All','Change_in_M_Money_Long_All','Change_in_M_Money_Short_All','Pct_of_Open_Interest_All','Pct_of_OI_Prod_Merc_Long_All','Pct_of_OI_Prod_Merc_Short_All','Pct_of_OI_M_Money_Long_All','Pct_of_OI_M_Money_Short_All','Pct_of_OI_M_Money_Spread_All']
-    populate_data(market_code=Lumber_code,columns_to_keep=None,hist=True,fut_opt="opt")
-    populate_data(market_code=Lumber_code,columns_to_keep=None,hist=True,fut_opt="fut")
-    get_legacy_fut_opt(market_code=Lumber_code,report_type="opt",hist=True)
-    get_legacy_fut_opt(market_code=Lumber_code,report_type="fut",hist=True)
+    report = DISAGGREGATED_REPORTS[fut_opt]
+    last_date = None if hist else get_watermark(market_code, report)
+    if report_df is None:
+        report_df = get_market_frame(report, market_code, since_year=last_date.year if last_date else None)
+    df = prepare_report_rows(report, market_code, report_df=report_df, last_date=last_date, columns_to_keep=columns_to_keep)
+    save_new_rows(df=df, mapper=DisaggregatedFuturesOptions, market_code=market_code, report_type=report)
 
-    
 
-    logger.info("Successfully populated data for {}".format(Lumber_code))
+def save_new_rows(df: pd.DataFrame, mapper, market_code: str, report_type: str) -> tuple:
+    """
+    Saves the new and revised report rows to the local parquet store and the database, with their values in
+    long format in the position_facts table (see facts.py), then moves the high-water mark of the market
+    forward to the latest stored report date, refreshes its latest report snapshot and bumps the data version
+    read caches are invalidated by.
 
-except Exception as e:
-   
-    logger.error("Error in running cod script on {}".format(date.today()))
-    logger.error(e)
+    The rows are compared with the stored ones by row hash first (see `diff_new_rows`): unchanged rows are not
+    written again, and revised ones are recorded in the revision_log table. The positioning analytics of
+    revised markets are to be recomputed from the first revised date, see `analytics.refresh_analytics`.
 
+    Args:
+        df (pd.DataFrame): Cleaned report rows with a "Date" column.
+        mapper: The mapper class of the database table.
+        market_code (str): The CFTC contract market code of the rows.
+        report_type (str): The report type of the rows, e.g. "legacy_fut".
 
+    Returns:
+        tuple: (inserted, updated) database row counts and the first revised report date, None without revisions.
+    """
+    changed, revisions = diff_new_rows(df, mapper, market_code, report_type)
+    return write_new_rows(changed, revisions, mapper, market_code, report_type)
+
+
+def diff_new_rows(df: pd.DataFrame, mapper, market_code: str, report_type: str) -> tuple:
+    """
+    Keeps the report rows that are new or revised compared with the rows stored in the table loads of `mapper`
+    go to, see `revisions.changed_rows`. Nothing is written.
+
+    Returns:
+        tuple: (rows to save, revisions for `revisions.log_revisions`)
+    """
+    if df.empty:
+        return df, pd.DataFrame(columns=["Date"])
+    with stage("diff", market_code=market_code, report_type=report_type, rows=len(df)) as record:
+        changed, revisions = changed_rows(df, mapper, market_code, report_type)
+        record["changed"], record["revised"] = len(changed), len(revisions)
+    return changed, revisions
+
+
+def write_new_rows(df: pd.DataFrame, revisions: pd.DataFrame, mapper, market_code: str, report_type: str) -> tuple:
+    """
+    Writes the rows and revisions found by `diff_new_rows`, see `save_new_rows`. Every step but the last,
+    logging the revisions, can run again, so a failed write is retried with the same rows and revisions rather
+    than diffing again against rows that were already stored.
+
+    Returns:
+        tuple: (inserted, updated) database row counts and the first revised report date, None without revisions.
+    """
+    if df.empty:
+        logger.info("No new or revised {} report dates for {}".format(report_type, market_code))
+        return 0, 0, None
+
+    inserted, updated = save_to_store(df=df, mapper=mapper)
+    with stage("facts", market_code=market_code, report_type=report_type) as record:
+        record["rows"] = save_facts(df, mapper)
+    with stage("snapshot", market_code=market_code, report_type=report_type):
+        set_watermark(market_code, report_type, pd.to_datetime(df["Date"]).max().date())
+        refresh_latest(mapper, market_code, report_type)
+        bump_data_version()
+        log_revisions(revisions)
+    revised_from = pd.to_datetime(revisions["Date"]).min().date() if len(revisions) else None
+    return inserted, updated, revised_from
+
+
+def first_year_to_fetch(report_type: str, market_codes: Optional[list[str]], last_dates: Optional[dict] = None) -> Optional[int]:
+    """
+    Returns the first archive year an incremental run needs for these markets: the year of the oldest
+    high-water mark, or None (the full history) if any of the markets was never loaded. Loading every market
+    of the report (`market_codes` None) always needs the full history, for the markets new to it.
+
+    Args:
+        report_type (str): The report type, e.g. "legacy_fut".
+        market_codes (List[str], optional): CFTC contract market codes, None for every market.
+        last_dates (dict, optional): The high-water marks of the markets when already read, see
+            `get_watermarks`. Defaults to None, read from the database.
+    """
+    if market_codes is None:
+        return None
+    if last_dates is None:
+        last_dates = get_watermarks(report_type, market_codes)
+    if not market_codes or any(code not in last_dates for code in market_codes):
+        return None
+    return min(last_dates[code] for code in market_codes).year
+
+
+def populate_markets(market_codes: list[str], columns_to_keep: list[str] = None, hist: bool = True) -> None:
+    """
+    Populates the disaggregated and legacy data of several markets, downloading each report type only once
+    and splitting it across the markets with a single groupby.
+
+    Args:
+        market_codes (List[str]): CFTC contract market codes to populate.
+        columns_to_keep (List[str], optional): Columns to keep from the disaggregated reports. Defaults to None.
+        hist (bool, optional): Passed through to `populate_data` and `get_legacy_fut_opt`. Defaults to True.
+    """
+    for fut_opt, report in (("opt", "disaggregated_futopt"), ("fut", "disaggregated_fut")):
+        frames = get_market_frames(report, market_codes, since_year=None if hist else first_year_to_fetch(report, market_codes),
+                                   columns=report_columns(report, columns_to_keep))
+        for market_code, report_df in frames.items():
+            populate_data(market_code=market_code, columns_to_keep=columns_to_keep, hist=hist, fut_opt=fut_opt,
+                          report_df=report_df)
+        release_report(report)
+
+    for report_type, report in (("opt", "legacy_futopt"), ("fut", "legacy_fut")):
+        frames = get_market_frames(report, market_codes, since_year=None if hist else first_year_to_fetch(report, market_codes))
+        for market_code, legacy_df in frames.items():
+            get_legacy_fut_opt(market_code=market_code, report_type=report_type, hist=hist, legacy_df=legacy_df)
+        release_report(report)
+
+
+if __name__ == "__main__":
+    # the markets to load are listed in markets.json, see pipeline.py
+    from pipeline import main
+    sys.exit(main())
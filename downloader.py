@@ -0,0 +1,286 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import zipfile
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import aiohttp
+except ImportError:
+    # without aiohttp the transfers run on a shared requests session, one worker thread per transfer
+    aiohttp = None
+
+logger = logging.getLogger(__name__)
+
+
+CHUNK_BYTES = 1024 * 1024
+
+# responses worth retrying, anything else but 200/206/304 fails the download at once
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+
+# longest wait between two attempts, in seconds
+MAX_BACKOFF = 60
+
+
+class DownloadError(Exception):
+    """Raised when a download fails for good."""
+
+
+class TransferError(Exception):
+    """Raised when an attempt fails in a way worth retrying: a retryable status, a truncated or corrupt file."""
+
+
+@dataclass
+class Download:
+    """
+    One file to download to `path`. `etag` and `last_modified` are the validators of the copy already held,
+    which make the request conditional; `sha256`, when known, is checked against the finished file.
+
+    The other fields are filled in by `download`: `status` becomes "downloaded", "not_modified" or "failed",
+    and `status_code` holds the HTTP status of the last response.
+    """
+    url: str
+    path: Path
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    sha256: Optional[str] = None
+    status: str = "pending"
+    status_code: Optional[int] = None
+    transferred: int = 0
+    attempts: int = 0
+    error: Optional[str] = None
+
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(CHUNK_BYTES), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def zip_is_intact(path: Path) -> bool:
+    """
+    Checks the CRC-32 of every member of a zip archive.
+    """
+    try:
+        with zipfile.ZipFile(path) as archive:
+            return archive.testzip() is None
+    except zipfile.BadZipFile:
+        return False
+
+
+def _part_paths(path: Path):
+    # the partial file, and the validators of the response it comes from, used to resume it
+    return path.with_name(path.name + ".part"), path.with_name(path.name + ".part.json")
+
+
+class _AiohttpTransport:
+    def __init__(self, per_host: int, timeout: int):
+        connector = aiohttp.TCPConnector(limit_per_host=per_host)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(
+            total=None, sock_connect=timeout, sock_read=timeout))
+
+    @asynccontextmanager
+    async def get(self, url, headers):
+        async with self.session.get(url, headers=headers) as response:
+            yield response.status, response.headers, response.content.iter_chunked(CHUNK_BYTES)
+
+    async def close(self):
+        await self.session.close()
+
+
+class _RequestsTransport:
+    def __init__(self, per_host: int, timeout: int):
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=per_host)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    @asynccontextmanager
+    async def get(self, url, headers):
+        response = await asyncio.to_thread(self.session.get, url, headers=headers, stream=True, timeout=self.timeout)
+        try:
+            yield response.status_code, response.headers, self._blocks(response)
+        finally:
+            response.close()
+
+    @staticmethod
+    async def _blocks(response):
+        blocks = response.iter_content(CHUNK_BYTES)
+        while True:
+            block = await asyncio.to_thread(next, blocks, None)
+            if block is None:
+                return
+            yield block
+
+    async def close(self):
+        self.session.close()
+
+
+def _retryable_errors():
+    errors = (TransferError, asyncio.TimeoutError, requests.RequestException, ConnectionError)
+    if aiohttp is not None:
+        errors += (aiohttp.ClientError,)
+    return errors
+
+
+def _expected_size(status, headers, offset):
+    """
+    Returns the full size of the file announced by a response, and the offset its body starts at.
+    """
+    if status == 206:
+        match = re.match(r"bytes (\d+)-\d+/(\d+|\*)", headers.get("Content-Range", ""))
+        if not match:
+            raise TransferError("invalid Content-Range {!r}".format(headers.get("Content-Range")))
+        start, total = int(match.group(1)), match.group(2)
+        return (int(total) if total != "*" else None), start
+    length = headers.get("Content-Length")
+    return (int(length) if length is not None else None), 0
+
+
+async def _attempt(transport, download: Download) -> None:
+    """
+    Makes one attempt at a download, resuming the partial file left by a previous attempt or run.
+    """
+    part, state_path = _part_paths(download.path)
+    state = None
+    if part.exists() and state_path.exists():
+        with open(state_path) as f:
+            state = json.load(f)
+        if state.get("url") != download.url:
+            state = None
+    offset = part.stat().st_size if state else 0
+
+    headers = {}
+    if offset:
+        headers["Range"] = "bytes={}-".format(offset)
+        # the server sends the whole file instead if it changed since the partial one was started
+        validator = state.get("etag") or state.get("last_modified")
+        if validator:
+            headers["If-Range"] = validator
+    else:
+        if download.etag:
+            headers["If-None-Match"] = download.etag
+        if download.last_modified:
+            headers["If-Modified-Since"] = download.last_modified
+
+    async with transport.get(download.url, headers) as (status, response_headers, blocks):
+        download.status_code = status
+        if status == 304:
+            download.status = "not_modified"
+            return
+        if status == 416:
+            # the partial file is no prefix of the current one, start over
+            part.unlink(missing_ok=True)
+            raise TransferError("range not satisfiable")
+        if status in RETRY_STATUSES:
+            raise TransferError("HTTP {}".format(status))
+        if status not in (200, 206):
+            raise DownloadError("HTTP {} for {}".format(status, download.url))
+
+        expected, start = _expected_size(status, response_headers, offset)
+        if status == 206 and start != offset:
+            raise TransferError("resumed at byte {} instead of {}".format(start, offset))
+        # a 200 to a Range request is the whole file: the server ignores ranges, or the file changed since
+        # the partial one was started and If-Range did not match. The partial file is rewritten from byte 0
+
+        etag, last_modified = response_headers.get("ETag"), response_headers.get("Last-Modified")
+        download.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(state_path, "w") as f:
+            json.dump({"url": download.url, "etag": etag, "last_modified": last_modified}, f)
+
+        with open(part, "ab" if start else "wb") as f:
+            async for block in blocks:
+                f.write(block)
+                download.transferred += len(block)
+
+    size = part.stat().st_size
+    if expected is not None and size != expected:
+        # the partial file is kept, the next attempt resumes it
+        raise TransferError("received {} of {} bytes".format(size, expected))
+
+    sha256 = await asyncio.to_thread(file_sha256, part)
+    intact = download.path.suffix != ".zip" or await asyncio.to_thread(zip_is_intact, part)
+    if not intact or (download.sha256 and sha256 != download.sha256):
+        part.unlink()
+        state_path.unlink(missing_ok=True)
+        raise TransferError("checksum mismatch for {}".format(download.url))
+
+    os.replace(part, download.path)
+    state_path.unlink(missing_ok=True)
+    download.status, download.sha256 = "downloaded", sha256
+    download.etag, download.last_modified = etag, last_modified
+
+
+async def _download(transport, limit: asyncio.Semaphore, download: Download, retries: int, backoff: float) -> None:
+    retryable = _retryable_errors()
+    for attempt in range(1, retries + 1):
+        download.attempts = attempt
+        try:
+            async with limit:
+                await _attempt(transport, download)
+            download.error = None
+            return
+        except DownloadError as e:
+            download.error = str(e)
+            break
+        except retryable as e:
+            download.error = repr(e)
+            logger.warning("downloading {} failed (attempt {}/{}): {!r}".format(download.url, attempt, retries, e))
+            if attempt < retries:
+                # exponential backoff with jitter, so retries of the same host do not line up
+                delay = min(backoff * 2 ** (attempt - 1), MAX_BACKOFF)
+                await asyncio.sleep(delay + random.uniform(0, delay))
+    download.status = "failed"
+
+
+async def download_all(downloads: list, per_host: int = 4, retries: int = 5, backoff: float = 1.0,
+                       timeout: int = 60) -> list:
+    """
+    Downloads files concurrently over one keep-alive session, at most `per_host` transfers per host at once.
+
+    Each download is retried on its own up to `retries` times with exponential backoff, on connection errors,
+    timeouts, 408/429/5xx responses and files failing their checks. A transfer cut short leaves a partial file
+    next to its destination, which the next attempt (or the next run) resumes with a Range request. A finished
+    file is checked against its announced size, the CRC-32 of its members for zip archives and `sha256` when
+    set, before it atomically replaces the destination.
+
+    Args:
+        downloads (list): `Download`s, updated in place.
+        per_host (int, optional): Concurrent transfers per host. Defaults to 4.
+        retries (int, optional): Attempts per download. Defaults to 5.
+        backoff (float, optional): Seconds before the first retry, doubled at each one. Defaults to 1.
+        timeout (int, optional): Seconds to connect, and to wait for each block of data. Defaults to 60.
+
+    Returns:
+        list: The downloads, failed ones with their `error`.
+    """
+    transport = (_AiohttpTransport if aiohttp is not None else _RequestsTransport)(per_host, timeout)
+    limits = {}
+    try:
+        await asyncio.gather(*[
+            _download(transport, limits.setdefault(urlsplit(d.url).netloc, asyncio.Semaphore(per_host)), d, retries, backoff)
+            for d in downloads])
+    finally:
+        await transport.close()
+    return downloads
+
+
+def download(downloads: list, **options) -> list:
+    """
+    Runs `download_all` to completion from synchronous code.
+    """
+    return asyncio.run(download_all(downloads, **options))
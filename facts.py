@@ -0,0 +1,197 @@
+import logging
+import threading
+from datetime import date
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import delete, func, select
+
+from common import coerce_to_schema
+from revisions import hashed_columns
+from backend.db.dbconnect import get_engine
+from backend.db.models import DisaggregatedFuturesOptions, Legacy, Metric, PositionFact
+from backend.db.upsert import append_dataframe
+
+logger = logging.getLogger(__name__)
+
+
+# trader categories appearing in the column names of the COT tables, in matching order. Metrics of no category
+# (open interest, trader totals, concentration ratios) are "Market"
+TRADER_CATEGORIES = ("Prod_Merc", "Swap", "M_Money", "Other_Rept", "Tot_Rept", "NonRept",
+                     "Noncommercial", "Commercial", "Total_Reportable", "Nonreportable")
+
+KEYS = ["Market_Code", "Report_Type", "Date"]
+
+# metric ids by (Table_Name, Name), per database url
+_METRIC_IDS = {}
+_LOCK = threading.Lock()
+
+
+def metric_category(name: str) -> str:
+    """
+    Returns the trader category a column reports on, e.g. "M_Money" for Change_in_M_Money_Long_All.
+    """
+    tokens = "_{}_".format(name)
+    for category in TRADER_CATEGORIES:
+        if "_{}_".format(category) in tokens:
+            return category
+    return "Market"
+
+
+def model_metrics(mappers=(DisaggregatedFuturesOptions, Legacy)) -> list:
+    """
+    Returns the metrics of the COT models, one per numeric column, as rows of the metric table.
+    """
+    return [{"Table_Name": mapper.__tablename__, "Name": name, "Category": metric_category(name)}
+            for mapper in mappers for name in hashed_columns(mapper, mapper.__table__.columns.keys())]
+
+
+def sync_metrics(engine=None) -> dict:
+    """
+    Adds the metrics of the COT models missing from the metric table, e.g. for a column added to a model.
+
+    Returns:
+        dict: Metric id by (Table_Name, Name).
+    """
+    engine = engine or get_engine()
+    metric = Metric.__table__
+    stmt = select(metric.c.Table_Name, metric.c.Name, metric.c.Id)
+    with engine.begin() as conn:
+        ids = {(table_name, name): id_ for table_name, name, id_ in conn.execute(stmt)}
+        missing = [row for row in model_metrics() if (row["Table_Name"], row["Name"]) not in ids]
+        if missing:
+            conn.execute(metric.insert(), missing)
+            logger.info("{} metrics added".format(len(missing)))
+            ids = {(table_name, name): id_ for table_name, name, id_ in conn.execute(stmt)}
+    return ids
+
+
+def metric_ids(engine=None) -> dict:
+    """
+    Returns the metric id by (Table_Name, Name), synced with the models once per process.
+    """
+    engine = engine or get_engine()
+    key = engine.url.render_as_string(hide_password=False)
+    with _LOCK:
+        if key not in _METRIC_IDS:
+            _METRIC_IDS[key] = sync_metrics(engine)
+        return _METRIC_IDS[key]
+
+
+def to_facts(df: pd.DataFrame, mapper, ids: dict) -> pd.DataFrame:
+    """
+    Turns report rows of the table of `mapper` into fact rows, one per non-missing numeric value.
+
+    Args:
+        df (pd.DataFrame): Report rows with "Date", "Market_Code" and "Report_Type" columns.
+        mapper: DisaggregatedFuturesOptions or Legacy.
+        ids (dict): Metric id by (Table_Name, Name), see `metric_ids`.
+
+    Returns:
+        pd.DataFrame: Rows named like PositionFact.
+    """
+    df = coerce_to_schema(df, mapper)
+    names = hashed_columns(mapper, df.columns)
+    values = df[names].to_numpy(dtype="float64", na_value=np.nan)
+    rows, columns = np.nonzero(~np.isnan(values))
+
+    metric_id = np.array([ids[(mapper.__tablename__, name)] for name in names], dtype="int64")
+    facts = {key: df[key].to_numpy()[rows] for key in KEYS}
+    return pd.DataFrame({**facts, "Metric_Id": metric_id[columns], "Value": values[rows, columns]})
+
+
+def save_facts(df: pd.DataFrame, mapper, engine=None) -> int:
+    """
+    Loads the facts of report rows about to be (or just) loaded into the table of `mapper`. The facts already
+    stored for their report dates are replaced in the same transaction, so values missing from a revised
+    report do not linger, and the new ones are appended without the merge of an upsert.
+
+    Returns:
+        int: Number of facts written.
+    """
+    if df.empty:
+        return 0
+    engine = engine or get_engine()
+    facts = to_facts(df, mapper, metric_ids(engine))
+
+    fact = PositionFact.__table__
+    dates = df.assign(Date=pd.to_datetime(df["Date"]).dt.date).groupby(["Market_Code", "Report_Type"])["Date"]
+    with engine.begin() as conn:
+        for (market_code, report_type), report_dates in dates:
+            conn.execute(delete(fact).where(fact.c.Market_Code == market_code, fact.c.Report_Type == report_type,
+                                            fact.c.Date.in_(report_dates.unique().tolist())))
+        return append_dataframe(conn, fact, facts)
+
+
+def backfill_facts(mapper, engine=None) -> int:
+    """
+    Loads the facts of every row already in the table of `mapper`, one year at a time.
+
+    Returns:
+        int: Number of facts written.
+    """
+    engine = engine or get_engine()
+    table = mapper.__table__
+    columns = [table.c[name] for name in KEYS + hashed_columns(mapper, table.columns.keys())]
+    with engine.connect() as conn:
+        first, last = conn.execute(select(func.min(table.c.Date), func.max(table.c.Date))).one()
+    if first is None:
+        return 0
+
+    written = 0
+    for year in range(pd.Timestamp(first).year, pd.Timestamp(last).year + 1):
+        with engine.connect() as conn:
+            result = conn.execute(select(*columns).where(table.c.Date >= date(year, 1, 1), table.c.Date < date(year + 1, 1, 1)))
+            df = pd.DataFrame(result.fetchall(), columns=list(result.keys()))
+        written += save_facts(df, mapper, engine)
+    logger.info("{} facts written for {}".format(written, table.name))
+    return written
+
+
+def read_facts(metrics: list, start=None, end=None, market_codes: list = None, report_types: list = None,
+               engine=None) -> pd.DataFrame:
+    """
+    Reads a few metrics across markets from the position_facts table, through its (Metric_Id, Date, Market_Code)
+    index, e.g. the managed money longs of every market over the last 5 years.
+
+    Args:
+        metrics (list): Metric names, i.e. numeric column names of the COT tables.
+        start (date, optional): First report date. Defaults to None, the first stored.
+        end (date, optional): Last report date. Defaults to None, the last stored.
+        market_codes (list, optional): Defaults to None, every market.
+        report_types (list, optional): Defaults to None, every report type.
+        engine (Engine, optional): Defaults to the COT database engine.
+
+    Returns:
+        pd.DataFrame: Long rows with "Date", "Market_Code", "Report_Type", "Metric" and "Value" columns.
+    """
+    engine = engine or get_engine()
+    names = {id_: name for (_, name), id_ in metric_ids(engine).items() if name in set(metrics)}
+
+    fact = PositionFact.__table__
+    stmt = select(fact.c.Date, fact.c.Market_Code, fact.c.Report_Type, fact.c.Metric_Id, fact.c.Value) \
+        .where(fact.c.Metric_Id.in_(list(names)))
+    if start is not None:
+        stmt = stmt.where(fact.c.Date >= start)
+    if end is not None:
+        stmt = stmt.where(fact.c.Date <= end)
+    if market_codes is not None:
+        stmt = stmt.where(fact.c.Market_Code.in_(list(market_codes)))
+    if report_types is not None:
+        stmt = stmt.where(fact.c.Report_Type.in_(list(report_types)))
+
+    with engine.connect() as conn:
+        result = conn.execute(stmt)
+        df = pd.DataFrame(result.fetchall(), columns=list(result.keys()))
+    df = df.assign(Date=pd.to_datetime(df["Date"]), Metric_Id=df["Metric_Id"].map(names))
+    return df.rename(columns={"Metric_Id": "Metric"})
+
+
+def pivot_facts(facts: pd.DataFrame) -> pd.DataFrame:
+    """
+    Rebuilds the wide view of facts read with `read_facts`: one row per (Date, Market_Code, Report_Type) and
+    one column per metric, missing where the report has no value.
+    """
+    wide = facts.pivot(index=["Date", "Market_Code", "Report_Type"], columns="Metric", values="Value")
+    wide.columns.name = None
+    return wide.reset_index()
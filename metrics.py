@@ -0,0 +1,144 @@
+import json
+import logging
+import os
+import resource
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Optional, Union
+
+logger = logging.getLogger(__name__)
+
+
+# counters summed per stage in the run report
+COUNTERS = ("bytes", "rows", "inserted", "updated")
+
+# records kept per run, the oldest are dropped past it (their totals are kept)
+DEFAULT_MAX_RECORDS = 100000
+
+
+def peak_rss_mib(children: bool = False) -> float:
+    """
+    Returns the peak resident set size of this process (or of its finished worker processes), in MiB.
+    """
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # ru_maxrss is in kilobytes on linux
+    return usage.ru_maxrss / 1024
+
+
+class RunMetrics:
+    """
+    Collects one record per stage of a run (download, parse, split, clean, store, db_load, ...), from any thread.
+    Worker processes collect their own records, which are merged into the run's with `extend`.
+
+    Only the last `max_records` records are kept (COT_METRICS_MAX_RECORDS, 100000 by default), so that a
+    long-lived process timing stages outside of any run does not grow without bound. The totals per stage and
+    per market still count every record.
+    """
+
+    def __init__(self, max_records: Optional[int] = None):
+        self.started = time.time()
+        if max_records is None:
+            max_records = int(os.getenv("COT_METRICS_MAX_RECORDS", DEFAULT_MAX_RECORDS))
+        self.records = deque(maxlen=max_records)
+        self.dropped = 0
+        self._stages, self._markets = {}, {}
+        self._lock = threading.Lock()
+
+    def _count(self, record):
+        totals = self._stages.setdefault(record["stage"], {"count": 0, "seconds": 0.0})
+        totals["count"] += 1
+        totals["seconds"] += record["seconds"]
+        for counter in COUNTERS:
+            if counter in record:
+                totals[counter] = totals.get(counter, 0) + record[counter]
+        if record.get("market_code"):
+            per_market = self._markets.setdefault(record["market_code"], {})
+            per_market[record["stage"]] = per_market.get(record["stage"], 0.0) + record["seconds"]
+        if len(self.records) == self.records.maxlen:
+            self.dropped += 1
+        self.records.append(record)
+
+    def add(self, record: dict) -> None:
+        with self._lock:
+            self._count(record)
+
+    def extend(self, records: list) -> None:
+        with self._lock:
+            for record in records:
+                self._count(record)
+
+    def report(self, **extra) -> dict:
+        """
+        Returns the run report: the run duration and peak memory, then totals per stage and seconds per stage
+        per market, then the records kept and the number dropped.
+        """
+        with self._lock:
+            records = list(self.records)
+            stages = {name: dict(totals) for name, totals in self._stages.items()}
+            markets = {code: dict(per_market) for code, per_market in self._markets.items()}
+            dropped = self.dropped
+
+        return {
+            "started": datetime.fromtimestamp(self.started).isoformat(timespec="seconds"),
+            "seconds": time.time() - self.started,
+            "peak_rss_mib": peak_rss_mib(),
+            "workers_peak_rss_mib": peak_rss_mib(children=True),
+            "stages": stages,
+            "markets": markets,
+            "records": records,
+            "dropped_records": dropped,
+            **extra,
+        }
+
+    def write(self, path: Union[str, Path], **extra) -> dict:
+        """
+        Writes the run report to a JSON file and returns it.
+        """
+        report = self.report(**extra)
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2, default=str)
+        return report
+
+
+_RUN = RunMetrics()
+
+
+def get_run_metrics() -> RunMetrics:
+    """
+    Returns the metrics of the current run in this process.
+    """
+    return _RUN
+
+
+def start_run() -> RunMetrics:
+    """
+    Starts collecting the metrics of a new run in this process, e.g. at the start of a worker task. The records
+    of the previous run are released.
+    """
+    global _RUN
+    _RUN = RunMetrics()
+    return _RUN
+
+
+@contextmanager
+def stage(name: str, **fields):
+    """
+    Times a stage of the run and records it, with `fields` (market_code, report_type, ...) and the counters
+    the block sets on the yielded record, e.g. `record["rows"] = len(df)`. A failing stage is recorded with
+    its error.
+    """
+    record = dict(fields)
+    start = time.perf_counter()
+    try:
+        yield record
+    except Exception as e:
+        record["error"] = repr(e)
+        raise
+    finally:
+        record.update(stage=name, seconds=time.perf_counter() - start, pid=os.getpid(), peak_rss_mib=peak_rss_mib())
+        _RUN.add(record)
@@ -0,0 +1,145 @@
+import argparse
+import json
+import logging
+from datetime import date
+from pathlib import Path
+from typing import Iterable, Optional, Union
+
+import numpy as np
+import pandas as pd
+from numpy.lib.format import open_memmap
+from pandas.tseries.offsets import BDay
+
+from cot import trading_days
+from parquet_store import KEYS, read_rows
+
+logger = logging.getLogger(__name__)
+
+
+# business days between a report date (Tuesday) and the first day it can be traded on (the Monday after its
+# Friday afternoon release), as in cot.delayed_cot_df
+RELEASE_LAG = 4
+
+
+def release_dates(report_dates, lag: int = RELEASE_LAG) -> pd.DatetimeIndex:
+    """
+    Returns the first day each report date can be used on, `lag` business days after it.
+    """
+    return pd.DatetimeIndex(report_dates) + lag * BDay()
+
+
+def build_panel(report_type: str = "disaggregated_futopt", fields: Optional[list] = None,
+                market_codes: Optional[Iterable[str]] = None, start: Optional[date] = None, end: Optional[date] = None,
+                lag: int = RELEASE_LAG, calendar: str = "CME_Agriculture", rows: Optional[pd.DataFrame] = None) -> pd.DataFrame:
+    """
+    Builds a point-in-time daily panel of a report for every market at once.
+
+    Each trading day of `calendar` gets, for every market, the last report released by then: report dates are
+    moved `lag` business days forward and joined to the (trading day x market) grid with a single `merge_asof`
+    by market, so no value is visible before it was released.
+
+    Args:
+        report_type (str, optional): The report type. Defaults to "disaggregated_futopt".
+        fields (list, optional): Numeric columns to include. Defaults to None, every numeric column.
+        market_codes (Iterable[str], optional): Markets to include. Defaults to None, every stored market.
+        start (date, optional): First trading day of the panel. Defaults to the first release.
+        end (date, optional): Last trading day of the panel. Defaults to yesterday.
+        lag (int, optional): Business days from a report date to the first day it can be used. Defaults to 4.
+        calendar (str, optional): `pandas_market_calendars` exchange name. Defaults to "CME_Agriculture".
+        rows (pd.DataFrame, optional): Report rows with "Date" and "Market_Code" columns. Defaults to None,
+            which reads them from the local parquet store.
+
+    Returns:
+        pd.DataFrame: Indexed by (Date, Market_Code) over the full grid, dates ascending, with a "Report_Date"
+            column holding the report each row comes from (NaT before a market's first release) and one
+            column per field.
+    """
+    if rows is None:
+        columns = None if fields is None else list(dict.fromkeys(["Date", "Market_Code"] + list(fields)))
+        rows = read_rows(report_type, market_codes, end=end, columns=columns)
+    elif market_codes is not None:
+        rows = rows[rows["Market_Code"].isin(list(market_codes))]
+
+    if fields is None:
+        fields = [c for c in rows.columns if c not in KEYS and pd.api.types.is_numeric_dtype(rows[c])]
+
+    end = pd.Timestamp(end) if end is not None else pd.Timestamp(date.today()) - pd.DateOffset(days=1)
+    rows = rows[["Date", "Market_Code"] + list(fields)].rename(columns={"Date": "Report_Date"})
+    rows = rows.assign(Report_Date=pd.to_datetime(rows["Report_Date"]).astype("datetime64[ns]"))
+    rows = rows.assign(Release_Date=release_dates(rows["Report_Date"], lag)).sort_values("Release_Date", kind="stable")
+
+    markets = pd.Index(sorted(rows["Market_Code"].unique()), name="Market_Code")
+    if rows.empty:
+        days = pd.DatetimeIndex([], name="Date")
+    else:
+        first = pd.Timestamp(start) if start is not None else rows["Release_Date"].iloc[0]
+        days = trading_days(calendar, pd.Timestamp(first.year, 1, 1), end)
+        days = days[days.searchsorted(first):].rename("Date").astype("datetime64[ns]")
+
+    grid = pd.MultiIndex.from_product([days, markets]).to_frame(index=False)
+    panel = pd.merge_asof(grid, rows, left_on="Date", right_on="Release_Date", by="Market_Code", direction="backward")
+
+    return panel.drop(columns="Release_Date").set_index(["Date", "Market_Code"])
+
+
+def panel_axes(panel: pd.DataFrame) -> dict:
+    """
+    Returns the labels of the (date, market, field) axes of a panel built by `build_panel`.
+    """
+    return {
+        "dates": panel.index.get_level_values("Date").unique().strftime("%Y-%m-%d").tolist(),
+        "markets": panel.index.get_level_values("Market_Code").unique().tolist(),
+        "fields": [c for c in panel.columns if c != "Report_Date"],
+    }
+
+
+def write_memmap(panel: pd.DataFrame, path: Union[str, Path]) -> np.memmap:
+    """
+    Writes a panel as a float64 (date x market x field) .npy array, missing values as NaN, with its axis labels
+    in a .json file next to it. The array can be opened without loading it with `np.load(path, mmap_mode="r")`.
+
+    Returns:
+        np.memmap: The written array.
+    """
+    path = Path(path).with_suffix(".npy")
+    axes = panel_axes(panel)
+    shape = (len(axes["dates"]), len(axes["markets"]), len(axes["fields"]))
+
+    array = open_memmap(path, mode="w+", dtype=np.float64, shape=shape)
+    # one field at a time, so only one column of the panel is converted at once
+    for i, field in enumerate(axes["fields"]):
+        array[:, :, i] = panel[field].to_numpy(dtype=np.float64, na_value=np.nan).reshape(shape[:2])
+    array.flush()
+
+    with open(path.with_suffix(".json"), "w") as f:
+        json.dump(axes, f)
+    return array
+
+
+def write_parquet(panel: pd.DataFrame, path: Union[str, Path]) -> Path:
+    """
+    Writes a panel as a single parquet file in long (Date, Market_Code) rows.
+    """
+    path = Path(path).with_suffix(".parquet")
+    panel.reset_index().to_parquet(path, index=False)
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a point-in-time daily COT panel for every stored market")
+    parser.add_argument("output", help="output file, .npy (memory-mapped array) or .parquet")
+    parser.add_argument("--report", default="disaggregated_futopt", help="report type (default: disaggregated_futopt)")
+    parser.add_argument("--fields", nargs="+", help="numeric columns to include (default: all)")
+    parser.add_argument("--markets", nargs="+", help="market codes to include (default: all)")
+    parser.add_argument("--start", type=date.fromisoformat, help="first trading day, YYYY-MM-DD")
+    parser.add_argument("--end", type=date.fromisoformat, help="last trading day, YYYY-MM-DD (default: yesterday)")
+    parser.add_argument("--lag", type=int, default=RELEASE_LAG, help="business days from report to release")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    panel = build_panel(args.report, args.fields, args.markets, args.start, args.end, args.lag)
+    if args.output.endswith(".parquet"):
+        written = write_parquet(panel, args.output)
+    else:
+        written = write_memmap(panel, args.output).filename
+    print("wrote a {} x {} panel to {}".format(len(panel), panel.shape[1], written))
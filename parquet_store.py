@@ -0,0 +1,160 @@
+import argparse
+import logging
+import os
+from datetime import date
+from pathlib import Path
+from typing import Iterable, Optional, Union
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+logger = logging.getLogger(__name__)
+
+
+# report rows are stored as one parquet file per report_type=<report>/market_code=<code>/year=<year> partition
+STORE_DIR = Path(os.getenv("COT_STORE_DIR") or Path(__file__).resolve().parent.joinpath("FILEDB", "parquet"))
+KEYS = ["Date", "Market_Code", "Report_Type"]
+PARTITIONING = ds.partitioning(pa.schema([("market_code", pa.string()), ("year", pa.int32())]), flavor="hive")
+
+
+def partition_path(root: Path, report_type: str, market_code: str, year: int) -> Path:
+    return root.joinpath("report_type=" + report_type, "market_code=" + market_code, "year={}".format(year), "data.parquet")
+
+
+def _arrow_friendly(df: pd.DataFrame) -> pd.DataFrame:
+    # object columns may mix numbers and strings, which parquet cannot store in one column
+    converted = {c: df[c].astype("string") for c in df.columns if df[c].dtype == object}
+    return df.assign(**converted)
+
+
+def write_rows(df: pd.DataFrame, root: Union[str, Path, None] = None) -> int:
+    """
+    Writes report rows to the store, merging them into the partitions they belong to.
+
+    Each touched partition is rewritten with the rows already stored there, keeping one row per
+    (Date, Market_Code, Report_Type); incoming rows replace stored ones with the same key.
+
+    Args:
+        df (pd.DataFrame): Rows with "Date", "Market_Code" and "Report_Type" columns.
+        root (str | Path, optional): Store location. Defaults to COT_STORE_DIR, or FILEDB/parquet.
+
+    Returns:
+        int: Number of rows in the partitions that were rewritten.
+    """
+    missing = [k for k in KEYS if k not in df.columns]
+    if missing:
+        raise ValueError("Missing key columns {}".format(missing))
+    if df.empty:
+        return 0
+
+    root = Path(root or STORE_DIR)
+    df = _arrow_friendly(df.assign(Date=pd.to_datetime(df["Date"])))
+    if "index" in df.columns:
+        df = df.drop(columns="index")
+
+    written = 0
+    for (report_type, market_code, year), part in df.groupby([df["Report_Type"], df["Market_Code"], df["Date"].dt.year], sort=False):
+        path = partition_path(root, report_type, market_code, year)
+        if path.exists():
+            part = pd.concat([pd.read_parquet(path), part], ignore_index=True)
+        part = part.drop_duplicates(subset=KEYS, keep="last").sort_values("Date", ignore_index=True)
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        part.to_parquet(tmp, index=False)
+        os.replace(tmp, path)
+        written += len(part)
+
+    return written
+
+
+def read_rows(report_type: str, market_codes: Optional[Iterable[str]] = None, start: Optional[date] = None,
+              end: Optional[date] = None, columns: Optional[list] = None, root: Union[str, Path, None] = None) -> pd.DataFrame:
+    """
+    Reads report rows from the store. Partitions outside the requested markets and years are never opened,
+    the date range is pushed down to the parquet row groups and only the requested columns are read.
+
+    Args:
+        report_type (str): The report type, e.g. "disaggregated_futopt".
+        market_codes (Iterable[str], optional): Market codes to read. Defaults to None, every market.
+        start (date, optional): First report date to read (inclusive).
+        end (date, optional): Last report date to read (inclusive).
+        columns (list, optional): Columns to read. Defaults to None, every column.
+        root (str | Path, optional): Store location. Defaults to COT_STORE_DIR, or FILEDB/parquet.
+
+    Returns:
+        pd.DataFrame: The matching rows, empty if nothing was stored.
+    """
+    base = Path(root or STORE_DIR).joinpath("report_type=" + report_type)
+    files = sorted(base.glob("market_code=*/year=*/*.parquet"))
+    if not files:
+        return pd.DataFrame(columns=columns or KEYS)
+
+    # partitions written at different times may disagree on a column type (e.g. int64 and double)
+    # and then the pandas dtypes recorded in the first file no longer hold
+    schema = pa.unify_schemas([pq.read_schema(f) for f in files], promote_options="permissive").remove_metadata()
+    for field in PARTITIONING.schema:
+        schema = schema.append(field)
+    dataset = ds.dataset(str(base), format="parquet", partitioning=PARTITIONING, schema=schema)
+
+    date_type = schema.field("Date").type
+    conditions = []
+    if market_codes is not None:
+        conditions.append(ds.field("market_code").isin(list(market_codes)))
+    if start is not None:
+        start = pd.Timestamp(start)
+        conditions += [ds.field("year") >= start.year, ds.field("Date") >= pa.scalar(start, type=date_type)]
+    if end is not None:
+        end = pd.Timestamp(end)
+        conditions += [ds.field("year") <= end.year, ds.field("Date") <= pa.scalar(end, type=date_type)]
+
+    expression = None
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+
+    return dataset.to_table(columns=columns or [f.name for f in schema if f.name not in PARTITIONING.schema.names],
+                            filter=expression).to_pandas()
+
+
+def migrate_csv_files(directory: Union[str, Path] = None, root: Union[str, Path, None] = None, remove: bool = False) -> dict:
+    """
+    Converts the append-only FILEDB CSV files into the parquet store, dropping the duplicate rows and the
+    index columns they accumulated.
+
+    Args:
+        directory (str | Path, optional): Folder holding the CSV files. Defaults to FILEDB.
+        root (str | Path, optional): Store location. Defaults to COT_STORE_DIR, or FILEDB/parquet.
+        remove (bool, optional): Delete each CSV file once converted. Defaults to False.
+
+    Returns:
+        dict: CSV file name -> number of rows in the partitions written from it.
+    """
+    directory = Path(directory or Path(__file__).resolve().parent.joinpath("FILEDB"))
+    converted = {}
+
+    for path in sorted(directory.glob("*.csv")):
+        df = pd.read_csv(path, low_memory=False, dtype={"Market_Code": str, "CFTC_Contract_Market_Code": str})
+        df = df.drop(columns=[c for c in df.columns if c.startswith("Unnamed:") or c in ("index", "level_0")])
+        if any(k not in df.columns for k in KEYS):
+            logger.warning("skipping {}, it has no {} columns".format(path.name, KEYS))
+            continue
+
+        converted[path.name] = write_rows(df, root)
+        logger.info("converted {} ({} rows)".format(path.name, len(df)))
+        if remove:
+            os.remove(path)
+
+    return converted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert the FILEDB CSV files into the parquet store")
+    parser.add_argument("--directory", help="folder holding the CSV files (default: FILEDB)")
+    parser.add_argument("--remove", action="store_true", help="delete each CSV file once converted")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    for name, rows in migrate_csv_files(args.directory, remove=args.remove).items():
+        print("{}: {} rows".format(name, rows))
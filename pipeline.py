@@ -0,0 +1,332 @@
+import argparse
+import cProfile
+import json
+import logging
+import os
+import pstats
+import sys
+import time
+import tracemalloc
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from dataclasses import asdict, dataclass
+from datetime import date
+from pathlib import Path
+from typing import Optional
+
+from analytics import refresh_analytics
+from archive_cache import archive_years, get_archive_cache
+from cot import REPORT_MAPPERS, diff_new_rows, first_year_to_fetch, prepare_report_rows, report_columns, write_new_rows
+from metrics import get_run_metrics, stage, start_run
+from reports import get_report, read_market_frames, release_report, split_by_market
+from backend.db.migrate_db import migrate_models
+from backend.db.migrations import rebuild_tables
+from backend.db.partitions import ensure_partitions
+from backend.db.snapshots import rebuild_latest
+from backend.db.versions import bump_data_version
+from backend.db.watermarks import get_watermarks
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_CONFIG = Path(__file__).resolve().parent.joinpath("markets.json")
+DEFAULT_REPORT = Path("logs", "run_report.json")
+DEFAULT_PROFILE_DIR = Path("logs", "profile")
+DEFAULT_LOG = Path("logs", "cot.log")
+
+# every market found in the reports, instead of an explicit list of market codes
+ALL_MARKETS = "all"
+
+
+@dataclass
+class TaskStatus:
+    """
+    Outcome of one (market, report) task: "loaded" (rows inserted or updated), "no_data" (no new or revised
+    rows), "missing" (not in the report) or "failed".
+    """
+    market_code: str
+    report_type: str
+    state: str = "pending"
+    attempts: int = 0
+    inserted: int = 0
+    updated: int = 0
+    revised_from: Optional[str] = None
+    error: Optional[str] = None
+
+
+def load_config(path=None) -> dict:
+    """
+    Reads the pipeline config: the market codes to load (or "all"), the report types, the worker pool sizes
+    and the number of attempts per task. Missing keys take their defaults.
+    """
+    with open(path or DEFAULT_CONFIG) as f:
+        config = json.load(f)
+
+    config.setdefault("report_types", list(REPORT_MAPPERS))
+    config.setdefault("columns_to_keep", None)
+    config.setdefault("process_workers", None)
+    config.setdefault("db_workers", int(os.getenv("DB_POOL_SIZE", 5)))
+    config.setdefault("retries", 3)
+    config.setdefault("retry_backoff", 5)
+
+    unknown = [r for r in config["report_types"] if r not in REPORT_MAPPERS]
+    if unknown:
+        raise ValueError("Report types {} cannot be loaded, expected some of {}".format(unknown, list(REPORT_MAPPERS)))
+    return config
+
+
+def _prepare_report(report_type, market_codes, since_year, last_dates, columns_to_keep):
+    """
+    Downloads and parses a report type, keeping only the rows of the configured markets while parsing unless
+    every market is loaded, then cleans the rows of each market. Runs in a worker process.
+
+    Returns:
+        tuple: (market code -> rows to load, market code -> error message for the markets that failed to clean)
+    """
+    if market_codes == ALL_MARKETS:
+        report = get_report(report_type, since_year=since_year)
+        with stage("split", report_type=report_type, rows=len(report)):
+            frames = split_by_market(report, report_type)
+        release_report(report_type)
+    else:
+        # only the rows of the configured markets are kept while the archives are parsed
+        frames = read_market_frames(report_type, market_codes, since_year, report_columns(report_type, columns_to_keep))
+
+    prepared, errors = {}, {}
+    for market_code, frame in frames.items():
+        try:
+            with stage("clean", market_code=market_code, report_type=report_type) as record:
+                prepared[market_code] = prepare_report_rows(report_type, market_code, frame, last_dates.get(market_code), columns_to_keep)
+                record["rows"] = len(prepared[market_code])
+        except Exception as e:
+            errors[market_code] = repr(e)
+    return prepared, errors
+
+
+def _prepare_in_worker(*args):
+    # the stage records of a worker process are sent back with its results
+    start_run()
+    prepared, errors = _prepare_report(*args)
+    return prepared, errors, list(get_run_metrics().records)
+
+
+def _load_market(status, df, retries, backoff):
+    """
+    Loads the prepared rows of one (market, report) task, retrying on its own. Runs in a worker thread.
+    """
+    mapper = REPORT_MAPPERS[status.report_type]
+    # the rows kept by the first diff are written again on a retry: diffing again after a partial write would
+    # find them stored already and skip their facts, watermark and revisions
+    changes = None
+
+    for attempt in range(1, retries + 1):
+        status.attempts = attempt
+        try:
+            if changes is None:
+                changes = diff_new_rows(df, mapper, status.market_code, status.report_type)
+            status.inserted, status.updated, revised_from = write_new_rows(*changes, mapper, status.market_code, status.report_type)
+            status.revised_from = revised_from.isoformat() if revised_from else None
+            status.state = "loaded" if status.inserted + status.updated else "no_data"
+            status.error = None
+            return status
+        except Exception as e:
+            status.error = repr(e)
+            logger.warning("loading {} {} failed (attempt {}/{}): {}".format(status.report_type, status.market_code, attempt, retries, e))
+            if attempt < retries:
+                time.sleep(backoff * 2 ** (attempt - 1))
+
+    status.state = "failed"
+    return status
+
+
+def run_pipeline(config: dict, hist: bool = False) -> list:
+    """
+    Loads every configured (market, report) pair.
+
+    Each report type is downloaded, parsed and cleaned once in a process pool, then the rows of each market
+    are loaded into the database from a thread pool bounded by `db_workers` connections. Every step is retried
+    on its own up to `retries` times, and a failure only affects the tasks that depend on it.
+
+    Args:
+        config (dict): As returned by `load_config`.
+        hist (bool, optional): Load the full history instead of the report dates past each market's watermark.
+            Defaults to False.
+
+    Returns:
+        list: A `TaskStatus` per (market, report) pair.
+    """
+    market_codes = config["markets"]
+    # the listed markets, None for every market of the reports
+    listed = None if market_codes == ALL_MARKETS else market_codes
+    retries, backoff = config["retries"], config["retry_backoff"]
+    statuses = []
+
+    with ProcessPoolExecutor(max_workers=config["process_workers"]) as processes, \
+            ThreadPoolExecutor(max_workers=config["db_workers"]) as threads:
+
+        def submit_prepare(report_type, attempt):
+            last_dates = watermarks[report_type]
+            future = processes.submit(_prepare_in_worker, report_type, market_codes, first_year_to_fetch(report_type, listed, last_dates),
+                                      last_dates, config["columns_to_keep"])
+            pending[future] = (report_type, attempt)
+
+        watermarks = {report_type: {} if hist else get_watermarks(report_type, listed)
+                      for report_type in config["report_types"]}
+        # every archive of the run is downloaded up front and concurrently, the workers then read them from the cache
+        get_archive_cache().prefetch([(report_type, year) for report_type in config["report_types"]
+                                      for year in archive_years(first_year_to_fetch(report_type, listed, watermarks[report_type]))])
+
+        pending = {}
+        loads = []
+        for report_type in config["report_types"]:
+            submit_prepare(report_type, 1)
+
+        while pending:
+            done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+            for future in done:
+                report_type, attempt = pending.pop(future)
+                try:
+                    prepared, errors, records = future.result()
+                    get_run_metrics().extend(records)
+                except Exception as e:
+                    logger.warning("preparing {} failed (attempt {}/{}): {}".format(report_type, attempt, retries, e))
+                    if attempt < retries:
+                        time.sleep(backoff * 2 ** (attempt - 1))
+                        submit_prepare(report_type, attempt + 1)
+                    else:
+                        codes = [ALL_MARKETS] if market_codes == ALL_MARKETS else market_codes
+                        statuses.extend(TaskStatus(code, report_type, "failed", attempt, error=repr(e)) for code in codes)
+                    continue
+
+                for market_code, df in prepared.items():
+                    status = TaskStatus(market_code, report_type)
+                    statuses.append(status)
+                    loads.append(threads.submit(_load_market, status, df, retries, backoff))
+                for market_code, error in errors.items():
+                    statuses.append(TaskStatus(market_code, report_type, "failed", 1, error=error))
+                if market_codes != ALL_MARKETS:
+                    found = set(prepared) | set(errors)
+                    statuses.extend(TaskStatus(code, report_type, "missing") for code in market_codes if code not in found)
+
+        wait(loads)
+
+    return statuses
+
+
+def profile_market(config: dict, market_code: str, directory=DEFAULT_PROFILE_DIR) -> dict:
+    """
+    Runs every configured report of a single market in this process under cProfile and tracemalloc: download,
+    parse, split, clean and load. The profile of each report is written to `<directory>/<market>_<report>.prof`
+    (with the top functions by cumulative time next to it in a .txt file) for snakeviz or pstats.
+
+    Returns:
+        dict: Report type -> profile path, task status, traced peak memory and the top allocation sites.
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    profiles = {}
+
+    for report_type in config["report_types"]:
+        last_dates = get_watermarks(report_type, [market_code])
+        status = TaskStatus(market_code, report_type)
+        profiler = cProfile.Profile()
+        tracemalloc.start(10)
+        try:
+            profiler.enable()
+            prepared, errors = _prepare_report(report_type, [market_code], first_year_to_fetch(report_type, [market_code], last_dates),
+                                               last_dates, config["columns_to_keep"])
+            if market_code in prepared:
+                _load_market(status, prepared[market_code], 1, 0)
+            else:
+                status.state, status.error = ("failed", errors[market_code]) if market_code in errors else ("missing", None)
+            profiler.disable()
+            snapshot = tracemalloc.take_snapshot()
+            _, traced_peak = tracemalloc.get_traced_memory()
+        finally:
+            profiler.disable()
+            tracemalloc.stop()
+
+        path = directory.joinpath("{}_{}.prof".format(market_code, report_type))
+        profiler.dump_stats(path)
+        with open(path.with_suffix(".txt"), "w") as f:
+            pstats.Stats(profiler, stream=f).sort_stats("cumulative").print_stats(40)
+
+        profiles[report_type] = {
+            "profile": str(path),
+            "status": asdict(status),
+            "traced_peak_mib": traced_peak / 1024 / 1024,
+            "top_allocations": [str(s) for s in snapshot.statistics("lineno")[:15]],
+        }
+        logger.info("profiled {} {} into {}".format(report_type, market_code, path))
+
+    return profiles
+
+
+def setup_logging(path=DEFAULT_LOG):
+    """
+    Sends the log of the run to `path`, creating its directory. Called by the entry points only, the modules
+    of the pipeline are imported as a library as well (benchmarks, panel).
+    """
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    logging.basicConfig(filename=str(path), level=logging.DEBUG)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load the CFTC COT reports into the database")
+    parser.add_argument("--config", default=str(DEFAULT_CONFIG), help="market list config (default: markets.json)")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="reload the full history into shadow tables and swap them in once loaded")
+    parser.add_argument("--report", default=str(DEFAULT_REPORT),
+                        help="JSON run report with the timings and counters of each stage (default: logs/run_report.json)")
+    parser.add_argument("--profile", metavar="MARKET_CODE",
+                        help="only load this market, in-process under cProfile and tracemalloc (output in logs/profile)")
+    args = parser.parse_args(argv)
+
+    setup_logging()
+    logger.info("Running cod script on {}".format(date.today()))
+    config = load_config(args.config)
+    run = start_run()
+
+    logger.info("migrating cot tables")
+    migrate_models()
+    ensure_partitions()
+
+    if args.profile:
+        profiles = profile_market(config, args.profile)
+        run.write(args.report, profiles=profiles)
+        return 1 if any(p["status"]["state"] == "failed" for p in profiles.values()) else 0
+
+    if args.rebuild:
+        logger.info("rebuilding cot tables")
+        with rebuild_tables():
+            statuses = run_pipeline(config, hist=True)
+            if any(status.state == "failed" for status in statuses):
+                raise RuntimeError("Rebuild aborted, the live tables were left untouched")
+        # the snapshots were refreshed from the live tables while the shadow ones were loaded
+        for mapper in set(REPORT_MAPPERS.values()):
+            rebuild_latest(mapper)
+        with stage("analytics") as record:
+            record["rows"] = refresh_analytics(full=True)
+        bump_data_version()
+    else:
+        statuses = run_pipeline(config)
+        if any(status.state == "loaded" for status in statuses):
+            revised = {(status.market_code, status.report_type): status.revised_from
+                       for status in statuses if status.revised_from}
+            with stage("analytics") as record:
+                record["rows"] = refresh_analytics(revised=revised)
+            bump_data_version()
+
+    states = {}
+    for status in statuses:
+        logger.info(json.dumps(asdict(status)))
+        states[status.state] = states.get(status.state, 0) + 1
+
+    report = run.write(args.report, tasks=[asdict(status) for status in statuses], states=states)
+    for name, totals in report["stages"].items():
+        logger.info("stage {}: {}".format(name, json.dumps(totals)))
+    logger.info("Finished cod script: {} in {:.1f}s, run report in {}".format(states, report["seconds"], args.report))
+    return 1 if states.get("failed") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
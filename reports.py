@@ -0,0 +1,334 @@
+import logging
+import zipfile
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterable, Optional
+
+import pandas as pd
+
+from archive_cache import archive_years, get_archive_cache
+from metrics import stage
+
+logger = logging.getLogger(__name__)
+
+
+# report types published by the CFTC and the column holding the contract market code in each of them
+MARKET_CODE_COLUMNS = {
+    "legacy_fut": "CFTC Contract Market Code",
+    "legacy_futopt": "CFTC Contract Market Code",
+    "supplemental_futopt": "CFTC_Contract_Market_Code",
+    "disaggregated_fut": "CFTC_Contract_Market_Code",
+    "disaggregated_futopt": "CFTC_Contract_Market_Code",
+    "traders_in_financial_futures_fut": "CFTC_Contract_Market_Code",
+    "traders_in_financial_futures_futopt": "CFTC_Contract_Market_Code",
+}
+
+REPORT_TYPES = list(MARKET_CODE_COLUMNS)
+
+# column holding the report date in each report type, as published
+DATE_COLUMNS = {
+    "legacy_fut": "As of Date in Form YYYY-MM-DD",
+    "legacy_futopt": "As of Date in Form YYYY-MM-DD",
+    "supplemental_futopt": "Report_Date_as_YYYY-MM-DD",
+    "disaggregated_fut": "Report_Date_as_YYYY-MM-DD",
+    "disaggregated_futopt": "Report_Date_as_YYYY-MM-DD",
+    "traders_in_financial_futures_fut": "Report_Date_as_YYYY-MM-DD",
+    "traders_in_financial_futures_futopt": "Report_Date_as_YYYY-MM-DD",
+}
+
+# the legacy reports spell their headers out ("% of OI-Noncommercial (Long) (All)"), the model columns do not
+LEGACY_HEADER_REPLACEMENTS = ((" ", "_"), ("(", ""), (")", ""), ("-", "_"), ("%", "Per"), ("=", ""))
+
+# columns holding names, codes and units rather than numbers, matched on part of their name
+TEXT_COLUMN_MARKERS = ("Name", "Code", "Units", "FutOnly", "Report_Type")
+
+# rows read at once by the streaming archive reader
+CHUNK_ROWS = 50000
+
+# report frames loaded during this run, keyed by (report type, first year loaded)
+_REPORT_FRAMES = {}
+
+
+def read_archive(path: Path) -> pd.DataFrame:
+    """
+    Reads the report text file contained in a CFTC zip archive, keeping market codes as strings.
+    """
+    with zipfile.ZipFile(path) as archive:
+        with archive.open(archive_member(archive)) as f:
+            return pd.read_csv(f, low_memory=False, dtype={column: str for column in set(MARKET_CODE_COLUMNS.values())})
+
+
+def archive_member(archive: zipfile.ZipFile) -> str:
+    return next(name for name in archive.namelist() if name.lower().endswith(".txt"))
+
+
+def report_dtypes(report_type: str, headers: tuple) -> dict:
+    """
+    Returns the dtype of each header of a report layout: text for the name, code, unit and date columns,
+    float64 for the numeric ones (the CFTC "." placeholder is read as NaN).
+    """
+    names = column_names(report_type, headers)
+    numeric = set(numeric_columns(names))
+    return {header: "float64" if name in numeric and "Date" not in name else str for header, name in zip(headers, names)}
+
+
+def read_archive_chunks(path: Path, report_type: str, market_codes: Optional[Iterable[str]] = None,
+                        columns: Optional[Iterable[str]] = None, chunksize: int = CHUNK_ROWS):
+    """
+    Reads the report text file of a CFTC zip archive `chunksize` rows at a time, straight from the archive, and
+    yields the rows of each chunk belonging to `market_codes`. Only one chunk of the report is held at once.
+
+    Args:
+        path (Path): The zip archive.
+        report_type (str): One of `REPORT_TYPES`, which gives the layout of the file.
+        market_codes (Iterable[str], optional): Market codes to keep. Defaults to None, every market.
+        columns (Iterable[str], optional): Model column names to read, e.g. "M_Money_Positions_Long_All"; the
+            report date and market code columns are always read. Defaults to None, every column.
+        chunksize (int, optional): Rows parsed at once. Defaults to `CHUNK_ROWS`.
+
+    Yields:
+        pd.DataFrame: The kept rows of a chunk (possibly none), with the published headers and explicit dtypes.
+    """
+    column = MARKET_CODE_COLUMNS[report_type]
+    codes = None if market_codes is None else set(market_codes)
+
+    with zipfile.ZipFile(path) as archive:
+        member = archive_member(archive)
+        with archive.open(member) as f:
+            headers = tuple(pd.read_csv(f, nrows=0).columns)
+
+        dtypes = report_dtypes(report_type, headers)
+        usecols = None
+        if columns is not None:
+            wanted = set(columns) | {"Date", "CFTC_Contract_Market_Code"}
+            usecols = [header for header, name in zip(headers, column_names(report_type, headers)) if name in wanted]
+            dtypes = {header: dtypes[header] for header in usecols}
+
+        with archive.open(member) as f:
+            for chunk in pd.read_csv(f, usecols=usecols, dtype=dtypes, na_values=["."], skipinitialspace=True,
+                                     chunksize=chunksize):
+                if codes is not None:
+                    chunk = chunk[chunk[column].str.strip().isin(codes)]
+                yield chunk
+
+
+def read_market_frames(report_type: str, market_codes: Iterable[str], since_year: Optional[int] = None,
+                       columns: Optional[Iterable[str]] = None, include_missing: bool = False) -> dict:
+    """
+    Reads the rows of `market_codes` from the yearly archives of a report type, filtering each chunk as it is
+    parsed, so that memory grows with the rows of these markets rather than with the whole report.
+
+    Args:
+        report_type (str): One of `REPORT_TYPES`.
+        market_codes (Iterable[str]): CFTC contract market codes to extract.
+        since_year (int, optional): Only read the archives from this year on. Defaults to None, the full history.
+        columns (Iterable[str], optional): Model column names to read, see `read_archive_chunks`.
+        include_missing (bool, optional): Return an empty frame for the codes absent from the report instead
+            of leaving them out. Defaults to False.
+
+    Returns:
+        dict: Market code -> DataFrame with the rows of that market, in archive order.
+    """
+    market_codes = list(market_codes)
+    column = MARKET_CODE_COLUMNS[report_type]
+    cache = get_archive_cache()
+    parts, empty = {}, None
+
+    for year in archive_years(since_year):
+        path = cache.get(report_type, year)
+        if path is None:
+            # the current year is not published yet
+            continue
+        with stage("parse", report_type=report_type, year=str(year)) as record:
+            record["rows"] = 0
+            for chunk in read_archive_chunks(path, report_type, market_codes, columns):
+                if empty is None:
+                    empty = chunk.iloc[0:0]
+                record["rows"] += len(chunk)
+                for code, rows in chunk.groupby(chunk[column].str.strip(), sort=False):
+                    parts.setdefault(code, []).append(rows)
+
+    frames = {code: pd.concat(parts[code], ignore_index=True) for code in market_codes if code in parts}
+    if include_missing and empty is not None:
+        frames.update({code: empty for code in market_codes if code not in frames})
+    return frames
+
+
+def load_report(report_type: str, since_year: Optional[int] = None) -> pd.DataFrame:
+    """
+    Loads a report type from the yearly archives, going through the local archive cache.
+
+    Args:
+        report_type (str): One of `REPORT_TYPES`.
+        since_year (int, optional): Only load the archives from this year on. Defaults to None, the full history.
+    """
+    cache = get_archive_cache()
+    frames = []
+    for year in archive_years(since_year):
+        path = cache.get(report_type, year)
+        if path is None:
+            # the current year is not published yet
+            continue
+        with stage("parse", report_type=report_type, year=str(year)) as record:
+            frames.append(read_archive(path))
+            record["rows"] = len(frames[-1])
+    if not frames:
+        return pd.DataFrame(columns=[MARKET_CODE_COLUMNS[report_type], DATE_COLUMNS[report_type]])
+    return pd.concat(frames, ignore_index=True)
+
+
+def get_report(report_type: str, refresh: bool = False, since_year: Optional[int] = None) -> pd.DataFrame:
+    """
+    Returns the full history of a CFTC report type for all markets, loading it at most once per run.
+
+    Args:
+        report_type (str): One of `REPORT_TYPES`, e.g. "disaggregated_futopt".
+        refresh (bool, optional): Load the report again even if it is already held in memory. Defaults to False.
+        since_year (int, optional): Only load the archives from this year on. Defaults to None, the full history.
+
+    Returns:
+        pd.DataFrame: The report data for every market, as published by the CFTC.
+    """
+    if report_type not in MARKET_CODE_COLUMNS:
+        raise ValueError("Unknown report type {}, expected one of {}".format(report_type, REPORT_TYPES))
+
+    key = (report_type, since_year)
+    if refresh or key not in _REPORT_FRAMES:
+        logger.info("loading {} report since {}".format(report_type, since_year or "inception"))
+        _REPORT_FRAMES[key] = load_report(report_type, since_year)
+
+    return _REPORT_FRAMES[key]
+
+
+def release_report(report_type: Optional[str] = None) -> None:
+    """
+    Drops a loaded report (or all of them when `report_type` is None) so its memory can be reclaimed.
+    """
+    for key in list(_REPORT_FRAMES):
+        if report_type is None or key[0] == report_type:
+            del _REPORT_FRAMES[key]
+
+
+def split_by_market(df: pd.DataFrame, report_type: str, market_codes: Optional[Iterable[str]] = None) -> dict:
+    """
+    Splits a report frame into one frame per market code with a single groupby.
+
+    Args:
+        df (pd.DataFrame): A report frame as returned by `get_report`.
+        report_type (str): The report type of `df`, used to find the market code column.
+        market_codes (Iterable[str], optional): Market codes to keep. Defaults to None, which keeps every market.
+
+    Returns:
+        dict: Market code -> DataFrame with the rows of that market. Codes absent from the report are left out.
+    """
+    column = MARKET_CODE_COLUMNS[report_type]
+    codes = df[column].astype(str).str.strip()
+
+    if market_codes is not None:
+        keep = codes.isin(set(market_codes))
+        df, codes = df[keep], codes[keep]
+
+    return {code: frame for code, frame in df.groupby(codes, sort=False)}
+
+
+@lru_cache(maxsize=None)
+def column_names(report_type: str, headers: tuple) -> tuple:
+    """
+    Maps the headers of a report type to the model column names, the report date column becoming "Date".
+    Computed once per report layout.
+    """
+    spelled_out = " " in MARKET_CODE_COLUMNS[report_type]
+    names = []
+    for header in headers:
+        if header == DATE_COLUMNS[report_type]:
+            header = "Date"
+        elif spelled_out:
+            for old, new in LEGACY_HEADER_REPLACEMENTS:
+                header = header.replace(old, new)
+        names.append(header)
+    return tuple(names)
+
+
+@lru_cache(maxsize=None)
+def numeric_columns(names: tuple) -> tuple:
+    """
+    Returns the column names holding numbers: everything but the date and the name, code and unit columns.
+    """
+    return tuple(name for name in names if name != "Date" and not any(marker in name for marker in TEXT_COLUMN_MARKERS))
+
+
+def normalize_report(df: pd.DataFrame, report_type: str, market_code: Optional[str] = None) -> pd.DataFrame:
+    """
+    Turns rows of a report, as published by the CFTC, into rows named and typed like the model columns.
+
+    The headers are renamed through `column_names`, the report date is parsed into a "Date" column and the
+    numeric columns still held as text (the CFTC writes "." for a missing value) are converted with
+    `pd.to_numeric`, missing values becoming NaN. Text columns are left untouched, and columns that were
+    already parsed as numbers are not converted again. "Report_Type" and "Market_Code" columns are added.
+
+    Args:
+        df (pd.DataFrame): Rows of `report_type`, e.g. as returned by `get_market_frame`.
+        report_type (str): One of `REPORT_TYPES`.
+        market_code (str, optional): Market code of the rows. Defaults to None, which takes it from the rows.
+
+    Returns:
+        pd.DataFrame: A new frame, `df` itself is not modified.
+    """
+    names = column_names(report_type, tuple(df.columns))
+    df = df.set_axis(list(names), axis=1)
+
+    converted = {name: pd.to_numeric(df[name], errors="coerce")
+                 for name in numeric_columns(names) if not pd.api.types.is_numeric_dtype(df[name])}
+    converted["Date"] = pd.to_datetime(df["Date"])
+    converted["Report_Type"] = report_type
+    converted["Market_Code"] = market_code if market_code is not None else df["CFTC_Contract_Market_Code"].astype(str).str.strip()
+
+    # the frame is built at once rather than assigned column by column, which left it in hundreds of blocks:
+    # the numeric columns end up in one block, whatever their order
+    columns = {name: converted.pop(name, df[name]) for name in df.columns}
+    return pd.DataFrame({**columns, **converted}, index=df.index)
+
+
+def get_market_frames(report_type: str, market_codes: Iterable[str], since_year: Optional[int] = None,
+                      columns: Optional[Iterable[str]] = None) -> dict:
+    """
+    Returns the rows of `report_type` for each of `market_codes`. They are split out of the report when it is
+    already held for this run, and streamed from the archives with `read_market_frames` otherwise.
+
+    Args:
+        report_type (str): One of `REPORT_TYPES`.
+        market_codes (Iterable[str]): CFTC contract market codes to extract.
+        since_year (int, optional): Only load the archives from this year on. Defaults to None, the full history.
+        columns (Iterable[str], optional): Model column names to read when streaming, see `read_archive_chunks`.
+            Defaults to None, every column.
+
+    Returns:
+        dict: Market code -> DataFrame. Codes that are not present in the report are logged and left out.
+    """
+    market_codes = list(market_codes)
+    if (report_type, since_year) in _REPORT_FRAMES:
+        frames = split_by_market(get_report(report_type, since_year=since_year), report_type, market_codes)
+    else:
+        frames = read_market_frames(report_type, market_codes, since_year, columns)
+
+    for code in market_codes:
+        if code not in frames:
+            logger.warning("market code {} not found in {} report".format(code, report_type))
+
+    return frames
+
+
+def get_market_frame(report_type: str, market_code: str, since_year: Optional[int] = None) -> pd.DataFrame:
+    """
+    Returns the rows of `report_type` for a single market code (empty if the market is not in the report).
+    """
+    if (report_type, since_year) in _REPORT_FRAMES:
+        frames = get_market_frames(report_type, [market_code], since_year)
+        if market_code in frames:
+            return frames[market_code]
+        return get_report(report_type, since_year=since_year).iloc[0:0]
+
+    frames = read_market_frames(report_type, [market_code], since_year, include_missing=True)
+    if not len(frames[market_code]):
+        logger.warning("market code {} not found in {} report".format(market_code, report_type))
+    return frames[market_code]
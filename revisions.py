@@ -0,0 +1,111 @@
+import logging
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import Float, Integer, Numeric, select
+
+from common import coerce_to_schema
+from backend.db.dbconnect import get_engine
+from backend.db.models import RevisionLog
+from backend.db.upsert import load_target
+
+logger = logging.getLogger(__name__)
+
+
+def hashed_columns(mapper, columns) -> list:
+    """
+    Returns the columns a row hash covers: the numeric columns of `mapper` among `columns`, in table order.
+    Names, codes and units are left out, the CFTC revises the positions, not the labels.
+    """
+    return [c.name for c in mapper.__table__.columns
+            if c.name in columns and c.name != "Row_Hash" and isinstance(c.type, (Integer, Float, Numeric))]
+
+
+def row_hashes(df: pd.DataFrame, mapper) -> pd.Series:
+    """
+    Hashes the numeric columns of each row in one vectorized pass, as signed 64-bit integers so they fit a
+    BigInteger column. `df` must hold the database types, see `common.coerce_to_schema`.
+    """
+    hashes = pd.util.hash_pandas_object(df[hashed_columns(mapper, df.columns)], index=False)
+    return pd.Series(hashes.to_numpy().view(np.int64), index=df.index, name="Row_Hash")
+
+
+def _stored_rows(mapper, market_code, report_type, start, columns, engine):
+    # the table loads go to, e.g. the empty shadow table of a rebuild, which then gets every row
+    table = load_target(mapper)
+    stmt = select(*[table.c[c] for c in columns]).where(
+        table.c.Market_Code == market_code, table.c.Report_Type == report_type, table.c.Date >= start)
+    with engine.connect() as conn:
+        result = conn.execute(stmt)
+        stored = pd.DataFrame(result.fetchall(), columns=list(result.keys()))
+    return stored.assign(Date=pd.to_datetime(stored["Date"]))
+
+
+def changed_rows(df: pd.DataFrame, mapper, market_code: str, report_type: str, engine=None) -> tuple:
+    """
+    Compares the rows of one market with the stored ones by row hash, keeping those that are new or revised.
+
+    The stored hashes of the report dates of `df` are read through the (Market_Code, Report_Type, Date) index,
+    from the table loads of `mapper` currently go to (see `upsert.load_target`).
+    Rows whose hash did not change are dropped. Revised rows (stored with another hash) are returned with the
+    columns that changed, for `log_revisions`. Rows stored before hashes were kept are rewritten without
+    being logged.
+
+    Args:
+        df (pd.DataFrame): Cleaned report rows of `market_code` and `report_type`.
+        mapper: The mapper class of the database table.
+        market_code (str): The CFTC contract market code of the rows.
+        report_type (str): The report type of the rows.
+        engine (Engine, optional): Defaults to the COT database engine.
+
+    Returns:
+        tuple: (rows to load with their "Row_Hash", revisions as a DataFrame named like RevisionLog)
+    """
+    engine = engine or get_engine()
+    df = coerce_to_schema(df, mapper)
+    df = df.assign(Date=pd.to_datetime(df["Date"]), Row_Hash=row_hashes(df, mapper))
+
+    columns = ["Date"] + hashed_columns(mapper, df.columns) + ["Row_Hash"]
+    stored = _stored_rows(mapper, market_code, report_type, df["Date"].min(), columns, engine)
+    # nullable integers, as floats would round the hashes
+    stored = stored.assign(Row_Hash=stored["Row_Hash"].astype("Int64"))
+    stored_hash = df["Date"].map(stored.set_index("Date")["Row_Hash"]).astype("Int64")
+
+    changed = (stored_hash != df["Row_Hash"]).fillna(True)
+    revised = stored_hash.notna() & changed
+
+    revisions = pd.DataFrame(columns=["Table_Name", "Date", "Market_Code", "Report_Type", "Old_Hash", "New_Hash", "Changed_Columns"])
+    if revised.any():
+        new = df.loc[revised, columns].set_index("Date")
+        old = coerce_to_schema(stored, mapper).set_index("Date").loc[new.index, new.columns]
+        differs = ~((old == new).fillna(False) | (old.isna() & new.isna()))
+        differs = differs.drop(columns="Row_Hash")
+        revisions = pd.DataFrame({
+            "Table_Name": mapper.__tablename__,
+            "Date": new.index,
+            "Market_Code": market_code,
+            "Report_Type": report_type,
+            "Old_Hash": old["Row_Hash"].to_numpy(),
+            "New_Hash": new["Row_Hash"].to_numpy(),
+            "Changed_Columns": [",".join(differs.columns[row]) for row in differs.to_numpy()],
+        })
+
+    return df[changed], revisions
+
+
+def log_revisions(revisions: pd.DataFrame, engine=None) -> int:
+    """
+    Appends revised rows found by `changed_rows` to the revision_log table.
+
+    Returns:
+        int: Number of revisions logged.
+    """
+    if revisions.empty:
+        return 0
+    engine = engine or get_engine()
+    rows = revisions.assign(Date=pd.to_datetime(revisions["Date"]).dt.date).to_dict(orient="records")
+    with engine.begin() as conn:
+        conn.execute(RevisionLog.__table__.insert(), rows)
+    for row in rows:
+        logger.info("{} {} {} revised: {}".format(row["Report_Type"], row["Market_Code"], row["Date"], row["Changed_Columns"]))
+    return len(rows)
@@ -0,0 +1,22 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+# the modules of the repository are imported from its root, as when running the scripts there
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+
+@pytest.fixture
+def cot_db(tmp_path, monkeypatch):
+    """A migrated SQLite COT database in DB_URL_COT, with the parquet store next to it. Yields its engine."""
+    import parquet_store
+    from backend.db.dbconnect import get_engine
+    from backend.db.migrations import upgrade
+
+    monkeypatch.setenv("DB_URL_COT", "sqlite:///{}".format(tmp_path / "cot.db"))
+    monkeypatch.setattr(parquet_store, "STORE_DIR", tmp_path / "parquet")
+    engine = get_engine()
+    upgrade(engine)
+    yield engine
+    engine.dispose()
@@ -0,0 +1,73 @@
+import io
+import os
+import zipfile
+from datetime import date
+
+import pytest
+
+import archive_cache
+import downloader
+from archive_cache import ArchiveCache, ArchiveNotPublished, archive_name
+
+
+REPORT_TYPE = "disaggregated_fut"
+
+
+def write_archive(site, year):
+    path = site / (archive_name(REPORT_TYPE, year) + ".zip")
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as archive:
+        archive.writestr("f_year.txt", "Report_Date_as_YYYY-MM-DD,CFTC_Contract_Market_Code\n{}-01-02,001602\n".format(year))
+    path.write_bytes(buf.getvalue())
+    return path
+
+
+@pytest.fixture
+def site(tmp_path):
+    site = tmp_path / "site"
+    site.mkdir()
+    return site
+
+
+@pytest.fixture
+def cache(tmp_path, site):
+    return ArchiveCache(tmp_path / "cache", base_url=str(site))
+
+
+def test_unpublished_current_year_is_skipped(cache):
+    assert cache.get(REPORT_TYPE, date.today().year) is None
+
+
+def test_missing_closed_year_fails(cache):
+    # the downloader's error, so that callers catch one exception for every failed download
+    with pytest.raises(downloader.DownloadError) as raised:
+        cache.get(REPORT_TYPE, date.today().year - 1)
+    assert isinstance(raised.value, ArchiveNotPublished)
+
+
+def test_closed_year_is_hashed_only_when_it_changes(cache, site, monkeypatch):
+    year = date.today().year - 1
+    write_archive(site, year)
+    path = cache.get(REPORT_TYPE, year)
+
+    hashed = []
+    sha256 = archive_cache.file_sha256
+    monkeypatch.setattr(archive_cache, "file_sha256", lambda p: hashed.append(p) or sha256(p))
+    for _ in range(3):
+        assert cache.get(REPORT_TYPE, year) == path
+    assert hashed == []
+
+    # touched but unchanged: hashed once, then trusted again
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    cache.get(REPORT_TYPE, year)
+    cache.get(REPORT_TYPE, year)
+    assert hashed == [path]
+
+
+def test_changed_closed_year_is_fetched_again(cache, site):
+    year = date.today().year - 1
+    source = write_archive(site, year)
+    path = cache.get(REPORT_TYPE, year)
+    path.write_bytes(b"x" * path.stat().st_size)
+    assert cache.get(REPORT_TYPE, year).read_bytes() == source.read_bytes()
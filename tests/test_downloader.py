@@ -0,0 +1,152 @@
+import io
+import json
+import os
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from downloader import CHUNK_BYTES, Download, download, file_sha256
+
+
+ETAG = '"v1"'
+
+
+def fixture_archive() -> bytes:
+    # stored, not deflated, so that a flipped byte lands in the member data and fails its CRC-32. Larger than
+    # a few blocks, so that a truncated transfer leaves whole blocks in the partial file
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_STORED) as archive:
+        archive.writestr("annual.txt", os.urandom(3 * CHUNK_BYTES))
+    return buf.getvalue()
+
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        body = server.body
+
+        if body is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        if self.headers.get("If-None-Match") == ETAG:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        start = 0
+        range_header = self.headers.get("Range")
+        if range_header and server.ranges and self.headers.get("If-Range", ETAG) == ETAG:
+            start = int(range_header.split("=")[1].rstrip("-"))
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, len(body) - 1, len(body)))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body) - start))
+        self.send_header("ETag", ETAG)
+        self.end_headers()
+
+        if server.truncate:
+            # announce the full length, send half of it and drop the connection
+            server.truncate -= 1
+            self.wfile.write(body[start:start + (len(body) - start) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body[start:])
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    httpd.body, httpd.ranges, httpd.truncate, httpd.requests = fixture_archive(), True, 0, []
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    httpd.url = "http://127.0.0.1:{}/fut_disagg_txt_2024.zip".format(httpd.server_address[1])
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def fetch(d):
+    return download([d], retries=3, backoff=0.01, timeout=5)[0]
+
+
+def partial(server, path, size):
+    """Leaves the first `size` bytes of the archive as the partial file of an interrupted download."""
+    path.with_name(path.name + ".part").write_bytes(server.body[:size])
+    path.with_name(path.name + ".part.json").write_text(json.dumps({"url": server.url, "etag": ETAG, "last_modified": None}))
+
+
+def test_fresh_download(server, tmp_path):
+    d = fetch(Download(server.url, tmp_path / "a.zip"))
+    assert d.status == "downloaded"
+    assert d.etag == ETAG
+    assert (tmp_path / "a.zip").read_bytes() == server.body
+    assert d.sha256 == file_sha256(tmp_path / "a.zip")
+    assert not (tmp_path / "a.zip.part").exists()
+
+
+def test_not_modified(server, tmp_path):
+    d = fetch(Download(server.url, tmp_path / "a.zip", etag=ETAG))
+    assert d.status == "not_modified"
+    assert not (tmp_path / "a.zip").exists()
+
+
+def test_resume_with_range(server, tmp_path):
+    path = tmp_path / "a.zip"
+    partial(server, path, 50_000)
+    d = fetch(Download(server.url, path))
+    assert d.status == "downloaded"
+    assert server.requests[0]["Range"] == "bytes=50000-"
+    assert d.transferred == len(server.body) - 50_000
+    assert path.read_bytes() == server.body
+
+
+def test_resume_when_server_ignores_range(server, tmp_path):
+    server.ranges = False
+    path = tmp_path / "a.zip"
+    partial(server, path, 50_000)
+    d = fetch(Download(server.url, path))
+    assert d.status == "downloaded"
+    assert d.attempts == 1
+    assert path.read_bytes() == server.body
+
+
+def test_truncated_body_is_resumed(server, tmp_path):
+    server.truncate = 1
+    path = tmp_path / "a.zip"
+    d = fetch(Download(server.url, path))
+    assert d.status == "downloaded"
+    assert d.attempts == 2
+    resumed_at = int(server.requests[1]["Range"].split("=")[1].rstrip("-"))
+    assert 0 < resumed_at <= len(server.body) // 2
+    assert d.transferred == len(server.body)
+    assert path.read_bytes() == server.body
+
+
+def test_not_found_fails_at_once(server, tmp_path):
+    server.body = None
+    d = fetch(Download(server.url, tmp_path / "a.zip"))
+    assert d.status == "failed"
+    assert d.status_code == 404
+    assert d.attempts == 1
+
+
+def test_corrupt_zip_fails(server, tmp_path):
+    body = bytearray(server.body)
+    body[len(body) // 2] ^= 0xFF
+    server.body = bytes(body)
+    path = tmp_path / "a.zip"
+    d = fetch(Download(server.url, path))
+    assert d.status == "failed"
+    assert "checksum mismatch" in d.error
+    assert d.attempts == 3
+    assert not path.exists()
+    assert not path.with_name(path.name + ".part").exists()
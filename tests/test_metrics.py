@@ -0,0 +1,19 @@
+from metrics import RunMetrics
+
+
+def record(stage, market_code=None, **counters):
+    return dict(stage=stage, seconds=1.0, market_code=market_code, **counters)
+
+
+def test_records_are_capped_and_totals_kept():
+    run = RunMetrics(max_records=3)
+    for i in range(5):
+        run.add(record("parse", rows=10))
+    run.extend([record("db_load", "001602", inserted=2), record("db_load", "001602", inserted=3)])
+
+    report = run.report()
+    assert len(report["records"]) == 3
+    assert report["dropped_records"] == 4
+    assert report["stages"]["parse"] == {"count": 5, "seconds": 5.0, "rows": 50}
+    assert report["stages"]["db_load"] == {"count": 2, "seconds": 2.0, "inserted": 5}
+    assert report["markets"] == {"001602": {"db_load": 2.0}}
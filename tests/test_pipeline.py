@@ -0,0 +1,65 @@
+from datetime import date
+
+import pandas as pd
+from sqlalchemy import func, select
+
+import cot
+from backend.db.models import PositionFact, RevisionLog
+from backend.db.versions import get_data_version
+from backend.db.watermarks import get_watermark
+from pipeline import TaskStatus, _load_market
+
+MARKET, REPORT = "001602", "legacy_fut"
+
+
+def report(*open_interest):
+    return pd.DataFrame({"Date": pd.date_range("2024-01-02", periods=len(open_interest), freq="7D"),
+                         "Market_Code": MARKET, "Report_Type": REPORT, "Open_Interest_All": list(open_interest)})
+
+
+def load(df):
+    return _load_market(TaskStatus(MARKET, REPORT), df, 3, 0)
+
+
+def test_rows_already_stored_are_no_data(cot_db):
+    assert load(report(5000, 5100)).state == "loaded"
+    version = get_data_version()
+
+    # the revision window reads back the stored weeks, unchanged
+    status = load(report(5000, 5100))
+    assert (status.state, status.inserted, status.updated) == ("no_data", 0, 0)
+    assert get_data_version() == version
+
+
+def test_failed_write_is_retried_with_the_first_diff(cot_db, monkeypatch):
+    load(report(5000, 5100))
+
+    save_facts, failures = cot.save_facts, []
+
+    def flaky_save_facts(df, mapper):
+        if not failures:
+            failures.append(df)
+            raise ConnectionError("connection reset")
+        return save_facts(df, mapper)
+
+    monkeypatch.setattr(cot, "save_facts", flaky_save_facts)
+    status = load(report(5000, 5150, 5200))
+
+    assert (status.state, status.attempts) == ("loaded", 2)
+    assert status.revised_from == "2024-01-09"
+    assert get_watermark(MARKET, REPORT) == date(2024, 1, 16)
+    with cot_db.connect() as conn:
+        assert conn.execute(select(func.count()).select_from(RevisionLog.__table__)).scalar() == 1
+        facts = conn.execute(select(PositionFact.Date, PositionFact.Value)).all()
+    assert (date(2024, 1, 9), 5150) in facts and (date(2024, 1, 16), 5200) in facts
+
+
+def test_first_year_to_fetch(cot_db):
+    last_dates = {"001602": date(2023, 12, 26), "002602": date(2024, 1, 9)}
+    assert cot.first_year_to_fetch(REPORT, ["001602", "002602"], last_dates) == 2023
+    assert cot.first_year_to_fetch(REPORT, ["001602", "067651"], last_dates) is None
+    assert cot.first_year_to_fetch(REPORT, None, last_dates) is None
+
+    # read from the database when not given
+    load(report(5000))
+    assert cot.first_year_to_fetch(REPORT, [MARKET]) == 2024
@@ -0,0 +1,157 @@
+"""
+Partitioning tests, run against the PostgreSQL database of COT_TEST_DB_URL and skipped without one. The tests
+drop the COT tables before and after each test, so this is a throwaway database and never DB_URL_COT, which
+backend/db/.env points to the production database.
+"""
+import os
+from datetime import date
+
+import pandas as pd
+import pytest
+from sqlalchemy import MetaData, func, select, text
+
+from backend.db.dbconnect import get_engine
+from backend.db.migrations import _stamp, rebuild_tables, upgrade
+from backend.db.models import Base, DisaggregatedFuturesOptions, Legacy, SchemaVersion
+from backend.db.partitions import (attach_partition, detach_partition, detach_years_before, list_partitions,
+                                   partitioned_in_database)
+from backend.db.upsert import upsert_dataframe
+
+DB_URL = os.getenv("COT_TEST_DB_URL", "")
+
+pytestmark = pytest.mark.skipif(not DB_URL.startswith("postgresql"), reason="COT_TEST_DB_URL is not a PostgreSQL database")
+
+
+def drop_cot_tables(engine):
+    # the tables of the models, their partitions, shadow and replaced copies, and detached partitions
+    prefixes = tuple(table.name for table in Base.metadata.sorted_tables) + ("stage_",)
+    with engine.begin() as conn:
+        names = conn.execute(text("SELECT tablename FROM pg_tables WHERE schemaname = current_schema()")).scalars()
+        for name in [name for name in names if name.startswith(prefixes)]:
+            conn.execute(text("DROP TABLE IF EXISTS {} CASCADE".format(conn.dialect.identifier_preparer.quote(name))))
+
+
+@pytest.fixture
+def engine():
+    engine = get_engine(DB_URL)
+    drop_cot_tables(engine)
+    yield engine
+    drop_cot_tables(engine)
+
+
+def rows(*keys, value=100):
+    """Legacy rows for (report type, date) keys of market 001602."""
+    return pd.DataFrame({"Report_Type": [report_type for report_type, _ in keys],
+                         "Date": [pd.Timestamp(day) for _, day in keys],
+                         "Market_Code": "001602", "Market_and_Exchange_Names": "WHEAT", "Open_Interest_All": value})
+
+
+def partition_of(engine, table, report_type, day):
+    with engine.connect() as conn:
+        return conn.execute(text('SELECT tableoid::regclass::text FROM {} WHERE "Report_Type" = :r AND "Date" = :d'.format(table)),
+                            {"r": report_type, "d": day}).scalar()
+
+
+def count(engine, table):
+    with engine.connect() as conn:
+        return conn.execute(text("SELECT count(*) FROM {}".format(table))).scalar()
+
+
+def relations_like(engine, pattern):
+    with engine.connect() as conn:
+        return conn.execute(text("SELECT relname FROM pg_class WHERE relname LIKE :p"), {"p": pattern}).scalars().all()
+
+
+def test_migration_partitions_an_unpartitioned_table(engine):
+    # the tables as they were before migration 7, stamped with version 6
+    for mapper in (DisaggregatedFuturesOptions, Legacy):
+        plain = mapper.__table__.to_metadata(MetaData())
+        plain.dialect_options["postgresql"]["partition_by"] = None
+        plain.create(engine)
+    SchemaVersion.__table__.create(engine)
+    _stamp(engine, 6, "positioning analytics table")
+    upsert_dataframe(Legacy, rows(("legacy_fut", date(2019, 3, 5)), ("legacy_futopt", date(2020, 6, 2))), engine)
+
+    assert upgrade(engine, target=7) == 7
+
+    with engine.connect() as conn:
+        assert partitioned_in_database(conn, Legacy.__table__)
+        assert partitioned_in_database(conn, DisaggregatedFuturesOptions.__table__)
+    partitions = dict(list_partitions(Legacy.__table__, engine))
+    assert partitions["legacy_fut_2019"] == "FOR VALUES FROM ('2019-01-01') TO ('2020-01-01')"
+    assert partitions["legacy_futopt_default"] == "DEFAULT"
+    assert count(engine, "legacy") == 2
+    assert partition_of(engine, "legacy", "legacy_fut", date(2019, 3, 5)) == "legacy_fut_2019"
+    assert partition_of(engine, "legacy", "legacy_futopt", date(2020, 6, 2)) == "legacy_futopt_2020"
+    # the replaced table is kept
+    assert count(engine, "legacy__unpartitioned") == 2
+
+
+def test_upsert_through_the_partitions(engine):
+    upgrade(engine)
+    keys = (("legacy_fut", date(2019, 3, 5)), ("legacy_futopt", date(2019, 3, 5)), ("legacy_fut", date(2021, 1, 5)))
+    assert upsert_dataframe(Legacy, rows(*keys), engine) == (3, 0)
+    assert upsert_dataframe(Legacy, rows(*keys[:2], ("legacy_fut", date(2022, 1, 4)), value=200), engine) == (1, 2)
+
+    with engine.connect() as conn:
+        values = dict(conn.execute(select(Legacy.Date, Legacy.Open_Interest_All).where(Legacy.Report_Type == "legacy_fut")).all())
+    assert values == {date(2019, 3, 5): 200, date(2021, 1, 5): 100, date(2022, 1, 4): 200}
+    assert partition_of(engine, "legacy", "legacy_futopt", date(2019, 3, 5)) == "legacy_futopt_2019"
+
+    # a year past the partitions created lands in the default partition of its report type
+    upsert_dataframe(Legacy, rows(("legacy_fut", date(date.today().year + 5, 1, 6))), engine)
+    assert partition_of(engine, "legacy", "legacy_fut", date(date.today().year + 5, 1, 6)) == "legacy_fut_default"
+
+
+def test_rebuild_swaps_and_renames_the_partitions(engine):
+    upgrade(engine)
+    upsert_dataframe(Legacy, rows(("legacy_fut", date(2019, 3, 5)), ("legacy_fut", date(2020, 3, 3))), engine)
+
+    with rebuild_tables((Legacy,), engine, keep_old=True):
+        upsert_dataframe(Legacy, rows(("legacy_fut", date(2019, 3, 5)), value=300), engine)
+        # readers keep seeing the live table during the rebuild
+        assert count(engine, "legacy") == 2
+
+    assert count(engine, "legacy") == 1
+    assert partition_of(engine, "legacy", "legacy_fut", date(2019, 3, 5)) == "legacy_fut_2019"
+    assert count(engine, "legacy__old") == 2
+    assert partition_of(engine, "legacy__old", "legacy_fut", date(2020, 3, 3)) == "legacy__old_fut_2020"
+    # partitions and their indexes follow their table, nothing is left under the shadow name
+    assert relations_like(engine, r"legacy\_\_shadow%") == []
+    assert "legacy_fut_2019_pkey" in relations_like(engine, "legacy_fut_2019%")
+
+
+def test_failed_rebuild_leaves_the_live_table(engine):
+    upgrade(engine)
+    upsert_dataframe(Legacy, rows(("legacy_fut", date(2019, 3, 5))), engine)
+
+    with pytest.raises(RuntimeError):
+        with rebuild_tables((Legacy,), engine):
+            upsert_dataframe(Legacy, rows(("legacy_fut", date(2020, 3, 3))), engine)
+            raise RuntimeError("load failed")
+
+    assert partition_of(engine, "legacy", "legacy_fut", date(2019, 3, 5)) == "legacy_fut_2019"
+    assert count(engine, "legacy") == 1
+    assert relations_like(engine, r"legacy\_\_shadow%") == []
+
+
+def test_detach_and_attach(engine):
+    upgrade(engine)
+    upsert_dataframe(Legacy, rows(("legacy_fut", date(2019, 3, 5)), ("legacy_fut", date(2020, 3, 3))), engine)
+
+    assert detach_partition(Legacy, "legacy_fut", 2019, engine) == "legacy_fut_2019"
+    assert "legacy_fut_2019" not in dict(list_partitions(Legacy.__table__, engine))
+    assert count(engine, "legacy") == 1
+    assert count(engine, "legacy_fut_2019") == 1
+
+    attach_partition(Legacy, "legacy_fut", 2019, engine)
+    assert count(engine, "legacy") == 2
+    assert partition_of(engine, "legacy", "legacy_fut", date(2019, 3, 5)) == "legacy_fut_2019"
+
+    detached = detach_years_before(Legacy, 2020, engine)
+    assert len(detached) == 2 * (2020 - Legacy.__table__.info["first_year"])
+    with engine.connect() as conn:
+        assert conn.execute(select(func.min(Legacy.Date))).scalar() == date(2020, 3, 3)
+
+    with pytest.raises(ValueError):
+        detach_partition(Legacy, "legacy_fut", date.today().year, engine)
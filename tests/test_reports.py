@@ -0,0 +1,135 @@
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from reports import MARKET_CODE_COLUMNS, REPORT_TYPES, normalize_report
+
+
+# one small report per layout: (published header, model column name, kind) for a sample of the columns of
+# each report type, kind being "code", "date", "text", "number" (with "." placeholders, read as text) or
+# "int" (fully populated, parsed as numbers by read_csv)
+LEGACY = [
+    ("Market and Exchange Names", "Market_and_Exchange_Names", "text"),
+    ("As of Date in Form YYYY-MM-DD", "Date", "date"),
+    ("CFTC Contract Market Code", "CFTC_Contract_Market_Code", "code"),
+    ("CFTC Market Code in Initials", "CFTC_Market_Code_in_Initials", "text"),
+    ("Open Interest (All)", "Open_Interest_All", "int"),
+    ("Noncommercial Positions-Long (All)", "Noncommercial_Positions_Long_All", "number"),
+    ("% of OI-Noncommercial-Long (All)", "Per_of_OI_Noncommercial_Long_All", "number"),
+    ("Traders-Total (All)", "Traders_Total_All", "number"),
+    ("Concentration-Gross LT =4 TDR-Long (All)", "Concentration_Gross_LT_4_TDR_Long_All", "number"),
+    ("Contract Units", "Contract_Units", "text"),
+]
+
+DISAGGREGATED = [
+    ("Market_and_Exchange_Names", "Market_and_Exchange_Names", "text"),
+    ("Report_Date_as_YYYY-MM-DD", "Date", "date"),
+    ("CFTC_Contract_Market_Code", "CFTC_Contract_Market_Code", "code"),
+    ("CFTC_Region_Code", "CFTC_Region_Code", "text"),
+    ("Open_Interest_All", "Open_Interest_All", "int"),
+    ("Prod_Merc_Positions_Long_All", "Prod_Merc_Positions_Long_All", "number"),
+    ("M_Money_Positions_Short_All", "M_Money_Positions_Short_All", "number"),
+    ("Pct_of_OI_M_Money_Long_All", "Pct_of_OI_M_Money_Long_All", "number"),
+    ("Contract_Units", "Contract_Units", "text"),
+    ("FutOnly_or_Combined", "FutOnly_or_Combined", "text"),
+]
+
+TFF = [
+    ("Market_and_Exchange_Names", "Market_and_Exchange_Names", "text"),
+    ("Report_Date_as_YYYY-MM-DD", "Date", "date"),
+    ("CFTC_Contract_Market_Code", "CFTC_Contract_Market_Code", "code"),
+    ("Open_Interest_All", "Open_Interest_All", "int"),
+    ("Dealer_Positions_Long_All", "Dealer_Positions_Long_All", "number"),
+    ("Asset_Mgr_Positions_Short_All", "Asset_Mgr_Positions_Short_All", "number"),
+    ("Pct_of_OI_Lev_Money_Long_All", "Pct_of_OI_Lev_Money_Long_All", "number"),
+    ("Contract_Units", "Contract_Units", "text"),
+    ("FutOnly_or_Combined", "FutOnly_or_Combined", "text"),
+]
+
+SUPPLEMENTAL = [
+    ("Market_and_Exchange_Names", "Market_and_Exchange_Names", "text"),
+    ("Report_Date_as_YYYY-MM-DD", "Date", "date"),
+    ("CFTC_Contract_Market_Code", "CFTC_Contract_Market_Code", "code"),
+    ("Open_Interest_All", "Open_Interest_All", "int"),
+    ("NComm_Positions_Long_All_NoCIT", "NComm_Positions_Long_All_NoCIT", "number"),
+    ("CIT_Positions_Short_All", "CIT_Positions_Short_All", "number"),
+    ("Pct_of_OI_CIT_Long_All", "Pct_of_OI_CIT_Long_All", "number"),
+    ("Contract_Units", "Contract_Units", "text"),
+]
+
+LAYOUTS = {
+    "legacy_fut": LEGACY,
+    "legacy_futopt": LEGACY,
+    "disaggregated_fut": DISAGGREGATED,
+    "disaggregated_futopt": DISAGGREGATED,
+    "traders_in_financial_futures_fut": TFF,
+    "traders_in_financial_futures_futopt": TFF,
+    "supplemental_futopt": SUPPLEMENTAL,
+}
+
+VALUES = {
+    "code": ("001602", "001602"),
+    "date": ("2024-01-09", "2024-01-02"),
+    "text": ("WHEAT", "."),
+    "number": ("1250", "."),
+    "int": ("5000", "5100"),
+}
+
+
+def published_report(report_type: str) -> pd.DataFrame:
+    """The rows of a layout written and read back as `reports.read_archive` reads the archives."""
+    layout = LAYOUTS[report_type]
+    rows = [",".join('"{}"'.format(header) for header, _, _ in layout)]
+    for i in range(2):
+        rows.append(",".join(VALUES[kind][i] for _, _, kind in layout))
+    return pd.read_csv(io.StringIO("\n".join(rows)), dtype={MARKET_CODE_COLUMNS[report_type]: str})
+
+
+def test_every_report_type_has_a_layout():
+    assert set(LAYOUTS) == set(REPORT_TYPES)
+
+
+@pytest.mark.parametrize("report_type", REPORT_TYPES)
+def test_headers_are_mapped_to_model_columns(report_type):
+    df = normalize_report(published_report(report_type), report_type)
+    expected = [name for _, name, _ in LAYOUTS[report_type]] + ["Report_Type", "Market_Code"]
+    assert list(df.columns) == expected
+    assert (df["Report_Type"] == report_type).all()
+    assert (df["Market_Code"] == "001602").all()
+
+
+@pytest.mark.parametrize("report_type", REPORT_TYPES)
+def test_placeholders_become_nan_in_numeric_columns_only(report_type):
+    df = normalize_report(published_report(report_type), report_type)
+    for _, name, kind in LAYOUTS[report_type]:
+        if kind == "number":
+            assert df[name].iloc[0] == 1250
+            assert np.isnan(df[name].iloc[1])
+        elif kind == "text":
+            assert list(df[name]) == ["WHEAT", "."]
+
+
+@pytest.mark.parametrize("report_type", REPORT_TYPES)
+def test_dtypes(report_type):
+    published = published_report(report_type)
+    df = normalize_report(published, report_type)
+    for header, name, kind in LAYOUTS[report_type]:
+        if kind == "date":
+            assert pd.api.types.is_datetime64_any_dtype(df[name])
+        elif kind == "number":
+            assert df[name].dtype == np.float64
+        elif kind == "int":
+            # already parsed as numbers, not converted again
+            assert df[name].dtype == published[header].dtype == np.int64
+        else:
+            assert pd.api.types.is_string_dtype(df[name]) or df[name].dtype == object
+    assert pd.api.types.is_string_dtype(df["Market_Code"]) or df["Market_Code"].dtype == object
+
+
+def test_input_frame_is_not_modified():
+    published = published_report("legacy_fut")
+    before = published.copy()
+    normalize_report(published, "legacy_fut", "001602")
+    pd.testing.assert_frame_equal(published, before)
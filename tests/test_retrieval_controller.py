@@ -0,0 +1,65 @@
+from datetime import date
+from decimal import Decimal
+
+import pyarrow.parquet as pq
+import pytest
+from sqlalchemy import BigInteger, Column, Date, Float, Numeric, String
+from sqlalchemy.orm import declarative_base
+
+from backend.controllers.DataRetreivalControllerCOT import DataRetreivalControllerCOT
+from backend.db.models import DataVersion
+from backend.db.versions import bump_data_version
+
+Base = declarative_base()
+
+
+class Positions(Base):
+    __tablename__ = "positions"
+
+    Date = Column(Date, primary_key=True)
+    Market_Code = Column(String, primary_key=True)
+    Report_Type = Column(String, primary_key=True)
+    Open_Interest_All = Column(BigInteger)
+    Pct_of_OI_M_Money_Long_All = Column(Float)
+    Change_in_Open_Interest_All = Column(Numeric(12, 2))
+    Traders_Tot_All = Column(Numeric)
+
+
+@pytest.fixture
+def controller(tmp_path, monkeypatch):
+    monkeypatch.setenv("DB_URL_COT", "sqlite:///{}".format(tmp_path / "cot.db"))
+    controller = DataRetreivalControllerCOT(cache=False)
+    Base.metadata.create_all(controller.engine)
+    with controller.engine.begin() as conn:
+        conn.execute(Positions.__table__.insert(), [
+            {"Date": date(2024, 1, 2), "Market_Code": "001602", "Report_Type": "disaggregated_fut", "Open_Interest_All": 5000,
+             "Pct_of_OI_M_Money_Long_All": 12.5, "Change_in_Open_Interest_All": Decimal("-250.50"), "Traders_Tot_All": 321},
+            {"Date": date(2024, 1, 9), "Market_Code": "001602", "Report_Type": "disaggregated_fut", "Open_Interest_All": 5100,
+             "Pct_of_OI_M_Money_Long_All": None, "Change_in_Open_Interest_All": None, "Traders_Tot_All": None},
+        ])
+    return controller
+
+
+def test_exported_parquet_keeps_numeric_types(controller, tmp_path):
+    path = tmp_path / "positions.parquet"
+    assert controller.export_parquet(Positions, path, chunk_size=1) == 2
+
+    table = pq.read_table(path)
+    types = {field.name: str(field.type) for field in table.schema}
+    assert types == {"Date": "date32[day]", "Market_Code": "string", "Report_Type": "string",
+                     "Open_Interest_All": "int64", "Pct_of_OI_M_Money_Long_All": "double",
+                     "Change_in_Open_Interest_All": "decimal128(12, 2)", "Traders_Tot_All": "double"}
+    rows = table.to_pylist()
+    assert rows[0]["Change_in_Open_Interest_All"] == Decimal("-250.50")
+    assert rows[0]["Traders_Tot_All"] == 321.0
+    assert rows[1]["Change_in_Open_Interest_All"] is None
+
+
+def test_data_version(controller):
+    # not migrated yet
+    assert controller.data_version() is None
+
+    DataVersion.__table__.create(controller.engine)
+    assert controller.data_version() == 0
+    bump_data_version(engine=controller.engine)
+    assert controller.data_version() == 1
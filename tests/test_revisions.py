@@ -0,0 +1,88 @@
+from datetime import date
+
+import pandas as pd
+from sqlalchemy import func, select, update
+
+from backend.db.migrations import rebuild_tables
+from backend.db.models import LATEST_TABLES, Legacy, PositionFact, RevisionLog
+from backend.db.watermarks import get_watermark
+from cot import save_new_rows
+from revisions import changed_rows, log_revisions, row_hashes
+
+MARKET, REPORT = "001602", "legacy_fut"
+
+
+def report(*values, start="2024-01-02"):
+    """Cleaned legacy rows of one market, one weekly report per (open interest, noncommercial longs) pair."""
+    return pd.DataFrame({
+        "Date": pd.date_range(start, periods=len(values), freq="7D"),
+        "Market_Code": MARKET,
+        "Report_Type": REPORT,
+        "Market_and_Exchange_Names": "WHEAT",
+        "Open_Interest_All": [oi for oi, _ in values],
+        "Noncommercial_Positions_Long_All": [longs for _, longs in values],
+    })
+
+
+def count(engine, table):
+    with engine.connect() as conn:
+        return conn.execute(select(func.count()).select_from(table)).scalar()
+
+
+def test_hashes_cover_the_numbers_only():
+    df = report((5000, 1200), (5000, 1200))
+    renamed = df.assign(Market_and_Exchange_Names="WHEAT - CBOT")
+    assert row_hashes(df, Legacy).nunique() == 1
+    assert (row_hashes(renamed, Legacy) == row_hashes(df, Legacy)).all()
+    assert (row_hashes(df.assign(Open_Interest_All=5001), Legacy) != row_hashes(df, Legacy)).all()
+
+
+def test_new_rows_are_kept(cot_db):
+    changed, revisions = changed_rows(report((5000, 1200), (5100, 1300)), Legacy, MARKET, REPORT, cot_db)
+    assert len(changed) == 2
+    assert changed["Row_Hash"].notna().all()
+    assert revisions.empty
+
+
+def test_unchanged_rows_are_dropped(cot_db):
+    save_new_rows(report((5000, 1200), (5100, 1300)), Legacy, MARKET, REPORT)
+    changed, revisions = changed_rows(report((5000, 1200), (5100, 1300), (5200, 1400)), Legacy, MARKET, REPORT, cot_db)
+    assert list(changed["Date"]) == [pd.Timestamp("2024-01-16")]
+    assert revisions.empty
+
+
+def test_revised_rows_are_logged(cot_db):
+    save_new_rows(report((5000, 1200), (5100, 1300)), Legacy, MARKET, REPORT)
+    inserted, updated, revised_from = save_new_rows(report((5000, 1200), (5100, 1350)), Legacy, MARKET, REPORT)
+    assert (inserted, updated, revised_from) == (0, 1, date(2024, 1, 9))
+
+    with cot_db.connect() as conn:
+        logged = conn.execute(select(RevisionLog.Date, RevisionLog.Changed_Columns, RevisionLog.Old_Hash != RevisionLog.New_Hash)).all()
+        stored = conn.execute(select(Legacy.Noncommercial_Positions_Long_All).where(Legacy.Date == date(2024, 1, 9))).scalar()
+    assert logged == [(date(2024, 1, 9), "Noncommercial_Positions_Long_All", True)]
+    assert stored == 1350
+
+
+def test_rows_stored_before_hashes_are_rewritten_without_a_revision(cot_db):
+    save_new_rows(report((5000, 1200)), Legacy, MARKET, REPORT)
+    with cot_db.begin() as conn:
+        conn.execute(update(Legacy.__table__).values(Row_Hash=None))
+
+    changed, revisions = changed_rows(report((5000, 1200)), Legacy, MARKET, REPORT, cot_db)
+    assert len(changed) == 1
+    assert revisions.empty
+    assert log_revisions(revisions) == 0
+
+
+def test_rebuild_loads_every_row_into_the_shadow_table(cot_db):
+    df = report((5000, 1200), (5100, 1300), (5200, 1400))
+    save_new_rows(df, Legacy, MARKET, REPORT)
+
+    with rebuild_tables((Legacy,), cot_db):
+        # the rows match the live table, but the shadow table it is replaced with starts empty
+        assert save_new_rows(df, Legacy, MARKET, REPORT) == (3, 0, None)
+
+    assert count(cot_db, Legacy.__table__) == 3
+    assert count(cot_db, LATEST_TABLES["legacy"]) == 1
+    assert count(cot_db, PositionFact.__table__) > 0
+    assert get_watermark(MARKET, REPORT) == date(2024, 1, 16)
@@ -0,0 +1,58 @@
+from datetime import date
+
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, select
+
+from backend.db.models import Legacy
+from backend.db.upsert import upsert_dataframe
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine("sqlite:///{}".format(tmp_path / "cot.db"))
+    Legacy.__table__.create(engine)
+    yield engine
+    engine.dispose()
+
+
+def rows(dates, open_interest, names="WHEAT"):
+    return pd.DataFrame({"Date": pd.to_datetime(dates), "Market_Code": "001602", "Report_Type": "legacy_fut",
+                         "Market_and_Exchange_Names": names, "Open_Interest_All": open_interest})
+
+
+def stored(engine):
+    with engine.connect() as conn:
+        return conn.execute(select(Legacy.Date, Legacy.Open_Interest_All, Legacy.Market_and_Exchange_Names)
+                            .order_by(Legacy.Date)).all()
+
+
+def test_new_and_existing_rows(engine):
+    assert upsert_dataframe(Legacy, rows(["2024-01-02", "2024-01-09"], [5000, 5100]), engine) == (2, 0)
+    assert upsert_dataframe(Legacy, rows(["2024-01-09", "2024-01-16"], [5150, 5200]), engine) == (1, 1)
+    assert stored(engine) == [(date(2024, 1, 2), 5000, "WHEAT"), (date(2024, 1, 9), 5150, "WHEAT"),
+                              (date(2024, 1, 16), 5200, "WHEAT")]
+
+
+def test_repeated_keys_keep_the_last_row(engine):
+    assert upsert_dataframe(Legacy, rows(["2024-01-02", "2024-01-02"], [5000, 5001]), engine) == (1, 0)
+    assert stored(engine) == [(date(2024, 1, 2), 5001, "WHEAT")]
+
+
+def test_missing_values_are_stored_as_null(engine):
+    upsert_dataframe(Legacy, rows(["2024-01-02"], [5000]), engine)
+    # a missing value overwrites the stored one, as the report no longer has it
+    assert upsert_dataframe(Legacy, rows(["2024-01-02", "2024-01-09"], [np.nan, pd.NA], names=[None, "WHEAT"]), engine) == (1, 1)
+    assert stored(engine) == [(date(2024, 1, 2), None, None), (date(2024, 1, 9), None, "WHEAT")]
+
+
+def test_rows_without_a_key_are_dropped(engine):
+    df = rows(["2024-01-02", None], [5000, 5100])
+    assert upsert_dataframe(Legacy, df, engine) == (1, 0)
+
+
+def test_unknown_columns_are_ignored_and_keys_required(engine):
+    assert upsert_dataframe(Legacy, rows(["2024-01-02"], [5000]).assign(Not_A_Column=1), engine) == (1, 0)
+    with pytest.raises(ValueError):
+        upsert_dataframe(Legacy, rows(["2024-01-02"], [5000]).drop(columns="Market_Code"), engine)
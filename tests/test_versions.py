@@ -0,0 +1,17 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import create_engine
+
+from backend.db.models import DataVersion
+from backend.db.versions import bump_data_version, get_data_version
+
+
+def test_concurrent_bumps_on_a_fresh_database(tmp_path):
+    engine = create_engine("sqlite:///{}".format(tmp_path / "cot.db"), connect_args={"timeout": 30})
+    DataVersion.__table__.create(engine)
+    assert get_data_version(engine=engine) == 0
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(lambda _: bump_data_version(engine=engine), range(40)))
+
+    assert get_data_version(engine=engine) == 40